@@ -1,19 +1,20 @@
-import random
-import requests
 import re
-import json
 import os
-import json 
+import asyncio
+import logging
+
+from llm_client import LLM_DEFAULT_TIMEOUT
+from resilience import post_with_retries
+from scoring import factor_matrix, weighted_scores, rank_order
 
-OPENAI_API_KEY = os.getenv("API-KEY1")
-LLAMA_API_KEY = os.getenv("LLAMA-key1")
 OPENAI_URL = "https://api.openai.com/v1/chat/completions"
-LLAMA_URL="https://api.groq.com/openai/v1/chat/completions"
 
+logger = logging.getLogger(__name__)
 
-# Load environment variables from .env file
-api_keys = [os.getenv(f"API-KEY{i}") for i in range(1, 4)]
-llama_keys = [os.getenv(f"LLAMA-key{i}") for i in range(1, 3)]
+# Stories are generated in two phases, an outline of epics and then the stories of every epic in parallel.
+# Each completion stays well under the output token limit and the first epics are ready early.
+STORY_GENERATION_SECTIONED = os.getenv("STORY_GENERATION_SECTIONED", "1") == "1"
+STORY_GENERATION_MAX_EPICS = int(os.getenv("STORY_GENERATION_MAX_EPICS", "12"))
 
 def generate_check_stories_prompt(stories, framework):
     stories_formatted = ''
@@ -56,18 +57,9 @@ def generate_check_stories_prompt(stories, framework):
     )
     
 
-def check_stories_with_framework(stories, framework, model, headers):
+def construct_check_stories_post_data(stories, framework, model):
     prompt = generate_check_stories_prompt(stories, framework)
-
-    if model == "llama3-70b-8192" or model == "mixtral-8x7b-32768":
-        url = LLAMA_URL
-        headers["Authorization"] = f"Bearer {LLAMA_API_KEY}"
-    else:
-        url = OPENAI_URL
-        headers["Authorization"] = f"Bearer {OPENAI_API_KEY}"
-
-    # headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
-    post_data = {
+    return {
         "model": model,
         "messages": [
             {"role": "system", "content": "You are a meticulous assistant capable of evaluating user stories based on established frameworks."},
@@ -76,13 +68,15 @@ def check_stories_with_framework(stories, framework, model, headers):
         "temperature": 0.7
     }
 
-    response = requests.post(url, json=post_data, headers=headers)
+async def check_stories_with_framework_async(stories, framework, model, headers, timeout=LLM_DEFAULT_TIMEOUT):
+    post_data = construct_check_stories_post_data(stories, framework, model)
+
+    # Runs on the shared connection pool, so a slow check no longer blocks the event loop
+    response = await post_with_retries(model, post_data, headers, timeout=timeout)
     if response.status_code == 200:
         completion = response.json()
         completion_text = completion['choices'][0]['message']['content']
-        print(completion_text)
-        checked_stories = parse_checked_stories(completion_text)
-        return checked_stories
+        return parse_checked_stories(completion_text)
     else:
         raise Exception("Failed to process the request with OpenAI")
 
@@ -116,213 +110,29 @@ def parse_checked_stories(completion_text):
     return checked_stories
 
 
-def parse_prioritized_stories(completion_text):
-    pattern = re.compile(
-        r"Story ID (\d+): '([^']+)' \(([^)]+)\)"
-        )
-
-    prioritized_stories = []
-    for match in pattern.finditer(completion_text):
-        story_id, story, category = match.groups()
-        prioritized_stories.append({
-            "ID": int(story_id),
-            "user_story": story,
-            "epic": category
-        })
-    return prioritized_stories
-
-def construct_ahp_prompt(data):
-    # Adjusted to match the provided JSON object's structure
-    stories_formatted = '\n'.join([f"- Story ID {story['key']}: '{story['user_story']}' ( {story['epic']}) " for story in data['stories']])
-    criteria_formatted = ', '.join(data['criteria'])
-    criteria_comparisons_formatted = json.dumps(data['criteriaComparisons'], indent=2)
-    story_comparisons_formatted = {k: json.dumps(v, indent=2) for k, v in data['storyComparisons'].items()}
-    
-    prompt_content = (
-        f"You are a helpful assistant. Using the Analytic Hierarchy Process (AHP), prioritize the following user stories based on the criteria of {criteria_formatted}.\n"
-        "Here are the stories:\n"
-        f"{stories_formatted}\n\n"
-        "The criteria comparisons are as follows:\n"
-        f"{criteria_comparisons_formatted}\n\n"
-        "The story comparisons under each criterion are as follows:\n"
-        f"{json.dumps(story_comparisons_formatted, indent=2)}\n\n"
-        "Considering these criteria and their comparisons, along with the user story comparisons under each criterion, please return the prioritized list of user stories by their ID, in descending order of priority."
-    )
-    return prompt_content
-
-def prioritize_stories_with_ahp(data, model):
- 
-    prompt = construct_ahp_prompt(data)
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
-    post_data = {
-        "model": "gpt-4o-mini",
-        "messages": [{"role": "system", "content": "You are a helpful assistant trained in AHP."}, {"role": "user", "content": prompt}],
-        "temperature": 0.7
-    }
-    response = requests.post(OPENAI_URL, json=post_data, headers=headers)
-    print('response checking: ',response)
-    if response.status_code == 200:
-        completion = response.json()
-        print('completion response',completion)
-        completion_text = completion['choices'][0]['message']['content']
-        print(completion_text)
-        prioritized_stories = parse_prioritized_stories(completion_text)
-        print('prioritized_stories ',prioritized_stories)
-        return prioritized_stories
-    else:
-        raise Exception("Failed to process the request with OpenAI")
-
 #***// Prioritize 100 dollar method // **#
 def prioritize_stories_with_100_dollar_method(data):
-    # Initialize an empty dictionary to store the total scores for each story
-    story_scores = {}
+    # Weighted sum of every story's criterion scores, computed for the whole backlog at once
+    stories = data['stories']
+    criteria = list(data['criteriaWeights'].keys())
+    weights = list(data['criteriaWeights'].values())
+    total_scores = weighted_scores(factor_matrix(stories, criteria), weights)
 
-    # Iterate over each story
-    for story in data['stories']:
-        total_score = 0
-        
-        # Calculate the score for each criterion based on the provided weights
-        for criterion, weight in data['criteriaWeights'].items():
-            # Assuming each criterion has a score associated with it for each story
-            # You can replace this with your own scoring mechanism
-            # Here, I'm just multiplying a random score (between 1 and 10) with the weight
-            criterion_score = story.get(criterion, 0) * weight
-            total_score += criterion_score
-        
-        # Assign the total score to the story
-        story_scores[story['key']] = total_score
-    
     # Sort the stories based on their total scores in descending order
-    prioritized_stories = sorted(story_scores.items(), key=lambda x: x[1], reverse=True)
-    
-    # Convert the prioritized stories into the desired format
     prioritized_stories_formatted = []
-    for story_id, total_score in prioritized_stories:
-        # Find the story details based on its ID
-        for story in data['stories']:
-            if story['key'] == story_id:
-                prioritized_stories_formatted.append({
-                    'key': story_id,
-                    'user_story': story['user_story'],
-                    'epic': story['epic']
-                })
-                break
+    for index in rank_order(total_scores):
+        story = stories[index]
+        prioritized_stories_formatted.append({
+            'key': story['key'],
+            'user_story': story['user_story'],
+            'epic': story['epic']
+        })
     
     return prioritized_stories_formatted
 
 
-
-##### Moscow 
-def construct_moscow_prompt(user_stories, method):
-    stories_formatted = '\n'.join([f"- {story['ID']}: {story['Story']} (Context: {story['Context']})" for story in user_stories])
-    prompt_content = (
-        f"You are a helpful assistant trained in software development prioritization. "
-        f"Using the {method} method, categorize the following user stories into Must have, Should have, Could have, and Won't have:\n\n"
-        f"{stories_formatted}\n\n"
-        "Please provide the categorization in a structured format."
-    )
-    return prompt_content
-
-def categorize_stories_with_moscow(user_stories, method, model):
-
-    prompt = construct_moscow_prompt(user_stories, method)
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    post_data = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.7
-    }
-    response = requests.post(OPENAI_URL, json=post_data, headers=headers)
-
-    if response.status_code == 200:
-        completion = response.json()
-        completion_text = completion['choices'][0]['message']['content']
-        # Implement parsing of completion_text to structure the MoSCoW categorization
-        return parse_moscow_categorized_stories(completion_text)
-    else:
-        raise Exception("Failed to process the request with OpenAI")
-
-
-def parse_moscow_categorized_stories(completion_text):
-    categorized_stories = []
-
-    # Adjusted regex pattern to match the format of your response
-    pattern = re.compile(r"\*\*(Must have|Should have|Could have|Won't have):\*\*\n((?:\d+\..+?\n)+)")
-
-    categories = pattern.findall(completion_text)
-    for category, stories_text in categories:
-        story_pattern = re.compile(r"(\d+)\. (.+?) \(Context: (.+?)\)")
-        for story_match in story_pattern.finditer(stories_text.strip()):
-            story_id, story, context = story_match.groups()
-            categorized_stories.append({
-                "ID": int(story_id),  # Assuming the ID refers to the position in the list rather than a unique identifier
-                "Story": story,
-                "Context": context,
-                "Category": category
-            })
-
-    return categorized_stories
-
-    
-def generate_user_stories_with_epics( vision, mvp, model, headers):
-
-    if model == "llama3-70b-8192" or model == "mixtral-8x7b-32768":
-        url = LLAMA_URL
-        headers["Authorization"] = f"Bearer {LLAMA_API_KEY}"
-    else:
-        url = OPENAI_URL
-        headers["Authorization"] = f"Bearer {OPENAI_API_KEY}"
-
-
-    # prompt_content = (
-    # "You are a helpful assistant tasked with generating unique user stories and suggesting epics from any project description or objective provided.\n"
-    # "Given the objective or project description: '{objective}', generate distinct user stories based upon the specified goals and requirements. Each user story should comprehensively address both the functional and technical aspects relevant to the project, ensuring uniqueness and avoiding duplication.\n"
-    # "For each user story, provide the following details:\n"
-    # "1. User Story: A clear and concise description that encapsulates a specific need or problem. Example: 'As a <role>, I want to <action>, in order to <benefit>'. Each story should be tailored to distinct functionalities or features identified in the project’s description.\n"
-    # "2. Epic: The epic under which the user story falls. Each epic should cover a broad thematic area that may include multiple user stories sharing a similar scope or functionality. Epics help organize user stories into manageable groups.\n"
-    # "3. Description: Detailed acceptance criteria for the user story, specifying what success looks like for the story to be considered complete.\n"
-    # "4. Sub-tasks: Include sub-tasks only if they are essential to the implementation of the user story. If sub-tasks are not necessary, this section can be left blank. Describe only general steps or tasks necessary to achieve the user story when included.\n\n"
-    # "Please use the following format for each story:\n"
-    # "### User Story X:\n"
-    # "- User Story: As a <role>, I want to <action>, in order to <benefit>.\n"
-    # "- Epic: <epic>\n"
-    # "- Description: Detailed and clear acceptance criteria that define the success of the user story.\n"
-    # "- Sub-tasks:\n"
-    # "  1. <Sub-task 1> - General description of an essential action or task (if applicable).\n"
-    # "  2. <Sub-task 2> - Another necessary step for achieving the objectives of the user story (if applicable).\n"
-    # "  3. <Sub-task 3> - Further actions required to complete the user story (if applicable).\n"
-    # "  ...\n\n"
-    # "When generating user stories, ensure they are clearly categorized under relevant epics based on the overarching themes or functionalities identified in the project description. This structure promotes organizational clarity and aids in efficient project management and implementation.\n"
-    # ).format(objective=objective)
-
-#     prompt_content = (
-#     "You are a helpful assistant tasked with generating unique user stories and grouping them under relevant epics based on any project vision or MVP goal provided.\n"
-#     "Given the project vision: '{vision}' and MVP goals: '{mvp}', generate distinct user stories that align with these core elements. Ensure each story comprehensively addresses both functional and technical aspects relevant to the project, with a focus on supporting the project's primary vision and achieving a functional MVP.\n"
-#     "For each user story, provide the following details:\n"
-#     "1. User Story: A clear and concise description that encapsulates a specific need or problem. Example: 'As a <role>, I want to <action>, in order to <benefit>'. Each story should directly support the project's vision or contribute towards a functional MVP.\n"
-#     "2. Epic: The broad epic under which the user story falls. Each epic should cover a thematic area and can encompass multiple related user stories that share a similar scope or functionality. This structure helps organize user stories into meaningful groups that align with the project's vision.\n"
-#     "3. Description: Detailed acceptance criteria for the user story, specifying what success looks like for the story to be considered complete, particularly in terms of MVP completion and alignment with the vision.\n"
-#     "4. Sub-tasks: Include sub-tasks only if they are essential to the implementation of the user story. If sub-tasks are not necessary, this section can be left blank. Describe only general steps or tasks necessary to achieve the user story when included.\n\n"
-#     "Please use the following format for each story:\n"
-#     "### User Story X:\n"
-#     "- User Story: As a <role>, I want to <action>, in order to <benefit>.\n"
-#     "- Epic: <epic> (Note: This epic may encompass multiple related user stories)\n"
-#     "- Description: Detailed and clear acceptance criteria that define the success of the user story, particularly in achieving MVP functionality and supporting the overall vision.\n"
-#     "- Sub-tasks:\n"
-#     "  1. <Sub-task 1> - General description of an essential action or task (if applicable).\n"
-#     "  2. <Sub-task 2> - Another necessary step for achieving the objectives of the user story (if applicable).\n"
-#     "  3. <Sub-task 3> - Further actions required to complete the user story (if applicable).\n"
-#     "  ...\n\n"
-#     "When generating user stories, ensure they are grouped under relevant epics based on the overarching themes, functionalities, or MVP goals identified. This structure promotes organizational clarity, supports efficient project management, and aligns with the project's vision and MVP goals."
-# ).format(vision=vision, mvp=mvp)
-
-    prompt_content = (
+def construct_user_stories_prompt(vision, mvp):
+    return (
     "You are a helpful assistant tasked with generating unique user stories and grouping them under relevant epics based on any project vision or MVP goal provided.\n"
     "When generating user stories, ensure they are grouped under relevant epics based on overarching themes, functionalities, or MVP goals identified. Each epic should contain multiple user stories that cover various aspects of the same theme or functionality. "
     "Aim to generate as many stories as necessary to fully cover the scope of the project, with **no upper limit on the number of user stories**. Focus on breaking down large functionalities into individual, task-specific stories.\n\n"
@@ -343,34 +153,157 @@ def generate_user_stories_with_epics( vision, mvp, model, headers):
     "- Description: Detailed and clear acceptance criteria that define the success of the user story, particularly in achieving MVP functionality and supporting the overall vision.\n"
 ).format(vision=vision, mvp=mvp)
 
-    
-
 
-
-    # Prepare the data for the POST request to OpenAI using the Chat API format
-    post_data = json.dumps({
+def construct_user_stories_post_data(prompt_content, model):
+    return {
         "model": model,
         "messages": [
             {"role": "system", "content": "You are a helpful assistant capable of generating user stories and suggesting epics from the objective."},
             {"role": "user", "content": prompt_content}
         ],
         "temperature": 0.7
-    })
+    }
 
-    response = requests.post(url, data=post_data, headers=headers)
-    
-    if response.status_code == 200:
-        response_data = response.json()
-        generated_content = response_data['choices'][0]['message']['content']
-        print(generated_content)
-        parsed_stories = parse_user_stories(generated_content)
-        print(parsed_stories)
-        return parsed_stories
-    else:
+
+def construct_epic_outline_prompt(vision, mvp, max_epics=STORY_GENERATION_MAX_EPICS):
+    return (
+    "You are a helpful assistant tasked with planning the epics of a product backlog based on any project vision or MVP goal provided.\n"
+    "Given the project vision: '{vision}' and MVP goals: '{mvp}', list the epics that together cover the full scope of the project. "
+    "Each epic is an overarching theme or functionality that will hold several related user stories. Epics must not overlap. "
+    "List at most {max_epics} epics and do not write the user stories yet.\n\n"
+    "Please use the following format for each epic:\n"
+    "### Epic X:\n"
+    "- Epic: <short epic name>\n"
+    "- Scope: <one sentence on what the epic covers>\n"
+).format(vision=vision, mvp=mvp, max_epics=max_epics)
+
+
+def construct_epic_stories_prompt(vision, mvp, epic, outline):
+    other_epics = "\n".join(f"- {other['epic']}: {other['scope']}" for other in outline if other is not epic)
+    return (
+    "You are a helpful assistant tasked with generating unique user stories for one epic of a project based on its vision and MVP goals.\n"
+    "Given the project vision: '{vision}' and MVP goals: '{mvp}', generate the user stories of the epic '{epic}', which covers: {scope}\n"
+    "Only write stories for this epic. The other epics of the backlog get their own stories:\n{other_epics}\n\n"
+    "Cover the epic completely, breaking large functionalities down into individual, task-specific stories that address both functional and technical aspects.\n\n"
+    "For each user story, provide the following details:\n"
+    "1. User Story: A clear and concise description that encapsulates a specific need or problem. Example: 'As a <role>, I want to <action>, in order to <benefit>'.\n"
+    "2. Epic: {epic}\n"
+    "3. Description: Detailed acceptance criteria for the user story, specifying what success looks like for the story to be considered complete.\n\n"
+    "Please use the following format for each story:\n"
+    "### User Story X:\n"
+    "- User Story: As a <role>, I want to <action>, in order to <benefit>.\n"
+    "- Epic: {epic}\n"
+    "- Description: Detailed and clear acceptance criteria that define the success of the user story.\n"
+).format(vision=vision, mvp=mvp, epic=epic['epic'], scope=epic['scope'], other_epics=other_epics or "- none")
+
+
+def parse_epic_outline(text_response, max_epics=STORY_GENERATION_MAX_EPICS):
+    pattern = re.compile(
+        r"### Epic \d+:\s*\n"
+        r"- Epic: (.*?)\n"
+        r"- Scope: (.*?)(?=\n### Epic \d+:|\Z)",
+        re.DOTALL
+    )
+    outline = []
+    seen = set()
+    for name, scope in pattern.findall(text_response):
+        name = name.strip().strip("*").strip()
+        if name and name.lower() not in seen:
+            seen.add(name.lower())
+            outline.append({"epic": name, "scope": " ".join(scope.split())})
+    return outline[:max_epics]
+
+
+async def complete_user_stories_prompt(prompt_content, model, headers, timeout=LLM_DEFAULT_TIMEOUT):
+    post_data = construct_user_stories_post_data(prompt_content, model)
+    response = await post_with_retries(model, post_data, headers, timeout=timeout)
+    if response.status_code != 200:
         raise Exception("Failed to process the request with OpenAI: " + response.text)
+    return response.json()['choices'][0]['message']['content']
 
 
-def parse_user_stories(text_response):
+def story_fingerprint_text(story):
+    # Wording of a story without case, punctuation and spacing, for dropping stories two epics both wrote
+    return " ".join(re.findall(r"\w+", story["user_story"].lower()))
+
+
+def dedupe_and_key_stories(stories):
+    unique = []
+    seen = set()
+    for story in stories:
+        fingerprint = story_fingerprint_text(story)
+        if fingerprint not in seen:
+            seen.add(fingerprint)
+            unique.append(story)
+    return [{**story, "key": key} for key, story in enumerate(unique)]
+
+
+async def generate_user_stories_by_epic(vision, mvp, model, headers, timeout=LLM_DEFAULT_TIMEOUT):
+    # Yields {"outline": [...]}, then {"epic_index", "epic", "stories"} for every epic as soon as it is parsed,
+    # and last {"stories_with_epics": [...]}: all stories in outline order, duplicates dropped and keyed 0..n-1.
+    # The keys don't depend on which epic finished first.
+    outline = parse_epic_outline(
+        await complete_user_stories_prompt(construct_epic_outline_prompt(vision, mvp), model, headers, timeout)
+    )
+    if not outline:
+        logger.warning("No epic outline in the response, generating all stories in one request")
+        stories = parse_user_stories(
+            await complete_user_stories_prompt(construct_user_stories_prompt(vision, mvp), model, headers, timeout)
+        )
+        yield {"stories_with_epics": dedupe_and_key_stories(stories), "failed_epics": []}
+        return
+    yield {"outline": outline}
+
+    async def epic_stories(index, epic):
+        try:
+            text = await complete_user_stories_prompt(
+                construct_epic_stories_prompt(vision, mvp, epic, outline), model, headers, timeout
+            )
+        except Exception as e:
+            logger.error(f"Story generation failed for epic {epic['epic']!r}: {e}")
+            return index, None
+        # The epic's name from the outline, so stories of one epic stay together
+        return index, [{**story, "epic": epic['epic']} for story in parse_user_story_sections(text)]
+
+    tasks = [asyncio.ensure_future(epic_stories(index, epic)) for index, epic in enumerate(outline)]
+    by_epic = [[] for _ in outline]
+    failed = []
+    try:
+        for finished in asyncio.as_completed(tasks):
+            index, stories = await finished
+            if stories is None:
+                failed.append(outline[index]['epic'])
+                continue
+            if not stories:
+                logger.warning(f"No user stories in the response for epic {outline[index]['epic']!r}")
+            by_epic[index] = stories
+            yield {"epic_index": index, "epic": outline[index]['epic'], "stories": stories}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if len(failed) == len(outline):
+        raise Exception("Story generation failed for every epic")
+    stories = dedupe_and_key_stories([story for stories in by_epic for story in stories])
+    logger.info(f"Generated {len(stories)} user stories for {len(outline) - len(failed)}/{len(outline)} epics")
+    yield {"stories_with_epics": stories, "failed_epics": failed}
+
+
+async def generate_user_stories_with_epics_async(vision, mvp, model, headers, timeout=LLM_DEFAULT_TIMEOUT):
+    # Returns the stories and the names of the epics whose stories could not be generated
+    if not STORY_GENERATION_SECTIONED:
+        # Keyed like the sectioned path, so both return the same shape
+        stories = parse_user_stories(
+            await complete_user_stories_prompt(construct_user_stories_prompt(vision, mvp), model, headers, timeout)
+        )
+        return dedupe_and_key_stories(stories), []
+    async for event in generate_user_stories_by_epic(vision, mvp, model, headers, timeout):
+        if "stories_with_epics" in event:
+            return event["stories_with_epics"], event["failed_epics"]
+    raise Exception("Story generation ended without a result")
+
+
+def parse_user_story_sections(text_response):
     # Adjusted pattern to match the structured numbered list format, including the last line without a newline
     pattern = re.compile(
         r"### User Story \d+:\n"
@@ -379,16 +312,14 @@ def parse_user_stories(text_response):
         r"- Description: (.*?)(?=\n### User Story \d+:|\Z)",
         re.DOTALL
     )
+    return [
+        {"user_story": match[0].strip(), "epic": match[1].strip(), "description": match[2].strip()}
+        for match in pattern.findall(text_response)
+    ]
 
-    matches = pattern.findall(text_response)
-    user_stories = []
 
-    for match in matches:
-        user_stories.append({
-            "user_story": match[0].strip(),
-            "epic": match[1].strip(),
-            "description": match[2].strip(),
-        })
+def parse_user_stories(text_response):
+    user_stories = parse_user_story_sections(text_response)
 
     if not user_stories:
         user_stories.append({
@@ -400,6 +331,5 @@ def parse_user_stories(text_response):
     return user_stories
 
 
-
 # Parsing the response
 
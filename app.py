@@ -1,13 +1,15 @@
 import asyncio
+import json
 import random
 import logging
 import os
 import re
+import uuid
 from starlette.applications import Starlette
 from starlette.routing import Route, Mount, WebSocketRoute
 from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
 from starlette.staticfiles import StaticFiles
-from starlette.responses import FileResponse, JSONResponse
+from starlette.responses import FileResponse, JSONResponse, StreamingResponse
 from starlette.requests import Request
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware import Middleware
@@ -24,26 +26,45 @@ app = FastAPI()
 load_dotenv()
 
 from helpers import (
-    construct_product_owner_prompt, construct_senior_developer_prompt, construct_senior_qa_prompt, extract_text_from_pdf, get_random_temperature, construct_greetings_prompt, construct_topic_prompt,
+    construct_product_owner_prompt, construct_senior_developer_prompt, construct_senior_qa_prompt, get_random_temperature, construct_greetings_prompt, construct_topic_prompt,
     construct_context_prompt, construct_batch_100_dollar_prompt, parse_100_dollar_response,
     validate_dollar_distribution, enrich_stories_with_dollar_distribution,
     construct_stories_formatted, ensure_unique_keys, estimate_wsjf, estimate_moscow, 
-    save_uploaded_file, parse_csv_to_json, estimate_kano, estimate_ahp, send_to_llm
+    estimate_kano, estimate_ahp, send_to_llm,
+    stream_llm_to_websocket, score_stories_in_chunks, format_client_feedback, format_discussion, AHP_METHOD
 )
+from chunking import merge_dollar_distributions
+from chunking import budgeted_prompts
+
 
 from agent import (
-    prioritize_stories_with_ahp, categorize_stories_with_moscow,
-    generate_user_stories_with_epics,
-    prioritize_stories_with_100_dollar_method, OPENAI_URL, check_stories_with_framework
+    generate_user_stories_with_epics_async, generate_user_stories_by_epic,
+    STORY_GENERATION_SECTIONED,
+    prioritize_stories_with_100_dollar_method, OPENAI_URL,
+    check_stories_with_framework_async
 )
 
-LLAMA_URL="https://api.groq.com/openai/v1/chat/completions"
-
-api_keys = [os.getenv(f"API-KEY{i}") for i in range(1, 4)]
-llama_keys = [os.getenv(f"LLAMA-key{i}") for i in range(1, 3)]
+from llm_client import close_clients, LLM_DEFAULT_TIMEOUT
+from workflow import agent_step, run_agent_steps
+from llm_cache import cache_enabled, cache_stats
+from key_scheduler import key_stats
+from resilience import resilience_stats
+from ingestion import iter_upload, upload_options, UploadError
+from pdf_extraction import extract_pdf_text, close_pdf_pool, PDF_MAX_BYTES
+from comparison import combine_rankings, describe_agreement
+from dedup import dedupe_backlog, find_duplicate_clusters, describe_clusters, DEDUP_MODE, DEDUP_MODES, DEDUP_THRESHOLD
+from incremental import plan_incremental_run, merge_incremental_results, reference_stories, session_snapshot, RELATIVE_FIELDS
+from session_store import (
+    create_session, save_run_start, save_turn, save_results, save_status, load_session, delete_expired_sessions,
+    close_session_store
+)
+from jobs import (
+    submit_job, get_job, find_job, request_cancel, active_job_for_session, status_event, queue_position, job_stats, close_jobs,
+    QueueFullError
+)
 
+LLAMA_URL="https://api.groq.com/openai/v1/chat/completions"
 
-print("API Keys:", api_keys)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -52,72 +73,371 @@ logger = logging.getLogger(__name__)
 
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    # Every connection gets a stored session, a client that reconnects sends {"resume": session_id} to get it back.
+    # session holds the results and agent turns of the last run, for incremental re-prioritization.
+    state = {"session_id": uuid.uuid4().hex, "session": None}
+    await create_session(state["session_id"])
+    await websocket.send_json({"agentType": "session", "message": "", "session_id": state["session_id"]})
+    # Runs are jobs on the worker pool, this loop only submits them and forwards the events of the ones it follows
+    forwarders = {}
     try:
         while True:
             data = await websocket.receive_json()
-            if "stories" in data and "prioritization_type" in data and "model" in data:
-                stories = data.get("stories")
-                model = data.get("model")
-                client_feedback = data.get("feedback")
-                prioritization_type = data.get("prioritization_type").upper()  # Normalize to uppercase
-                await run_agents_workflow(stories, prioritization_type, model, client_feedback, websocket)
+            action = data.get("action", "submit")
+            if "resume" in data:
+                await resume_session(websocket, state, data["resume"], forwarders, data.get("replay", True))
+            elif action == "subscribe" and get_job(data.get("job_id")):
+                follow_job(websocket, get_job(data["job_id"]), forwarders)
+            elif action in ("subscribe", "cancel", "status"):
+                # Jobs of other worker processes can be cancelled and polled, but their events stay with that worker
+                job_id = data.get("job_id")
+                cancel_requested = await request_cancel(job_id) if action == "cancel" else None
+                summary = await find_job(job_id) or {"job_id": job_id, "status": "not_found"}
+                if cancel_requested is not None:
+                    summary["cancel_requested"] = cancel_requested
+                await websocket.send_json({"agentType": "job", "message": "", **summary})
+            elif action == "submit" and "stories" in data and "prioritization_type" in data and "model" in data:
+                try:
+                    job = submit_prioritization(state, data)
+                except QueueFullError as e:
+                    logger.warning(f"Rejecting prioritization run: {e}")
+                    await websocket.send_json({
+                        "agentType": "job", "message": "", "status": "rejected",
+                        "error": "The server is busy, please try again in a moment",
+                    })
+                    continue
+                except ValueError as e:
+                    await websocket.send_json({"agentType": "job", "message": "", "status": "rejected", "error": str(e)})
+                    continue
+                await websocket.send_json(status_event(job, queue_position=queue_position(job)))
+                follow_job(websocket, job, forwarders)
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected")
     finally:
+        # The jobs keep running and store their results, only the forwarding stops
+        for forwarder in forwarders.values():
+            forwarder.cancel()
         if websocket.application_state != WebSocketState.DISCONNECTED:
             await websocket.close()
 
 
+def missing_keys_error(stories):
+    if not isinstance(stories, list) or not all(isinstance(story, dict) and 'key' in story for story in stories):
+        return "Every story needs a key"
+    return None
+
+
+def submit_prioritization(state, data):
+    # Raises ValueError for a request that can't run, before anything is queued
+    stories = data.get("stories") or []
+    error = missing_keys_error(stories)
+    if error:
+        raise ValueError(error)
+    dedup_mode = data.get("dedup", DEDUP_MODE)
+    if dedup_mode not in DEDUP_MODES:
+        raise ValueError(f"Unsupported dedup mode {dedup_mode!r}, use one of {', '.join(DEDUP_MODES)}")
+    # Keys identify stories in the results and in the session store, clients sometimes send duplicates
+    stories = ensure_unique_keys(stories)
+    model = data.get("model")
+    client_feedback = data.get("feedback")
+    # One technique, or a list of them to compare in one run
+    requested = data.get("prioritization_type")
+    prioritization_types = list(dict.fromkeys(
+        name.upper() for name in (requested if isinstance(requested, list) else [requested])  # Normalize to uppercase
+    ))
+    use_cache = data.get("use_cache", True)
+    # Without the cache the client asks for new answers, patching the previous run would reuse the old ones
+    previous_session = state["session"] if data.get("incremental", True) and use_cache else None
+    session_id = state["session_id"]
+
+    async def run(channel):
+        cache_enabled.set(use_cache)
+        try:
+            run_stories = await merge_duplicate_stories(stories, dedup_mode, channel)
+            if len(prioritization_types) > 1:
+                snapshot = await run_multi_technique_workflow(
+                    run_stories, prioritization_types, model, client_feedback, channel, session_id
+                )
+            else:
+                snapshot = await run_agents_workflow(
+                    run_stories, prioritization_types[0], model, client_feedback, channel, previous_session, session_id
+                )
+        except asyncio.CancelledError:
+            await save_status(session_id, "cancelled")
+            raise
+        except Exception:
+            await save_status(session_id, "failed")
+            raise
+        if state["session_id"] == session_id:
+            state["session"] = snapshot
+        return snapshot["results"]
+
+    return submit_job(run, "+".join(prioritization_types), session_id)
+
+
+async def merge_duplicate_stories(stories, mode, websocket):
+    # Near-duplicates are reported, or merged so that every prompt of the run is shorter. Off the event loop,
+    # MinHash over a few thousand stories takes a moment.
+    merged_stories, clusters = await asyncio.to_thread(dedupe_backlog, stories, mode)
+    if clusters:
+        await websocket.send_json({
+            "agentType": "duplicates",
+            "message": describe_clusters(stories, clusters, merged=mode == "merge"),
+            "clusters": [[stories[i]['key'] for i in members] for members in clusters],
+            "merged": mode == "merge",
+        })
+    return merged_stories
+
+
+def follow_job(websocket, job, forwarders, from_start=True):
+    if job.id in forwarders and not forwarders[job.id].done():
+        return
+    forwarders[job.id] = asyncio.ensure_future(forward_job_events(websocket, job, from_start))
+
+
+async def forward_job_events(websocket, job, from_start=True):
+    subscriber = job.subscribe(from_start)
+    try:
+        while (event := await subscriber.get()) is not None:
+            if websocket.application_state == WebSocketState.DISCONNECTED:
+                break
+            await websocket.send_json(event)
+    except (WebSocketDisconnect, RuntimeError):
+        logger.info(f"Stopped forwarding job {job.id}, the WebSocket is closed")
+    finally:
+        job.unsubscribe(subscriber)
+
+
+async def resume_session(websocket, state, session_id, forwarders, replay=True):
+    stored = await load_session(session_id)
+    if stored is None:
+        logger.info(f"Session {session_id} not found, keeping the new one")
+        return
+    state["session_id"] = session_id
+    await websocket.send_json({"agentType": "session", "message": "", "session_id": session_id, "status": stored["status"]})
+
+    job = active_job_for_session(session_id)
+    if job is not None:
+        # The run is still going: its own events replace the stored turns, and the snapshot comes when it ends
+        state["session"] = None
+        follow_job(websocket, job, forwarders, from_start=replay)
+        return
+    if replay:
+        for agent, agent_type in (("po", "PO"), ("qa", "QA"), ("developer", "developer")):
+            if agent in stored["turns"]:
+                await stream_response_word_by_word(websocket, stored["turns"][agent], agent_type)
+        if stored["results"] and stored["technique"] == MULTI_TECHNIQUE:
+            techniques = [column[:-len("_rank")] for column in stored["results"][0] if column.endswith("_rank")]
+            await send_final_output(websocket, stored["results"], MULTI_TECHNIQUE, techniques=techniques)
+        elif stored["results"]:
+            await send_final_output(websocket, stored["results"], prioritization_type_for(stored["technique"]))
+    state["session"] = None
+    if stored["status"] == "done" and stored["results"]:
+        turns = {agent: stored["turns"].get(agent, "") for agent in ("po", "qa", "developer")}
+        state["session"] = session_snapshot(
+            stored["technique"], stored["model"], stored["stories"], stored["feedback"], turns, stored["results"]
+        )
+
+
+PRIORITIZATION_TYPES = ("100_DOLLAR", "WSJF", "MOSCOW", "KANO", "AHP")
+# Stored technique of a run that compared several techniques, its results are the combined table
+MULTI_TECHNIQUE = "MULTI"
+
+# Only the 100 dollar manager prompt reads the PO turn, the other techniques start as soon as QA and developer are done
+TECHNIQUE_DEPENDENCIES = {
+    "100_DOLLAR": ("po", "qa", "developer"),
+    "WSJF": ("qa", "developer"),
+    "MOSCOW": ("qa", "developer"),
+    "KANO": ("qa", "developer"),
+    "AHP": ("qa", "developer"),
+}
+
+
+def enrichment_technique(prioritization_type):
+    if prioritization_type == "AHP" and AHP_METHOD == "pairwise":
+        return "AHP_PAIRWISE"
+    return prioritization_type
+
+
+def prioritization_type_for(technique):
+    return "AHP" if technique == "AHP_PAIRWISE" else technique
+
+
 # client_feedback=""
-async def run_agents_workflow(stories, prioritization_type, model, client_feedback, websocket):
-   
+async def run_agents_workflow(stories, prioritization_type, model, client_feedback, websocket, previous_session=None, session_id=None):
+    # Returns the session snapshot that the next message on this connection can re-prioritize incrementally
+    if prioritization_type not in PRIORITIZATION_TYPES:
+        raise ValueError(f"Unsupported prioritization type: {prioritization_type}")
+
+    feedback_lines = format_client_feedback(client_feedback)
+    technique = enrichment_technique(prioritization_type)
+    rescore = plan_incremental_run(previous_session, stories, feedback_lines, technique, model)
+    if rescore is not None:
+        await save_run_start(session_id, technique, model, stories, feedback_lines, keep_turns=True)
+        return await run_incremental_workflow(
+            previous_session, rescore, stories, prioritization_type, model, client_feedback, websocket, session_id
+        )
+    await save_run_start(session_id, technique, model, stories, feedback_lines)
+
+    async def run_prioritization(po=None, qa=None, developer=None):
+        return await run_prioritization_step(prioritization_type, stories, model, client_feedback, websocket, qa, developer, po)
+
+    # Steps 1-3 don't depend on each other and run concurrently, Step 4 waits only for its own inputs
+    results = await run_agent_steps(discussion_steps(stories, model, client_feedback, websocket, session_id) + [
+        agent_step("prioritization", run_prioritization, depends_on=TECHNIQUE_DEPENDENCIES[prioritization_type]),
+    ])
+    prioritized_stories = results["prioritization"]
+    await save_results(session_id, technique, prioritized_stories)
+
+    await send_final_output(websocket, prioritized_stories, prioritization_type)
+
+    turns = {"po": results["po"], "qa": results["qa"], "developer": results["developer"]}
+    return session_snapshot(technique, model, stories, feedback_lines, turns, prioritized_stories)
+
+
+def discussion_steps(stories, model, client_feedback, websocket, session_id=None):
     # Step 1: Greetings
-    greetings_prompt = construct_product_owner_prompt({"stories": stories}, client_feedback )
-    greetings_response = await engage_agents(greetings_prompt, websocket, "PO", model)
+    greetings_prompts = budgeted_prompts("Product Owner", model, lambda s, _: construct_product_owner_prompt({"stories": s}, client_feedback ), stories)
 
-    try:
+    # Step 2: Topic Introduction
+    topic_prompts = budgeted_prompts("Senior Developer", model, lambda s, _: construct_senior_developer_prompt({"stories": s}, client_feedback ), stories)
+
+    # Step 3: Context and Discussion
+    context_prompts = budgeted_prompts("Senior QA", model, lambda s, _: construct_senior_qa_prompt({"stories": s}, client_feedback ), stories)
+
+    async def run_turn(agent, prompts, agent_type):
+        # A backlog too large for the model is discussed part by part, the parts make up the agent's turn
+        responses = [await engage_agents(prompt, websocket, agent_type, model) for prompt in prompts]
+        response = "\n\n".join(responses)
+        await save_turn(session_id, agent, response)
+        return response
+
+    async def run_po():
+        greetings_response = await run_turn("po", greetings_prompts, "PO")
         # Log the raw response for debugging
         logger.info(f"Raw greetings response: {greetings_response}")
+        return greetings_response
+
+    return [
+        agent_step("po", run_po),
+        agent_step("qa", lambda: run_turn("qa", topic_prompts, "QA")),
+        agent_step("developer", lambda: run_turn("developer", context_prompts, "developer")),
+    ]
+
+
+class TechniqueChannel:
+    # The WebSocket as seen by one technique of a multi-technique run: its chat frames are labelled with the
+    # technique so that the concurrent streams don't run into each other
+    def __init__(self, websocket, label):
+        self.websocket = websocket
+        self.label = label
+
+    @property
+    def application_state(self):
+        return self.websocket.application_state
+
+    async def send_json(self, payload):
+        if payload.get("agentType") == "Final Prioritization":
+            payload = {**payload, "agentType": f"Final Prioritization ({self.label})"}
+        await self.websocket.send_json(payload)
+
+
+async def run_multi_technique_workflow(stories, prioritization_types, model, client_feedback, websocket, session_id=None):
+    # The agents discuss once, then every technique scores the backlog concurrently on that discussion.
+    # Returns a snapshot of the combined table, which the incremental mode of a single technique won't reuse.
+    unsupported = [name for name in prioritization_types if name not in PRIORITIZATION_TYPES]
+    if unsupported:
+        raise ValueError(f"Unsupported prioritization type(s): {unsupported}")
+
+    feedback_lines = format_client_feedback(client_feedback)
+    await save_run_start(session_id, MULTI_TECHNIQUE, model, stories, feedback_lines)
+
+    def run_technique(prioritization_type):
+        channel = TechniqueChannel(websocket, prioritization_type)
+
+        async def run(po=None, qa=None, developer=None):
+            # One technique failing leaves the others in the comparison
+            try:
+                prioritized_stories = await run_prioritization_step(
+                    prioritization_type, stories, model, client_feedback, channel, qa, developer, po
+                )
+            except Exception as e:
+                logger.error(f"{prioritization_type} failed in the multi-technique run: {e}")
+                await stream_response_word_by_word(channel, f"{prioritization_type} could not be completed.", "Final Prioritization")
+                return None
+            await save_results(session_id, enrichment_technique(prioritization_type), prioritized_stories, status="running")
+            return prioritized_stories
+        return run
+
+    results = await run_agent_steps(discussion_steps(stories, model, client_feedback, websocket, session_id) + [
+        agent_step(name, run_technique(name), depends_on=TECHNIQUE_DEPENDENCIES[name]) for name in prioritization_types
+    ])
+    completed = [
+        (name, enrichment_technique(name), results[name]) for name in prioritization_types if results[name] is not None
+    ]
+    if not completed:
+        raise Exception("None of the techniques produced a prioritization")
+
+    rows, agreement = combine_rankings(stories, completed)
+    await save_results(session_id, MULTI_TECHNIQUE, rows)
+    if len(completed) > 1:
+        await stream_response_word_by_word(websocket, describe_agreement(agreement), "Final Prioritization")
+    await send_final_output(
+        websocket, rows, MULTI_TECHNIQUE, techniques=[name for name, _, _ in completed], agreement=agreement
+    )
 
-        # # Improved parsing logic
-        # greetings = greetings_response.split("2. ")
-        # pekka_greeting = greetings[0].strip()
-        # remaining_greetings = greetings[1].split("3. ")
-        # sami_greeting = remaining_greetings[0].strip()
-        # zeeshan_greeting = remaining_greetings[1].strip()
-
-        # Send greetings with delay
-        stream_response_word_by_word(websocket, greetings_response, "PO")
-        #await asyncio.sleep(1)  # Delay of 1 second between greetings
-        
-        #await stream_response_word_by_word(websocket, sami_greeting, "QA")
-        #await asyncio.sleep(1)  # Delay of 1 second between greetings
-        
-        #await stream_response_word_by_word(websocket, zeeshan_greeting, "developer")
-    except Exception as e:
-        logger.error(f"Error parsing greetings response: {greetings_response}")
-        logger.error(f"Exception: {e}")
-        #await websocket.send_json({"agentType": "error", "message": "Error parsing greetings response. Please try again later."})
-
-     # Step 2: Topic Introduction
-    topic_prompt = construct_senior_developer_prompt({"stories": stories}, client_feedback )    #logger.info(f"topic_prompt : {topic_prompt}")
-    
-    # Step 3: Context and Discussion
-    context_prompt = construct_senior_qa_prompt({"stories": stories}, client_feedback ) 
-    
-    # Run Step 2 and Step 3 concurrently
-    topic_response, context_response = await asyncio.gather(
-        engage_agents(topic_prompt, websocket, "QA", model),
-        engage_agents(context_prompt, websocket, "developer", model)
+    turns = {"po": results["po"], "qa": results["qa"], "developer": results["developer"]}
+    return session_snapshot(MULTI_TECHNIQUE, model, stories, feedback_lines, turns, rows)
+
+
+async def run_incremental_workflow(previous_session, rescore, stories, prioritization_type, model, client_feedback, websocket, session_id=None):
+    # Skips the agent discussion: only the changed stories are scored again, with the earlier turns as context,
+    # and merged into the previous ranking
+    technique = previous_session["technique"]
+    feedback_lines = format_client_feedback(client_feedback)
+    new_feedback = [line for line in feedback_lines if line not in previous_session["feedback"]]
+    turns = previous_session["turns"]
+    logger.info(f"Incremental run: re-scoring {len(rescore)} of {len(stories)} stories")
+
+    rescored = []
+    references = []
+    if rescore and technique in RELATIVE_FIELDS:
+        # Relative scores only mean something next to other stories, a few unchanged ones are scored again as anchors
+        references = reference_stories(technique, previous_session["results"], stories, {story['key'] for story in rescore})
+    if rescore:
+        await stream_response_word_by_word(
+            websocket, f"Re-prioritizing {len(rescore)} changed stories using the earlier discussion.", "Final Prioritization"
+        )
+        qa_turn = format_discussion(turns["qa"])
+        if new_feedback:
+            qa_turn += "\n\nNew feedback from the client:\n" + '\n'.join('- ' + line for line in new_feedback)
+        rescored = await run_prioritization_step(
+            prioritization_type, rescore + references, model, client_feedback, websocket, qa_turn, turns["developer"], turns["po"]
+        )
+    prioritized_stories = merge_incremental_results(
+        technique, previous_session["results"], rescored, stories, {story['key'] for story in references}
     )
+    await save_results(session_id, technique, prioritized_stories)
 
-    #logger.info(f"topic_prompt response: {topic_response}")
-    
+    await send_final_output(websocket, prioritized_stories, prioritization_type)
+    return session_snapshot(technique, model, stories, feedback_lines, turns, prioritized_stories)
+
+
+async def send_final_output(websocket, prioritized_stories, prioritization_type, **extra):
+    # Step 5: Final Output
+    await stream_response_word_by_word(websocket, "Here is the final prioritized output:", "Final Prioritization")
+
+    # Step 6: Final Output in table
+    await websocket.send_json({"agentType": "Final_output_into_table", "message": prioritized_stories, "prioritization_type": prioritization_type, **extra})
+
+
+async def run_prioritization_step(prioritization_type, stories, model, client_feedback, websocket, topic_response, context_response, greetings_response=None):
     # Step 4: Prioritization
     if prioritization_type == "100_DOLLAR":
         # prioritize_prompt = construct_batch_100_dollar_prompt({"stories": stories}, topic_response, context_response)
-        prioritize_prompt = construct_batch_100_dollar_prompt({"stories": stories}, topic_response, context_response, greetings_response, client_feedback )
-        prioritized_stories = await engage_agents_in_prioritization(prioritize_prompt, stories, websocket, model)
+        build_prompt = lambda chunk, turns: construct_batch_100_dollar_prompt({"stories": chunk}, *turns, client_feedback )
+        turns = (topic_response, context_response, greetings_response)
+        prioritized_stories = await engage_agents_in_prioritization(build_prompt, turns, stories, websocket, model)
         print("Final 100 dollar", prioritized_stories)
     elif prioritization_type == "WSJF":
         prioritized_stories = await estimate_wsjf(stories, websocket, model, topic_response, context_response)
@@ -129,50 +449,43 @@ async def run_agents_workflow(stories, prioritization_type, model, client_feedba
         prioritized_stories = await estimate_ahp({"stories": stories}, websocket, model, topic_response, context_response)    
     else:
         raise ValueError(f"Unsupported prioritization type: {prioritization_type}")
-
-    # Step 5: Final Output
-    await stream_response_word_by_word(websocket, "Here is the final prioritized output:", "Final Prioritization")
-
-    # Step 6: Final Output in table
-    await asyncio.sleep(1)  # Delay of 1 second between greetings
-    await websocket.send_json({"agentType": "Final_output_into_table", "message": prioritized_stories, "prioritization_type": prioritization_type})
+    return prioritized_stories
 
 
 async def engage_agents(prompt, websocket, agent_type, model, max_retries=1):
     headers = {
-        "Authorization": f"Bearer {random.choice(api_keys)}",
         "Content-Type": "application/json"
     }
 
     agent_prompt = {"role": "user", "content": prompt}
     
     logger.info(f"Engaging agents with prompt: {prompt}")
-    agent_response = await send_to_llm(agent_prompt['content'], headers, model)
+    agent_response = await stream_llm_to_websocket(agent_prompt['content'], headers, model, websocket, agent_type)
     
-    if agent_response:
-        await stream_response_word_by_word(websocket, agent_response, agent_type)
-    else:
+    if not agent_response:
         agent_response = "No response from agent"
     
     return agent_response
 
-async def engage_agents_in_prioritization(prompt, stories, websocket, model, max_retries=1 ):
+async def engage_agents_in_prioritization(build_prompt, turns, stories, websocket, model, max_retries=2):
+    # Transport errors are retried in resilience.py, these attempts are for answers that could not be parsed
     headers = {
-        "Authorization": f"Bearer {random.choice(api_keys)}",
         "Content-Type": "application/json"
     }
 
-    logger.info(f"Engaging agents in prioritization with prompt: {prompt}")
+    logger.info(f"Engaging agents in prioritization for {len(stories)} stories")
     for attempt in range(max_retries):
+        if attempt > 0:
+            # The unparseable completion is cached, ask the model again instead of replaying it
+            cache_enabled.set(False)
         try:
-            final_response = await send_to_llm(prompt, headers, model)
-            logger.info(f"Final response from agent: {final_response}")  # Detailed logging
-            await stream_response_word_by_word(websocket, final_response, "Final Prioritization")
+            chunk_results = await score_stories_in_chunks(stories, websocket, model, headers, build_prompt, parse_100_dollar_response, "100 dollar", turns)
+            logger.info(f"Final response from agent: {chunk_results}")  # Detailed logging
 
-            dollar_distribution = parse_100_dollar_response(final_response)
+            dollar_distribution = merge_dollar_distributions(chunk_results, len(stories))
 
             if not dollar_distribution:
-                logger.error(f"Failed to parse dollar distribution: {final_response}")
+                logger.error(f"Failed to parse dollar distribution: {chunk_results}")
                 continue
 
             logger.info(f"Dollar Response: {dollar_distribution}")
@@ -190,7 +503,8 @@ async def engage_agents_in_prioritization(prompt, stories, websocket, model, max
 
         except Exception as e:
             logger.error(f"Error during prioritization attempt {attempt + 1}: {str(e)}")
-        logger.info(f"Retrying prioritization... ({attempt + 1}/{max_retries})")
+        if attempt + 1 < max_retries:
+            logger.info(f"Retrying prioritization... ({attempt + 1}/{max_retries})")
 
     raise Exception("Failed to get valid response from agents after multiple attempts")
 
@@ -241,21 +555,45 @@ async def stream_response_word_by_word(websocket, response, agent_type, delay=0.
         })
         # await asyncio.sleep(delay)  # Delay to simulate streaming effect  
 
-async def stream_response_as_complete_message(websocket: WebSocket, response: str, agent_type: str, delay: float = 0.6):
-    if websocket.application_state != WebSocketState.DISCONNECTED:
-        await websocket.send_json({
-            "agentType": agent_type,
-            "message": response
-        })
-        await asyncio.sleep(delay)  # Delay to simulate streaming effect            
-
 async def catch_all(request):
     return FileResponse(os.path.join('dist', 'index.html'))
 
+async def run_until_disconnected(request: Request, coro, poll_interval=0.5):
+    # Cancel the LLM call as soon as the HTTP client goes away instead of finishing it for nobody
+    task = asyncio.ensure_future(coro)
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=poll_interval)
+            if not task.done() and await request.is_disconnected():
+                logger.info(f"Client disconnected, cancelling {request.url.path}")
+                return None, JSONResponse({'error': 'Client disconnected'}, status_code=499)
+        return task.result(), None
+    except httpx.TimeoutException:
+        logger.error(f"LLM request timed out for {request.url.path}")
+        return None, JSONResponse({'error': 'The model did not respond in time'}, status_code=504)
+    finally:
+        if not task.done():
+            task.cancel()
+
+def stream_generated_stories(vision, mvp, model, headers, timeout):
+    # NDJSON, one line per event of generate_user_stories_by_epic, so the first epics show while the rest are
+    # generated. A client that disconnects closes the generator, which cancels the epics still running.
+    async def lines():
+        try:
+            if STORY_GENERATION_SECTIONED:
+                async for event in generate_user_stories_by_epic(vision, mvp, model, headers, timeout):
+                    yield json.dumps(event) + "\n"
+            else:
+                stories, failed_epics = await generate_user_stories_with_epics_async(vision, mvp, model, headers, timeout=timeout)
+                yield json.dumps({"stories_with_epics": stories, "failed_epics": failed_epics}) + "\n"
+        except Exception as e:
+            logger.error(f"User story generation failed: {e}")
+            yield json.dumps({"error": str(e)}) + "\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 async def generate_user_stories(request: Request):
     data = await request.json()
     headers = {
-        "Authorization": f"Bearer {random.choice(api_keys)}",
         "Content-Type": "application/json"
     }
 
@@ -264,28 +602,53 @@ async def generate_user_stories(request: Request):
     model = data['model']
     vision = data['vision']
     mvp = data['mvp']
-    stories_with_epics = generate_user_stories_with_epics(vision, mvp, model,headers)
-    return JSONResponse({"stories_with_epics": stories_with_epics})
-
-
-# async def generate_user_stories_by_files(request: Request):
-#     print(vision_file)
-#     print(mvp_file)
-#     try:
-#         vision_data = await extract_text_from_pdf(vision_file)
-#         mvp_data = extract_text_from_pdf(mvp_file)
-#         print(vision_data)
-#         print(mvp_data)
-
-#         return JSONResponse({"vision_content": vision_data, "mvp_content":mvp_data })
-#     except Exception as e:
-#         return JSONResponse({'error': f"Error processing the file: {str(e)}"}, status_code=500)
+    timeout = float(data.get('timeout', LLM_DEFAULT_TIMEOUT))
+    if data.get('stream'):
+        return stream_generated_stories(vision, mvp, model, headers, timeout)
+    generated, error_response = await run_until_disconnected(
+        request, generate_user_stories_with_epics_async(vision, mvp, model, headers, timeout=timeout)
+    )
+    if error_response:
+        return error_response
+    # Epics whose request failed are missing from the stories, the client is told which
+    stories_with_epics, failed_epics = generated
+    return JSONResponse({"stories_with_epics": stories_with_epics, "failed_epics": failed_epics})
+
+
+async def generate_user_stories_by_files(request: Request):
+    # Same as generate_user_stories with the vision and MVP read from PDFs, extracted off the event loop
+    if int(request.headers.get('content-length') or 0) > 2 * PDF_MAX_BYTES + 64 * 1024:
+        return JSONResponse({'error': 'The upload is too large'}, status_code=413)
+    form = await request.form(max_files=2, max_fields=5)
+    try:
+        if 'vision_file' not in form or 'model' not in form:
+            return JSONResponse({'error': 'Missing required data: vision_file, and model'}, status_code=400)
+        model = form['model']
+        timeout = float(form.get('timeout', LLM_DEFAULT_TIMEOUT))
+        stream = form.get('stream') == 'true'
+        files = [form['vision_file']] + ([form['mvp_file']] if form.get('mvp_file') else [])
+        try:
+            texts = await asyncio.gather(*(extract_pdf_text(file) for file in files))
+        except UploadError as e:
+            return JSONResponse({'error': str(e)}, status_code=e.status_code)
+    finally:
+        await form.close()
+    vision, mvp = texts[0], texts[1] if len(texts) > 1 else ""
+    if stream:
+        return stream_generated_stories(vision, mvp, model, {"Content-Type": "application/json"}, timeout)
+    generated, error_response = await run_until_disconnected(
+        request, generate_user_stories_with_epics_async(vision, mvp, model, {"Content-Type": "application/json"}, timeout=timeout)
+    )
+    if error_response:
+        return error_response
+    # Epics whose request failed are missing from the stories, the client is told which
+    stories_with_epics, failed_epics = generated
+    return JSONResponse({"stories_with_epics": stories_with_epics, "failed_epics": failed_epics})
 
 
 async def check_user_stories_quality(request: Request):
     data = await request.json()
     headers = {
-        "Authorization": f"Bearer {random.choice(api_keys)}",
         "Content-Type": "application/json"
     }
     if not data or 'framework' not in data or 'stories' not in data or 'model' not in data:
@@ -294,34 +657,102 @@ async def check_user_stories_quality(request: Request):
     model = data['model']
     framework = data['framework']
     stories = data['stories']
-    stories_with_epics = check_stories_with_framework(framework, stories, model, headers)
+    timeout = float(data.get('timeout', LLM_DEFAULT_TIMEOUT))
+    stories_with_epics, error_response = await run_until_disconnected(
+        request, check_stories_with_framework_async(stories, framework, model, headers, timeout=timeout)
+    )
+    if error_response:
+        return error_response
     return JSONResponse({"stories_with_epics": stories_with_epics})
 
-async def upload_csv(request: Request):
-    form = await request.form()
-    file = form.get("file")
-    if not file:
-        return JSONResponse({'error': 'No file part'}, status_code=400)
-    
-    file_path, error = save_uploaded_file(UPLOAD_FOLDER, file)
-    
+async def find_duplicates(request: Request):
+    # Suggested merges for a backlog, before it is prioritized
+    data = await request.json()
+    if not data or 'stories' not in data:
+        return JSONResponse({'error': 'Missing required data: stories'}, status_code=400)
+    stories = data['stories']
+    error = missing_keys_error(stories)
     if error:
         return JSONResponse({'error': error}, status_code=400)
-    if file_path:
-        csv_data = parse_csv_to_json(file_path)
-        return JSONResponse({"stories_with_epics": csv_data})
+    try:
+        threshold = float(data.get('threshold', DEDUP_THRESHOLD))
+    except (TypeError, ValueError):
+        return JSONResponse({'error': 'threshold must be a number'}, status_code=400)
+    clusters = await asyncio.to_thread(find_duplicate_clusters, stories, threshold)
+    return JSONResponse({
+        "clusters": [[stories[i]['key'] for i in members] for members in clusters],
+        "message": describe_clusters(stories, clusters, merged=False),
+    })
+
+async def get_cache_stats(request: Request):
+    return JSONResponse(cache_stats())
+
+async def get_key_stats(request: Request):
+    return JSONResponse(key_stats())
+
+async def get_resilience_stats(request: Request):
+    return JSONResponse(resilience_stats())
+
+async def get_job_status(request: Request):
+    summary = await find_job(request.path_params['job_id'])
+    if summary is None:
+        return JSONResponse({'error': 'Job not found'}, status_code=404)
+    return JSONResponse(summary)
+
+async def get_job_stats(request: Request):
+    return JSONResponse(job_stats())
+
+class UploadStreamingResponse(StreamingResponse):
+    # The generator still reads the request body, so the response must not listen for a disconnect on
+    # receive as StreamingResponse does: that listener would take the body messages. A client that goes
+    # away raises ClientDisconnect in the generator instead.
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+async def upload_csv(request: Request):
+    # A CSV is parsed in batches while the request body arrives, an .xlsx sheet is streamed row by row.
+    # ?sheet=, ?header_row= and ?<field>_column= pick what is imported.
+    # The response is NDJSON, one {"stories": [...]} line per batch and a last line saying what was used,
+    # so the stories are never held in memory as a whole. Errors before the first batch keep their status code.
+    info = {}
+    try:
+        batches = iter_upload(request, upload_options(request.query_params), info)
+        first = await anext(batches, None)
+    except UploadError as e:
+        return JSONResponse({'error': str(e)}, status_code=e.status_code)
+
+    async def lines():
+        try:
+            if first is not None:
+                yield json.dumps({"stories": first}) + "\n"
+                async for batch in batches:
+                    yield json.dumps({"stories": batch}) + "\n"
+            yield json.dumps({"done": True, **info}) + "\n"
+        except UploadError as e:
+            yield json.dumps({"error": str(e), "status_code": e.status_code}) + "\n"
+        finally:
+            await batches.aclose()
+    return UploadStreamingResponse(lines(), media_type="application/x-ndjson")
+
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(current_dir, 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-app = Starlette(debug=True, middleware=[
+app = Starlette(debug=True, on_startup=[delete_expired_sessions], on_shutdown=[close_jobs, close_clients, close_session_store, close_pdf_pool], middleware=[
     Middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 ], routes=[
     Route('/api/generate-user-stories', generate_user_stories, methods=['POST']),
-    # Route('/api/generate-user-stories-by-files', generate_user_stories_by_files, methods=['POST']),
+    Route('/api/generate-user-stories-by-files', generate_user_stories_by_files, methods=['POST']),
     Route('/api/upload-csv', upload_csv, methods=['POST']),
     Route('/api/check-user-stories-quality', check_user_stories_quality, methods=['POST']),
+    Route('/api/find-duplicates', find_duplicates, methods=['POST']),
+    Route('/api/cache-stats', get_cache_stats, methods=['GET']),
+    Route('/api/key-stats', get_key_stats, methods=['GET']),
+    Route('/api/resilience-stats', get_resilience_stats, methods=['GET']),
+    Route('/api/jobs', get_job_stats, methods=['GET']),
+    Route('/api/jobs/{job_id}', get_job_status, methods=['GET']),
     WebSocketRoute("/api/ws-chat", websocket_endpoint),
     Mount('/', StaticFiles(directory='dist', html=True), name='static')
 ])
@@ -0,0 +1,89 @@
+# chunking.py
+
+import os
+import logging
+
+from token_budget import estimate_tokens, prompt_budget, summarize_turns, fit_prompt_to_budget
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for the story list of one technique prompt. Smaller models get less: whatever their prompt budget
+# leaves next to the rest of the prompt (see story_token_budget).
+STORY_CHUNK_TOKENS = int(os.getenv("STORY_CHUNK_TOKENS", "6000"))
+# Every story produces several output lines, so chunks are also capped by count to keep completions short
+MAX_STORIES_PER_CHUNK = int(os.getenv("MAX_STORIES_PER_CHUNK", "60"))
+
+
+def story_tokens(story, model=None):
+    return estimate_tokens(
+        f"- Story ID {story['key']}: '{story['user_story']}' (Epic: '{story['epic']}') - {story.get('description', '')}",
+        model,
+    )
+
+
+def story_token_budget(model, build_prompt, turns=()):
+    # Tokens left for the stories of one prompt: the model's prompt budget minus the prompt without any stories.
+    # A discussion that takes more than half of the budget is counted as fit_prompt_to_budget would summarize it.
+    budget = prompt_budget(model)
+    turns = list(turns)
+    fixed_tokens = estimate_tokens(build_prompt([], turns), model)
+    if turns and fixed_tokens > budget // 2:
+        fixed_tokens = estimate_tokens(build_prompt([], summarize_turns(turns, model)), model)
+    # A quarter of the budget at least, prompts that are still too long are compacted further
+    return min(STORY_CHUNK_TOKENS, max(budget - fixed_tokens, budget // 4))
+
+
+def chunk_stories(stories, token_budget=STORY_CHUNK_TOKENS, max_stories=MAX_STORIES_PER_CHUNK, model=None):
+    chunks = []
+    current = []
+    used_tokens = 0
+    for story in stories:
+        tokens = story_tokens(story, model)
+        if current and (used_tokens + tokens > token_budget or len(current) >= max_stories):
+            chunks.append(current)
+            current = []
+            used_tokens = 0
+        current.append(story)
+        used_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def budgeted_prompts(step, model, build_prompt, stories, turns=()):
+    # The prompt for all stories when it fits the model's budget after compaction, otherwise one prompt per chunk.
+    # The agent discussion prompts don't limit the stories per chunk, only their tokens.
+    prompt, report = fit_prompt_to_budget(step, model, build_prompt, stories, turns)
+    if report["tokens"] <= report["budget"] or len(stories) < 2:
+        return [prompt]
+    chunks = chunk_stories(stories, story_token_budget(model, build_prompt, turns), len(stories), model)
+    logger.info(f"{step} prompt split into {len(chunks)} parts to fit {model}")
+    return [
+        fit_prompt_to_budget(f"{step} part {index + 1}/{len(chunks)}", model, build_prompt, chunk, turns)[0]
+        for index, chunk in enumerate(chunks)
+    ]
+
+
+def merge_chunk_results(chunk_results):
+    # WSJF, MoSCoW, Kano and AHP give absolute scores or categories, so chunks are simply concatenated
+    merged = []
+    for _, parsed in chunk_results:
+        merged.extend(parsed)
+    return merged
+
+
+def merge_dollar_distributions(chunk_results, total_stories):
+    # Every chunk spent its own 100 dollars on IDs numbered from 1. Map them back to the backlog
+    # (key + 1, as enrich_stories_with_dollar_distribution expects) and weight each chunk by its
+    # share of the backlog so the merged distribution still adds up to 100.
+    merged = []
+    for chunk, distribution in chunk_results:
+        share = len(chunk) / total_stories if total_stories else 0
+        for dist in distribution:
+            local_index = dist['story_id'] - 1
+            if 0 <= local_index < len(chunk):
+                merged.append({
+                    'story_id': chunk[local_index]['key'] + 1,
+                    'dollars': round(dist['dollars'] * share, 2)
+                })
+    return merged
@@ -0,0 +1,61 @@
+# comparison.py
+
+import logging
+from itertools import combinations
+
+import numpy as np
+
+from enrichment import TECHNIQUE_ENRICHMENT
+from scoring import average_ranks, spearman_matrix, kendall_w, rank_order
+
+logger = logging.getLogger(__name__)
+
+STORY_COLUMNS = ('key', 'epic', 'user_story', 'description')
+
+
+def combine_rankings(stories, results):
+    # results: [(label, technique, enriched stories), ...] of one multi-technique run.
+    # Returns one row per story with the rank and outcome of every technique, ordered by mean rank,
+    # and how far the techniques agree on the order.
+    ranks = np.zeros((len(stories), len(results)))
+    values = []
+    for j, (label, technique, enriched) in enumerate(results):
+        spec = TECHNIQUE_ENRICHMENT[technique]
+        by_key = {story['key']: story for story in enriched}
+        scored = [by_key.get(story['key']) for story in stories]
+        ranks[:, j] = average_ranks([spec["score"](story) if story else float('-inf') for story in scored])
+        values.append([story.get(spec["value"]) if story else None for story in scored])
+
+    mean_ranks = ranks.mean(axis=1) if results else np.zeros(len(stories))
+    rows = []
+    for i in rank_order(mean_ranks, descending=False).tolist():
+        row = {column: stories[i].get(column) for column in STORY_COLUMNS}
+        for j, (label, _, _) in enumerate(results):
+            row[f"{label}_rank"] = float(ranks[i, j])
+            row[f"{label}_value"] = values[j][i]
+        row["mean_rank"] = round(float(mean_ranks[i]), 2)
+        rows.append(row)
+    return rows, rank_agreement([label for label, _, _ in results], ranks)
+
+
+def rank_agreement(labels, ranks):
+    rho = spearman_matrix(ranks) if len(labels) > 1 else np.ones((1, 1))
+    pairs = []
+    for a, b in combinations(range(len(labels)), 2):
+        value = rho[a, b]
+        pairs.append({"techniques": [labels[a], labels[b]], "spearman": None if np.isnan(value) else round(float(value), 3)})
+    return {"techniques": labels, "kendall_w": round(kendall_w(ranks), 3), "pairs": pairs}
+
+
+def describe_agreement(agreement):
+    w = agreement["kendall_w"]
+    strength = "strong" if w >= 0.7 else "moderate" if w >= 0.4 else "weak"
+    lines = [f"Rank agreement across {', '.join(agreement['techniques'])}: Kendall's W = {w} ({strength})."]
+    pairs = [pair for pair in agreement["pairs"] if pair["spearman"] is not None]
+    if pairs:
+        closest = max(pairs, key=lambda pair: pair["spearman"])
+        furthest = min(pairs, key=lambda pair: pair["spearman"])
+        lines.append(f"Closest: {' and '.join(closest['techniques'])} (Spearman {closest['spearman']}).")
+        if furthest is not closest:
+            lines.append(f"Furthest apart: {' and '.join(furthest['techniques'])} (Spearman {furthest['spearman']}).")
+    return " ".join(lines)
@@ -0,0 +1,137 @@
+# dedup.py
+
+import os
+import re
+import zlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# What happens to near-duplicate stories before a run: "off", "suggest" (reported only) or "merge"
+DEDUP_MODE = os.getenv("DEDUP_MODE", "suggest")
+# Estimated Jaccard similarity of the word shingles above which two stories count as duplicates
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.7"))
+DEDUP_MODES = ("off", "suggest", "merge")
+
+# MinHash signature of 128 hashes, split into 32 LSH bands of 4. Two stories share a band bucket with
+# probability 1 - (1 - J^4)^32, about 0.94 at J = 0.5 and 0.996 at J = 0.7, so candidates are rarely missed,
+# and every candidate is checked against the threshold on the full signature.
+NUM_HASHES = 128
+BANDS = 32
+ROWS = NUM_HASHES // BANDS
+# Buckets this large (e.g. stories that are mostly boilerplate) are checked against their first story only,
+# which keeps a degenerate backlog from turning into an all-pairs comparison
+MAX_BUCKET_PAIRS = 64
+
+# Hashes (a * x + b) mod p, p has to be smaller than a * x for the products to wrap and permute the shingles
+_PRIME = np.uint64((1 << 31) - 1)
+_rng = np.random.default_rng(20240717)  # fixed, signatures must agree across runs and workers
+_A = _rng.integers(1, (1 << 31) - 1, size=NUM_HASHES, dtype=np.uint64)
+_B = _rng.integers(0, (1 << 31) - 1, size=NUM_HASHES, dtype=np.uint64)
+_EMPTY = np.full(NUM_HASHES, np.iinfo(np.uint64).max, dtype=np.uint64)
+
+
+def story_shingles(story):
+    # Word pairs of user_story + description, single words for very short stories
+    words = re.findall(r"\w+", f"{story.get('user_story', '')} {story.get('description', '')}".lower())
+    if len(words) < 2:
+        return set(words)
+    return {f"{a} {b}" for a, b in zip(words, words[1:])}
+
+
+def minhash_signatures(stories):
+    # (stories, NUM_HASHES) matrix. crc32 rather than hash(), which is salted per process.
+    signatures = np.empty((len(stories), NUM_HASHES), dtype=np.uint64)
+    for i, story in enumerate(stories):
+        shingles = story_shingles(story)
+        if not shingles:
+            signatures[i] = _EMPTY
+            continue
+        x = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles)) % _PRIME
+        # a * x + b stays below 2^62 for a, b and x under 2^31
+        signatures[i] = ((_A[:, None] * x[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+    return signatures
+
+
+def candidate_pairs(signatures):
+    # Pairs of stories that share at least one LSH band, without comparing all pairs
+    pairs = set()
+    for band in range(BANDS):
+        buckets = {}
+        for i, row in enumerate(signatures[:, band * ROWS:(band + 1) * ROWS]):
+            buckets.setdefault(row.tobytes(), []).append(i)
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            if len(members) > MAX_BUCKET_PAIRS:
+                pairs.update((members[0], other) for other in members[1:])
+            else:
+                pairs.update((a, b) for index, a in enumerate(members) for b in members[index + 1:])
+    return pairs
+
+
+def find_duplicate_clusters(stories, threshold=DEDUP_THRESHOLD):
+    # Groups of story indexes (in backlog order, two or more each) whose stories are near-duplicates
+    if len(stories) < 2:
+        return []
+    signatures = minhash_signatures(stories)
+    pairs = np.array(sorted(candidate_pairs(signatures)), dtype=np.int64).reshape(-1, 2)
+    similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1) if len(pairs) else np.zeros(0)
+    empty = (signatures == _EMPTY).all(axis=1)
+
+    # Union-find over the pairs above the threshold, stories without any words are never duplicates
+    parent = list(range(len(stories)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for (a, b), value in zip(pairs.tolist(), similarity.tolist()):
+        if value >= threshold and not empty[a] and not empty[b]:
+            parent[max(root(a), root(b))] = min(root(a), root(b))
+
+    clusters = {}
+    for i in range(len(stories)):
+        clusters.setdefault(root(i), []).append(i)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def merge_duplicates(stories, clusters):
+    # The first story of a cluster stays and lists the keys it absorbed, the others are dropped.
+    # Keys are kept as they are, so results still join on them.
+    dropped = set()
+    merged = {}
+    for members in clusters:
+        keep, *others = members
+        merged[keep] = {**stories[keep], "merged_keys": [stories[i]['key'] for i in others]}
+        dropped.update(others)
+    return [merged.get(i, story) for i, story in enumerate(stories) if i not in dropped]
+
+
+def describe_clusters(stories, clusters, merged):
+    lines = [
+        f"{'Merged' if merged else 'Possible duplicates'}: story {stories[members[0]]['key']} "
+        f"with {', '.join(str(stories[i]['key']) for i in members[1:])}"
+        for members in clusters
+    ]
+    count = sum(len(members) - 1 for members in clusters)
+    summary = f"{count} near-duplicate {'story' if count == 1 else 'stories'} {'merged' if merged else 'found'} in {len(clusters)} group(s)."
+    return " ".join([summary] + lines)
+
+
+def dedupe_backlog(stories, mode=DEDUP_MODE, threshold=DEDUP_THRESHOLD):
+    # Returns the stories to run with and the clusters found, as lists of story indexes
+    if mode not in DEDUP_MODES:
+        raise ValueError(f"Unsupported dedup mode: {mode}")
+    if mode == "off":
+        return stories, []
+    clusters = find_duplicate_clusters(stories, threshold)
+    if clusters:
+        logger.info(f"{sum(len(members) - 1 for members in clusters)} near-duplicate stories in {len(clusters)} clusters ({mode})")
+    if mode == "merge" and clusters:
+        return merge_duplicates(stories, clusters), clusters
+    return stories, clusters
@@ -0,0 +1,141 @@
+# enrichment.py
+
+import logging
+
+from scoring import WSJF_CRITERIA, AHP_CRITERIA, factor_matrix, wsjf_scores, ahp_scores, rank_order
+
+logger = logging.getLogger(__name__)
+
+MOSCOW_CATEGORIES = ['Must Have', 'Should Have', 'Could Have', "Won't Have"]
+KANO_CATEGORIES = ['Basic Needs', 'Performance Needs', 'Excitement Needs', 'Indifferent', 'Reverse']
+
+# Rank tables for the category sorts, anything else (e.g. "No Category") goes last
+MOSCOW_RANK = {category: rank for rank, category in enumerate(MOSCOW_CATEGORIES)}
+KANO_RANK = {category: rank for rank, category in enumerate(KANO_CATEGORIES)}
+
+
+def index_results(results, id_field):
+    # First result per ID wins, like the linear scans this replaces
+    index = {}
+    for item in results:
+        index.setdefault(item[id_field], item)
+    return index
+
+
+def ahp_fields(story, result):
+    if result is None:
+        return {"BV": 0, "ER": 0, "D": 0, "priority": float('inf')}
+    # The model's copy of the title is not used, the story keeps its own
+    return {field: value for field, value in result.items() if field != "user_story"}
+
+
+def ahp_pairwise_fields(story, result):
+    return {"W": result["W"], "OS": result["OS"]} if result else {"W": 0, "OS": 0}
+
+
+def wsjf_fields(story, result):
+    if result is None:
+        return {'wsjf_factors': {'BV': 0, 'TC': 0, 'RR/OE': 0, 'JS': 0}, 'bv': 0, 'tc': 0, 'oe': 0, 'js': 0}
+    factors = result['wsjf_factors']
+    return {'wsjf_factors': factors, 'bv': factors['BV'], 'tc': factors['TC'], 'oe': factors['RR/OE'], 'js': factors['JS']}
+
+
+def moscow_fields(story, result):
+    return {'moscow_category': result['category'] if result else "No Category"}
+
+
+def kano_fields(story, result):
+    return {'kano_category': result['category'] if result else "No Category"}
+
+
+def dollar_fields(story, result):
+    return {'dollar_allocation': result['dollars'] if result else 0}
+
+
+# Scores are computed for all stories at once from their factor matrix, the LLM only supplies the factors
+
+def score_ahp(enriched):
+    weights = ahp_scores(factor_matrix(enriched, AHP_CRITERIA))
+    for story, weight in zip(enriched, weights.tolist()):
+        story['W'] = round(weight, 2)
+        story['OS'] = round(weight, 2)
+    return rank_order(weights)
+
+
+def score_wsjf(enriched):
+    scores = wsjf_scores(factor_matrix(enriched, WSJF_CRITERIA, source='wsjf_factors'))
+    for story, score in zip(enriched, scores.tolist()):
+        story['wsjf_score'] = score
+    return rank_order(scores)
+
+
+def rank_dollars(enriched):
+    return rank_order([story['dollar_allocation'] for story in enriched])
+
+
+def rank_categories(field, ranks):
+    # Anything outside the rank table (e.g. "No Category") goes last
+    return lambda enriched: rank_order([ranks.get(story[field], len(ranks)) for story in enriched], descending=False)
+
+
+# Per technique: ID field of a parsed result, the story's ID in those results, the fields it adds,
+# a function that scores the joined stories and returns their order, and the field that holds the
+# technique's outcome with a higher-is-better score of it for comparing techniques
+TECHNIQUE_ENRICHMENT = {
+    "AHP": {
+        "result_id": "ID", "story_id": lambda story: story['key'], "fields": ahp_fields, "order": score_ahp,
+        "value": "OS", "score": lambda story: story['OS'],
+    },
+    # Priorities from pairwise judgments are already computed, they are only joined and ranked
+    "AHP_PAIRWISE": {
+        "result_id": "ID", "story_id": lambda story: story['key'], "fields": ahp_pairwise_fields,
+        "order": lambda enriched: rank_order([story['OS'] for story in enriched]),
+        "value": "OS", "score": lambda story: story['OS'],
+    },
+    "WSJF": {
+        "result_id": "story_id", "story_id": lambda story: story['key'], "fields": wsjf_fields, "order": score_wsjf,
+        "value": "wsjf_score", "score": lambda story: story['wsjf_score'],
+    },
+    "MOSCOW": {
+        "result_id": "story_id", "story_id": lambda story: story['key'], "fields": moscow_fields,
+        "order": rank_categories('moscow_category', MOSCOW_RANK),
+        "value": "moscow_category", "score": lambda story: -MOSCOW_RANK.get(story['moscow_category'], len(MOSCOW_RANK)),
+    },
+    "KANO": {
+        "result_id": "story_id", "story_id": lambda story: story['key'], "fields": kano_fields,
+        "order": rank_categories('kano_category', KANO_RANK),
+        "value": "kano_category", "score": lambda story: -KANO_RANK.get(story['kano_category'], len(KANO_RANK)),
+    },
+    # The 100 dollar prompts number stories from 1, merge_dollar_distributions maps them to key + 1
+    "100_DOLLAR": {
+        "result_id": "story_id", "story_id": lambda story: story['key'] + 1, "fields": dollar_fields,
+        "order": rank_dollars,
+        "value": "dollar_allocation", "score": lambda story: story['dollar_allocation'],
+    },
+}
+
+
+def enrich_stories(technique, stories, results):
+    # One hash join of the parsed results onto the stories, then a stable ranking on the technique's scores.
+    # Returns new story dicts, the caller's stories are left as they were.
+    spec = TECHNIQUE_ENRICHMENT[technique]
+    by_id = index_results(results, spec["result_id"])
+
+    enriched = []
+    missing = []
+    for story in stories:
+        story_id = spec["story_id"](story)
+        result = by_id.get(story_id)
+        if result is None:
+            missing.append(story_id)
+        enriched.append({**story, **spec["fields"](story, result)})
+
+    if missing:
+        logger.warning(f"{technique}: no result for story ID(s) {missing}")
+    return [enriched[i] for i in spec["order"](enriched)] if enriched else enriched
+
+
+def rank_stories(technique, enriched):
+    # Ranks already enriched stories again, e.g. after merging results from separate runs
+    enriched = [dict(story) for story in enriched]
+    return [enriched[i] for i in TECHNIQUE_ENRICHMENT[technique]["order"](enriched)] if enriched else enriched
@@ -1,30 +1,38 @@
 # helpers.py
 
-import io
 import re
 import random
 import logging
 import os
-import csv
-import requests
-from starlette.datastructures import UploadFile
 import httpx
 from httpx import Timeout, AsyncClient
 import asyncio
 from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
-import pdfplumber
 
 from agent import OPENAI_URL
-LLAMA_URL="https://api.groq.com/openai/v1/chat/completions"
+from llm_client import LLAMA_URL, LLMError, provider_for_model
+from resilience import post_with_retries, stream_with_retries
+from llm_cache import cache_key, should_use_cache, get_cached_completion, store_completion
+from chunking import chunk_stories, story_token_budget, merge_chunk_results
+from enrichment import enrich_stories
+from token_budget import estimate_tokens, fit_prompt_to_budget
+from structured_output import (
+    JSONItemStream, TECHNIQUES, PairJudgment, PairJudgmentResponse, structured_output_enabled, response_format_for,
+    json_response_format, structured_instructions, validate_items, parse_structured_response,
+    render_structured_response, extract_summary
+)
+from scoring import comparison_pairs, incomplete_pairwise_weights, judgment_components
 
 # from app import send_to_llm
 
-# Load environment variables from .env file
-api_keys = [os.getenv(f"API-KEY{i}") for i in range(1, 4)]
-llama_keys = [os.getenv(f"LLAMA-key{i}") for i in range(1, 3)]
+# Ask again for the stories a technique response left out, instead of filling them with zeros
+LLM_REPAIR_MISSING = os.getenv("LLM_REPAIR_MISSING", "1") == "1"
+
+# "pairwise" runs AHP on pairwise story judgments, "scores" asks for BV/ER/D scores per story
+AHP_METHOD = os.getenv("AHP_METHOD", "pairwise")
+AHP_PAIRS_PER_REQUEST = int(os.getenv("AHP_PAIRS_PER_REQUEST", "40"))
 
-print("API Keys: in ", api_keys)
-print("GROQ keys : in ", llama_keys)
+# API keys are picked per request by key_scheduler, from the API-KEYn / LLAMA-keyn variables in the .env file
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -33,17 +41,49 @@ logger = logging.getLogger(__name__)
 def get_random_temperature(low=0.1, high=0.7):
     return random.uniform(low, high)
 
+# Prompt assembly
+
+def format_discussion(response):
+    # Prior agent turns arrive as complete strings. '\n'.join() on a string would put a newline
+    # between every character and double the prompt size, so only lists of turns are joined.
+    if not response:
+        return ""
+    if isinstance(response, str):
+        return response
+    return '\n'.join(response)
+
+def format_client_feedback(client_feedback):
+    # The UI sends the feedback as one free-text string, other clients as a list of lines
+    if not client_feedback:
+        return []
+    if isinstance(client_feedback, str):
+        return [line.strip() for line in client_feedback.splitlines() if line.strip()]
+    return [fb for fb in client_feedback if fb]
+
+def count_prompt_tokens(step, prompt):
+    tokens = estimate_tokens(prompt)
+    logger.info(f"{step} prompt: ~{tokens} tokens ({len(prompt)} characters)")
+    return tokens
+
 async def estimate_ahp(data, websocket, model, topic_response, context_response):
+    if AHP_METHOD == "pairwise":
+        return await estimate_ahp_pairwise(data, websocket, model, topic_response, context_response)
+    return await estimate_ahp_scores(data, websocket, model, topic_response, context_response)
+
+
+async def estimate_ahp_scores(data, websocket, model, topic_response, context_response):
+    # AHP over the BV/ER/D criteria, the agents score every story
     headers = {
-        "Authorization": f"Bearer {random.choice(api_keys)}",
         "Content-Type": "application/json"
     }
     
-    prioritize_prompt = construct_ahp_prompt(data, topic_response, context_response)
-    estimated_factors = await send_to_llm(prioritize_prompt, headers, model)
-    await stream_response_word_by_word(websocket, estimated_factors, "Final Prioritization")
-    
-    prioritized_stories = parse_prioritized_stories(estimated_factors)
+    chunk_results = await score_stories_in_chunks(
+        data['stories'], websocket, model, headers,
+        lambda chunk, turns: construct_ahp_prompt({"stories": chunk}, *turns),
+        parse_prioritized_stories, "AHP", (topic_response, context_response)
+    )
+    prioritized_stories = merge_chunk_results(chunk_results)
+    prioritized_stories.sort(key=lambda x: x["OS"], reverse=True)
     logger.info(f"Prioritized Stories:\n{prioritized_stories}")
     
     enriched_stories = enrich_original_stories_with_ahp(data['stories'], prioritized_stories)
@@ -85,12 +125,11 @@ def construct_ahp_prompt(data, topic_response, context_response):
         for story in data['stories']
     ])
 
-    topic_response_direct = '\n'.join(topic_response)
-    context_response_direct = '\n'.join(context_response)
+    topic_response_direct = format_discussion(topic_response)
+    context_response_direct = format_discussion(context_response)
 
-    print(stories_formatted)
-    print(topic_response_direct)
-    print(context_response_direct)
+    logger.debug(f"AHP prompt stories:\n{stories_formatted}")
+    logger.debug(f"AHP prompt discussion:\n{topic_response_direct}\n{context_response_direct}")
     
     prompt = (
         "You are a helpful assistant. Using the Analytic Hierarchy Process (AHP), prioritize the following user stories based on their relative importance.\n\n"
@@ -116,31 +155,176 @@ def construct_ahp_prompt(data, topic_response, context_response):
         "For each story, provide a detailed explanation of why it received the allocated values. What is the main reason behind its prioritization? Make sure to include a complete explanation for every story."
     )
     
+    count_prompt_tokens("AHP", prompt)
     return prompt
 
 
-async def send_to_llm(prompt, headers, model, timeout=100):
-    if model.startswith("llama3") or model == "mixtral-8x7b-32768":
-        url = LLAMA_URL
-        headers["Authorization"] = f"Bearer {random.choice(llama_keys)}"
-    else:
-        url = OPENAI_URL
-        headers["Authorization"] = f"Bearer {random.choice(api_keys)}"
-    
+def construct_llm_post_data(prompt, model, response_format=None):
     post_data = {
         "model": model,
         "messages": [{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": prompt}],
         "temperature": 0.7
     }
-    
-    response = requests.post(url, json=post_data, headers=headers, timeout=timeout)
+    if response_format:
+        post_data["response_format"] = response_format
+    return post_data
+
+async def send_to_llm(prompt, headers, model, timeout=100, use_cache=None, response_format=None):
+    post_data = construct_llm_post_data(prompt, model, response_format)
+
+    caching = should_use_cache(use_cache)
+    if caching:
+        key = cache_key(model, post_data["messages"], post_data["temperature"])
+        cached_completion = await get_cached_completion(key)
+        if cached_completion is not None:
+            return cached_completion
+
+    response = await post_with_retries(model, post_data, headers, timeout=timeout)
     
     if response.status_code == 200:
         completion = response.json()
         completion_text = completion['choices'][0]['message']['content']
+        if caching:
+            await store_completion(key, completion_text)
         return completion_text
     else:
-        raise Exception("Failed to process the request with OpenAI")
+        raise LLMError("Failed to process the request with OpenAI", response.status_code)
+
+async def stream_llm_to_websocket(prompt, headers, model, websocket, agent_type, timeout=100, use_cache=None, technique=None):
+    # Forwards every token delta to the client as it arrives and returns the full completion.
+    # With a structured technique the completion is JSON, so each story is sent rendered once its object is complete.
+    response_format = response_format_for(technique, model) if technique else None
+    post_data = construct_llm_post_data(prompt, model, response_format)
+
+    caching = should_use_cache(use_cache)
+    if caching:
+        key = cache_key(model, post_data["messages"], post_data["temperature"])
+        cached_completion = await get_cached_completion(key)
+        if cached_completion is not None:
+            shown = render_structured_response(technique, cached_completion) if technique else cached_completion
+            await send_stream_frame(websocket, agent_type, shown, "delta")
+            await send_stream_frame(websocket, agent_type, "", "end")
+            return cached_completion
+
+    chunks = []
+    item_stream = JSONItemStream() if technique else None
+    rendered_items = 0
+    async for delta in stream_with_retries(model, post_data, headers, timeout=timeout):
+        chunks.append(delta)
+        if item_stream is None:
+            await send_stream_frame(websocket, agent_type, delta, "delta")
+            continue
+        for item in validate_items(technique, item_stream.feed(delta)):
+            rendered_items += 1
+            await send_stream_frame(websocket, agent_type, TECHNIQUES[technique]["render"](item), "delta")
+
+    completion_text = ''.join(chunks)
+    if item_stream is not None:
+        # The summary comes after the stories, and a model that ignored the JSON instructions is shown as is
+        tail = extract_summary(completion_text) if rendered_items else completion_text
+        if tail:
+            await send_stream_frame(websocket, agent_type, tail, "delta")
+    await send_stream_frame(websocket, agent_type, "", "end")
+
+    if caching:
+        await store_completion(key, completion_text)
+    return completion_text
+
+async def send_scoring_request(prompt, headers, model, websocket, technique=None):
+    # Sent as one complete chat message, for requests that run concurrently with others of the same step
+    response_format = response_format_for(technique, model) if technique else None
+    completion = await send_to_llm(prompt, dict(headers), model, response_format=response_format)
+    shown = render_structured_response(technique, completion) if technique else completion
+    await stream_response_word_by_word(websocket, shown, "Final Prioritization")
+    return completion
+
+async def score_stories_in_chunks(stories, websocket, model, headers, build_prompt, parse_response, step, turns=()):
+    # Map step of the chunked prioritization: one prompt per token-budgeted chunk, all chunks scored concurrently.
+    # build_prompt(chunk, turns) is compacted by fit_prompt_to_budget when it would overflow the model's budget.
+    # Returns (chunk, parsed_response) pairs so the caller can merge and normalize them.
+    technique = step if structured_output_enabled(step) else None
+    if technique:
+        # JSON output validated against the technique's schema, the regex parser stays as the fallback
+        text_prompt, text_parser = build_prompt, parse_response
+        build_prompt = lambda chunk, turns: text_prompt(chunk, turns) + structured_instructions(technique)
+        parse_response = lambda completion: parse_structured_response(technique, completion, fallback=text_parser)
+
+    async def repair(chunk, parsed):
+        return await repair_missing_stories(chunk, parsed, websocket, model, headers, build_prompt, parse_response, step, turns, technique)
+
+    chunks = chunk_stories(stories, story_token_budget(model, build_prompt, turns), model=model)
+    if len(chunks) == 1:
+        prompt, _ = fit_prompt_to_budget(step, model, build_prompt, stories, turns)
+        completion = await stream_llm_to_websocket(prompt, headers, model, websocket, "Final Prioritization", technique=technique)
+        return await repair(stories, parse_response(completion))
+
+    logger.info(f"Scoring {len(stories)} stories in {len(chunks)} chunks")
+
+    async def score_chunk(index, chunk):
+        # Chunks finish in any order, so each one is sent as a complete message instead of interleaved deltas
+        prompt, _ = fit_prompt_to_budget(f"{step} chunk {index + 1}/{len(chunks)}", model, build_prompt, chunk, turns)
+        completion = await send_scoring_request(prompt, headers, model, websocket, technique)
+        return await repair(chunk, parse_response(completion))
+
+    chunk_results = await asyncio.gather(*(score_chunk(index, chunk) for index, chunk in enumerate(chunks)))
+    return [pair for pairs in chunk_results for pair in pairs]
+
+# Repair of incomplete responses
+
+def expected_story_ids(step, stories):
+    # The 100 dollar prompts number the stories by position, the technique prompts use the story key
+    if step == "100 dollar":
+        return list(range(1, len(stories) + 1))
+    return [story['key'] for story in stories]
+
+def parsed_story_id(step, item):
+    return item["ID"] if step == "AHP" else item["story_id"]
+
+def validate_response(step, parsed, stories):
+    validators = {
+        "AHP": validate_ahp_response,
+        "WSJF": validate_wsjf_response,
+        "MoSCoW": validate_moscow_response,
+        "Kano": validate_kano_response,
+        "100 dollar": validate_dollar_distribution,
+    }
+    return validators[step](parsed, stories)
+
+async def repair_missing_stories(chunk, parsed, websocket, model, headers, build_prompt, parse_response, step, turns=(), technique=None):
+    # Stories left out of a response are asked for again in one small follow-up request instead of re-running
+    # the whole chunk. Returns (stories, parsed_response) pairs like score_stories_in_chunks.
+    if not LLM_REPAIR_MISSING or not parsed or validate_response(step, parsed, chunk):
+        return [(chunk, parsed)]
+
+    expected = expected_story_ids(step, chunk)
+    answered = {parsed_story_id(step, item) for item in parsed}
+    missing_positions = [i for i, story_id in enumerate(expected) if story_id not in answered]
+    if not missing_positions:
+        return [(chunk, parsed)]
+
+    missing = [chunk[i] for i in missing_positions]
+    logger.warning(f"{step}: {len(missing)} of {len(chunk)} stories missing from the response, requesting only those")
+    prompt, _ = fit_prompt_to_budget(f"{step} repair", model, build_prompt, missing, turns)
+    try:
+        completion = await send_scoring_request(prompt, headers, model, websocket, technique)
+    except Exception as e:
+        logger.error(f"{step} repair request failed: {str(e)}")
+        return [(chunk, parsed)]
+
+    missing_ids = set(expected_story_ids(step, missing))
+    repaired = [item for item in parse_response(completion) if parsed_story_id(step, item) in missing_ids]
+    logger.info(f"{step} repair returned {len(repaired)} of {len(missing)} missing stories")
+
+    if step == "100 dollar":
+        # Both requests spent their own 100 dollars over positions numbered from 1, so they are kept as
+        # two chunks and merge_dollar_distributions weights each one by its share of the stories
+        missing_set = set(missing_positions)
+        present_positions = [i for i in range(len(chunk)) if i not in missing_set]
+        renumbered = {expected[i]: position for position, i in enumerate(present_positions, start=1)}
+        present = [chunk[i] for i in present_positions]
+        present_parsed = [{**item, 'story_id': renumbered[item['story_id']]} for item in parsed if item['story_id'] in renumbered]
+        return [(present, present_parsed), (missing, repaired)]
+    return [(chunk, parsed + repaired)]
 
 def parse_prioritized_stories(completion_text):
     pattern = re.compile(
@@ -170,26 +354,135 @@ def parse_prioritized_stories(completion_text):
     prioritized_stories.sort(key=lambda x: x["OS"], reverse=True)
     return prioritized_stories
 
+def validate_ahp_response(prioritized_stories, stories):
+    story_ids = {story['key'] for story in stories}
+    response_story_ids = {story['ID'] for story in prioritized_stories}
+
+    return story_ids == response_story_ids
+
 def enrich_original_stories_with_ahp(original_stories, prioritized_stories):
-    for story in original_stories:
-        story_id = story['key']
-        priority_data = next((item for item in prioritized_stories if item["ID"] == story_id), None)
-        if priority_data:
-            story.update(priority_data)
-        else:
-            story.update({
-                "BV": 0,
-                "ER": 0,
-                "D": 0,
-                "W": 0,
-                "OS": 0,
-                "priority": float('inf')
-            })
-            logger.warning(f"Story ID {story_id} not found in prioritized stories")
-
-    enriched_stories = sorted(original_stories, key=lambda x: x.get('OS', 0), reverse=True)
+    return enrich_stories("AHP", original_stories, prioritized_stories)
+
+async def estimate_ahp_pairwise(data, websocket, model, topic_response, context_response):
+    # AHP on the stories themselves: the agents judge a sparse set of story pairs (about n log n, see
+    # scoring.comparison_pairs) in concurrent batches, and the priorities are the principal eigenvector
+    # of the incomplete comparison matrix, computed locally
+    headers = {
+        "Content-Type": "application/json"
+    }
+
+    stories = data['stories']
+    pairs = comparison_pairs(len(stories))
+    logger.info(f"AHP: {len(pairs)} pairwise comparisons for {len(stories)} stories in {-(-len(pairs) // AHP_PAIRS_PER_REQUEST)} requests")
+    response_format = json_response_format(model, "AHP pairwise", PairJudgmentResponse)
+
+    async def judge_batch(index, batch, batch_count):
+        numbered = dict(enumerate(batch, start=1))
+        numbered_keys = [(number, stories[i]['key'], stories[j]['key']) for number, (i, j) in numbered.items()]
+        batch_stories = [stories[i] for i in sorted({i for pair in batch for i in pair})]
+        prompt, _ = fit_prompt_to_budget(
+            f"AHP pairs {index + 1}/{batch_count}", model,
+            lambda prompt_stories, turns: construct_ahp_pairwise_prompt(prompt_stories, numbered_keys, *turns),
+            batch_stories, (topic_response, context_response)
+        )
+        completion = await send_to_llm(prompt, dict(headers), model, response_format=response_format)
+        return parse_ahp_judgments(completion, numbered, stories)
+
+    async def judge_pairs(pairs_to_judge):
+        batches = [pairs_to_judge[i:i + AHP_PAIRS_PER_REQUEST] for i in range(0, len(pairs_to_judge), AHP_PAIRS_PER_REQUEST)]
+
+        async def judge_or_skip(index, batch):
+            # A failed batch leaves its pairs unjudged, they are asked for again below
+            try:
+                return await judge_batch(index, batch, len(batches))
+            except Exception as e:
+                logger.error(f"AHP pairs batch {index + 1}/{len(batches)} failed: {e}")
+                return []
+
+        batch_judgments = await asyncio.gather(*(judge_or_skip(index, batch) for index, batch in enumerate(batches)))
+        return [judgment for batch in batch_judgments for judgment in batch]
+
+    judgments = await judge_pairs(pairs)
+    judged = {(min(i, j), max(i, j)) for i, j, _ in judgments}
+    missing = [pair for pair in pairs if pair not in judged]
+    if missing:
+        logger.warning(f"AHP: {len(missing)} of {len(pairs)} pairs were not judged, asking again")
+        judgments += await judge_pairs(missing)
+
+    components = judgment_components(len(stories), judgments)
+    if len(components) > 1:
+        # Weights of stories that were never compared with each other can't be put on one scale
+        logger.warning(f"AHP: the judgments split the backlog into {len(components)} unconnected groups, scoring BV/ER/D instead")
+        await stream_response_word_by_word(
+            websocket,
+            f"Only {len(judgments)} of {len(pairs)} pairwise judgments came back and they don't connect all stories "
+            f"({len(components)} separate groups), so the stories are scored on business value, effort and dependencies instead.",
+            "Final Prioritization"
+        )
+        return await estimate_ahp_scores(data, websocket, model, topic_response, context_response)
+    weights, consistency_ratio = incomplete_pairwise_weights(len(stories), judgments)
+
+    prioritized_stories = [
+        {"ID": story['key'], "W": round(weight, 4), "OS": round(weight * 100, 2)}
+        for story, weight in zip(stories, weights.tolist())
+    ]
+    enriched_stories = enrich_stories("AHP_PAIRWISE", stories, prioritized_stories)
+    logger.info(f"AHP: {len(judgments)}/{len(pairs)} judgments, consistency ratio {consistency_ratio:.3f}")
+
+    summary = (
+        f"AHP priorities from {len(judgments)} pairwise judgments ({len(pairs)} requested, "
+        f"consistency ratio {consistency_ratio:.3f}):\n"
+        + '\n'.join(f"- Story ID {story['key']}: '{story['user_story']}' - {story['OS']}%" for story in enriched_stories)
+    )
+    await stream_response_word_by_word(websocket, summary, "Final Prioritization")
     return enriched_stories
 
+def construct_ahp_pairwise_prompt(stories, numbered_pairs, topic_response, context_response):
+    stories_formatted = '\n'.join([
+        f"- Story ID {story['key']}: '{story['user_story']}' (Epic: '{story['epic']}') - {story['description']}"
+        for story in stories
+    ])
+    pairs_formatted = '\n'.join([
+        f"- Pair {number}: Story ID {first} vs Story ID {second}"
+        for number, first, second in numbered_pairs
+    ])
+
+    topic_response_direct = format_discussion(topic_response)
+    context_response_direct = format_discussion(context_response)
+
+    prompt = (
+        "You are a helpful assistant. Using the Analytic Hierarchy Process (AHP), compare pairs of user stories by their overall priority, "
+        "considering business value, effort required and dependencies.\n\n"
+        f"Here are the stories:\n{stories_formatted}\n\n"
+        "Previously, the following points were discussed regarding prioritization:\n"
+        f"{topic_response_direct}\n\n"
+        "Additionally, here is the context from prior discussions:\n"
+        f"{context_response_direct}\n\n"
+        f"Compare the stories of each pair:\n{pairs_formatted}\n\n"
+        "For every pair, give the Story ID that should be prioritized higher and how strongly, on Saaty's scale: "
+        "1 = equal, 3 = moderately, 5 = strongly, 7 = very strongly, 9 = extremely more important (2, 4, 6 and 8 are in between).\n"
+        "Answer with a single JSON object and nothing else, shaped like:\n"
+        '{"judgments": [{"pair": 1, "preferred": 3, "intensity": 5}]}\n'
+        "Include one judgment for every pair listed above."
+    )
+
+    count_prompt_tokens("AHP pairwise", prompt)
+    return prompt
+
+def parse_ahp_judgments(completion_text, numbered_pairs, stories):
+    # (i, j, intensity) with story i preferred over story j, positions as in comparison_pairs
+    judgments = []
+    for item in validate_items("AHP pairwise", JSONItemStream().feed(completion_text), PairJudgment):
+        pair = numbered_pairs.get(item.pair)
+        if pair is None:
+            continue
+        i, j = pair
+        if str(item.preferred) == str(stories[i]['key']):
+            judgments.append((i, j, item.intensity))
+        elif str(item.preferred) == str(stories[j]['key']):
+            judgments.append((j, i, item.intensity))
+    return judgments
+
 # End of AHP      
 
 
@@ -262,21 +555,24 @@ def construct_context_prompt(stories, technique):
     )
     return prompt
 
-def construct_batch_100_dollar_prompt(data, qa_response, dev_response, po_response, feedback_section):
+def construct_batch_100_dollar_prompt(data, qa_response, dev_response, po_response, client_feedback):
     # Ensure story IDs start from 1
     stories_formatted = '\n'.join([
         f"- Story ID {index + 1}: '{story['user_story']}' {story['epic']} {story['description']}"
         for index, story in enumerate(data['stories'])
     ])
 
-    qa_response_direct = '\n'.join(qa_response)
-    dev_response_direct = '\n'.join(dev_response)
-    po_response_direct = '\n'.join(po_response)
+    qa_response_direct = format_discussion(qa_response)
+    dev_response_direct = format_discussion(dev_response)
+    po_response_direct = format_discussion(po_response)
+
+    feedback_section = ""
+    feedback_lines = format_client_feedback(client_feedback)
+    if feedback_lines:
+        feedback_section = "Take into account the following feedback provided by the client:\n\n" + '\n'.join(['- ' + fb for fb in feedback_lines]) + "\n\n"
 
-    print(stories_formatted)
-    print(qa_response_direct)
-    print(dev_response_direct)
-    print(po_response_direct)
+    logger.debug(f"100 dollar prompt stories:\n{stories_formatted}")
+    logger.debug(f"100 dollar prompt discussion:\n{qa_response_direct}\n{dev_response_direct}\n{po_response_direct}")
     
     # prompt = (
     # "You are the Manager agent, the head of the team responsible for prioritizing user stories by distributing 100 dollars (points) among them. "
@@ -327,6 +623,7 @@ def construct_batch_100_dollar_prompt(data, qa_response, dev_response, po_respon
 )
 
     
+    count_prompt_tokens("100 dollar", prompt)
     return prompt
    
 
@@ -376,25 +673,15 @@ def parse_100_dollar_response(response_text):
     return dollar_distribution
 
 def validate_dollar_distribution(dollar_distribution, stories):
+    # The prompt numbers the stories from 1 by position, not by key
     total_dollars = sum(dist['dollars'] for dist in dollar_distribution)
-    story_ids = {story['key'] for story in stories}
+    story_ids = set(range(1, len(stories) + 1))
     response_story_ids = {dist['story_id'] for dist in dollar_distribution}
     
     return total_dollars == 100 and story_ids == response_story_ids
 
 def enrich_stories_with_dollar_distribution(original_stories, dollar_distribution):
-    dollar_dict = {dist['story_id']: dist['dollars'] for dist in dollar_distribution}
-
-    enriched_stories = []
-    for story in original_stories:
-        story_id = story['key'] + 1 
-        story['dollar_allocation'] = dollar_dict.get(story_id, 0)
-        enriched_stories.append(story)
-
-    # Sort the enriched stories by dollar_allocation in descending order
-    enriched_stories.sort(key=lambda x: x['dollar_allocation'], reverse=True)
-    
-    return enriched_stories
+    return enrich_stories("100_DOLLAR", original_stories, dollar_distribution)
 
 def construct_stories_formatted(stories):
     return '\n'.join([
@@ -403,30 +690,42 @@ def construct_stories_formatted(stories):
     ])
 
 def ensure_unique_keys(stories):
+    # Returns copies with colliding keys replaced. Integer keys get the next unused integer, because
+    # the techniques do arithmetic on them (the 100 dollar IDs are key + 1).
+    used = {story['key'] for story in stories}
+    next_int = max((key for key in used if isinstance(key, int)), default=-1) + 1
     seen = {}
+    unique = []
     for story in stories:
         key = story['key']
         if key in seen:
             seen[key] += 1
-            story['key'] = f"{key}_{seen[key]}"
+            if isinstance(key, int):
+                while next_int in used:
+                    next_int += 1
+                new_key = next_int
+            else:
+                new_key = f"{key}_{seen[key]}"
+            used.add(new_key)
+            logger.warning(f"Duplicate story key {key!r}, renamed to {new_key!r}")
+            story = {**story, 'key': new_key}
         else:
             seen[key] = 0
-    return stories
+        unique.append(story)
+    return unique
 
 
 async def estimate_wsjf(data, websocket, model, topic_response, context_response):
     headers = {
-        "Authorization": f"Bearer {random.choice(api_keys)}",
         "Content-Type": "application/json"
     }
     
-    prioritize_prompt = construct_batch_wsjf_prompt(data, topic_response, context_response)
-    #logger.info(f"Prioritize Prompt:\n{prioritize_prompt}")  # Debugging print
-    estimated_factors = await send_to_llm(prioritize_prompt, headers, model)
-    await stream_response_word_by_word(websocket, estimated_factors, "Final Prioritization")
-    #logger.info(f"Estimated Factor:\n{estimated_factors}")
-    
-    wsjf_factors = parse_wsjf_response(estimated_factors)
+    chunk_results = await score_stories_in_chunks(
+        data, websocket, model, headers,
+        lambda chunk, turns: construct_batch_wsjf_prompt(chunk, *turns),
+        parse_wsjf_response, "WSJF", (topic_response, context_response)
+    )
+    wsjf_factors = merge_chunk_results(chunk_results)
     logger.info(f"wsjf_factors Factor:\n{wsjf_factors}")
     
 
@@ -466,8 +765,8 @@ def construct_batch_wsjf_prompt(stories, topic_response, context_response):
         for story in stories
     ])
     
-    topic_response_direct = '\n'.join(topic_response)
-    context_response_direct = '\n'.join(context_response)
+    topic_response_direct = format_discussion(topic_response)
+    context_response_direct = format_discussion(context_response)
     
     #print(stories_formatted)
     #print(topic_response_direct)
@@ -495,6 +794,7 @@ def construct_batch_wsjf_prompt(stories, topic_response, context_response):
         "For each story, provide a detailed explanation of why it received the allocated values. What is the main reason behind its prioritization? Make sure to include a complete explanation for every story."
     )
     
+    count_prompt_tokens("WSJF", prompt)
     return prompt
     
 
@@ -531,44 +831,7 @@ def validate_wsjf_response(wsjf_factors, stories):
     return False
 
 def enrich_original_stories_with_wsjf(original_stories, wsjf_factors):
-    wsjf_dict = {factor['story_id']: factor['wsjf_factors'] for factor in wsjf_factors}
-    logger.info(f"Original stories:\n{original_stories}")
-    logger.info(f"WSJF factors dictionary:\n{wsjf_dict}")
-
-    enriched_stories = []
-    for story in original_stories:
-        story_id = story['key']
-        if story_id in wsjf_dict:
-            wsjf_data = wsjf_dict[story_id]
-            story['wsjf_factors'] = wsjf_data
-            bv = wsjf_data['BV']
-            tc = wsjf_data['TC']
-            rr_oe = wsjf_data['RR/OE']
-            js = wsjf_data['JS']
-            wsjf_score = (bv + tc + rr_oe) / js if js != 0 else 0  # Prevent division by zero
-            story['wsjf_score'] = wsjf_score
-            story['bv'] = bv
-            story['tc'] = tc
-            story['oe'] = rr_oe
-            story['js'] =  js 
-
-            logger.info(f"Story ID {story_id} WSJF factors: {wsjf_data}, WSJF score: {wsjf_score}")
-        else:
-            story['wsjf_factors'] = {
-                'BV': 0,
-                'TC': 0,
-                'RR/OE': 0,
-                'JS': 0
-            }
-            story['wsjf_score'] = 0
-            story['bv'] = 0
-            story['tc'] = 0
-            logger.warning(f"Story ID {story_id} not found in WSJF factors")
-
-        enriched_stories.append(story)
-
-    enriched_stories = sort_stories_by_wsjf_in_place(enriched_stories)
-    return enriched_stories
+    return enrich_stories("WSJF", original_stories, wsjf_factors)
 
 def sort_stories_by_wsjf_in_place(enriched_stories):
     return sorted(enriched_stories, key=lambda story: story.get('wsjf_score', 0), reverse=True)
@@ -578,45 +841,6 @@ def sort_stories_by_wsjf_in_place(enriched_stories):
     return enriched_sorted_stories
 
 
-def save_uploaded_file(upload_folder, file: UploadFile):
-    if not file.filename.endswith('.csv'):
-        return None, 'Unsupported file type'
-
-    file_path = os.path.join(upload_folder, file.filename)
-    with open(file_path, 'wb') as f:
-        f.write(file.file.read())
-    return file_path, None
-
-def parse_csv_to_json(file_path):
-    with open(file_path, mode='r', encoding='utf-8') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        csv_data = list(csv_reader)  # Convert CSV file content to a list of dictionaries
-    os.remove(file_path)  # Optional: remove the file after processing
-    return csv_data
-
-
-async def extract_text_from_pdf(file: UploadFile):
-    try:
-        # Read the file content into bytes
-        file_bytes = await file.read()
-        
-        # Use BytesIO to treat the bytes like a file for pdfplumber
-        with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-            all_text = ""
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    all_text += page_text + "\n"
-                    
-        # If no text was extracted, raise an error
-        if not all_text:
-            raise ValueError("No text could be extracted from the PDF.")
-        
-        return all_text
-    except Exception as e:
-        # Handle PDF reading/extraction errors
-        raise ValueError(f"Error extracting text from PDF: {str(e)}")
-    
 #     raise Exception("Failed to get response from OpenAI after multiple attempts")
 
 # Implement MOSCOW Technique 
@@ -626,15 +850,15 @@ async def extract_text_from_pdf(file: UploadFile):
 
 async def estimate_moscow(data, websocket, model, topic_response, context_response):
     headers = {
-        "Authorization": f"Bearer {random.choice(api_keys)}",
         "Content-Type": "application/json"
     }
     
-    prioritize_prompt = construct_batch_moscow_prompt(data, topic_response, context_response)
-    estimated_priorities = await send_to_llm(prioritize_prompt, headers, model)
-    await stream_response_word_by_word(websocket, estimated_priorities, "Final Prioritization")
-    
-    moscow_priorities = parse_moscow_response(estimated_priorities)
+    chunk_results = await score_stories_in_chunks(
+        data, websocket, model, headers,
+        lambda chunk, turns: construct_batch_moscow_prompt(chunk, *turns),
+        parse_moscow_response, "MoSCoW", (topic_response, context_response)
+    )
+    moscow_priorities = merge_chunk_results(chunk_results)
     logger.info(f"MoSCoW Priorities:\n{moscow_priorities}")
     
     enriched_stories = enrich_original_stories_with_moscow(data, moscow_priorities)
@@ -669,12 +893,11 @@ def construct_batch_moscow_prompt(stories, topic_response, context_response):
         for story in stories
     ])
 
-    topic_response_direct = '\n'.join(topic_response)
-    context_response_direct = '\n'.join(context_response)
+    topic_response_direct = format_discussion(topic_response)
+    context_response_direct = format_discussion(context_response)
 
-    print(stories_formatted)
-    print(topic_response_direct)
-    print(context_response_direct)
+    logger.debug(f"MoSCoW prompt stories:\n{stories_formatted}")
+    logger.debug(f"MoSCoW prompt discussion:\n{topic_response_direct}\n{context_response_direct}")
     
     prompt = (
         "You are a helpful assistant trained in MoSCoW prioritization. "
@@ -694,6 +917,7 @@ def construct_batch_moscow_prompt(stories, topic_response, context_response):
         "For each story, provide a detailed explanation of why it received the allocated category. What is the main reason behind its prioritization? Make sure to include a complete explanation for every story."
     )
     
+    count_prompt_tokens("MoSCoW", prompt)
     return prompt
 
 def parse_moscow_response(response_text):
@@ -716,17 +940,7 @@ def validate_moscow_response(moscow_priorities, stories):
     return story_ids == response_story_ids
 
 def enrich_original_stories_with_moscow(original_stories, moscow_priorities):
-    moscow_dict = {priority['story_id']: priority['category'] for priority in moscow_priorities}
-
-    enriched_stories = []
-    for story in original_stories:
-        story_id = story['key']
-        story['moscow_category'] = moscow_dict.get(story_id, "No Category")
-        enriched_stories.append(story)
-
-    enriched_stories.sort(key=lambda x: ['Must Have', 'Should Have', 'Could Have', "Won't Have"].index(x['moscow_category']))
-    
-    return enriched_stories
+    return enrich_stories("MOSCOW", original_stories, moscow_priorities)
 
 
 
@@ -736,15 +950,15 @@ def enrich_original_stories_with_moscow(original_stories, moscow_priorities):
 # KANO Functions
 async def estimate_kano(data, websocket, model, topic_response, context_response):
     headers = {
-        "Authorization": f"Bearer {random.choice(api_keys)}",
         "Content-Type": "application/json"
     }
     
-    prioritize_prompt = construct_batch_kano_prompt(data, topic_response, context_response)
-    estimated_priorities = await send_to_llm(prioritize_prompt, headers, model, )
-    await stream_response_word_by_word(websocket, estimated_priorities, "Final Prioritization")
-    
-    kano_priorities = parse_kano_response(estimated_priorities)
+    chunk_results = await score_stories_in_chunks(
+        data, websocket, model, headers,
+        lambda chunk, turns: construct_batch_kano_prompt(chunk, *turns),
+        parse_kano_response, "Kano", (topic_response, context_response)
+    )
+    kano_priorities = merge_chunk_results(chunk_results)
     logger.info(f"KANO Priorities:\n{kano_priorities}")
     
     enriched_stories = enrich_original_stories_with_kano(data, kano_priorities)
@@ -780,12 +994,11 @@ def construct_batch_kano_prompt(stories, topic_response, context_response):
         for story in stories
     ])
     
-    topic_response_direct = '\n'.join(topic_response)
-    context_response_direct = '\n'.join(context_response)
+    topic_response_direct = format_discussion(topic_response)
+    context_response_direct = format_discussion(context_response)
     
-    print(stories_formatted)
-    print(topic_response_direct)
-    print(context_response_direct)
+    logger.debug(f"Kano prompt stories:\n{stories_formatted}")
+    logger.debug(f"Kano prompt discussion:\n{topic_response_direct}\n{context_response_direct}")
     
     prompt = (
         "You are a helpful assistant trained in KANO model prioritization. "
@@ -806,6 +1019,7 @@ def construct_batch_kano_prompt(stories, topic_response, context_response):
         "For each story, provide a detailed explanation of why it received the allocated category. What is the main reason behind its prioritization? Make sure to include a complete explanation for every story."
     )
     
+    count_prompt_tokens("Kano", prompt)
     return prompt
 
 def parse_kano_response(response_text):
@@ -828,29 +1042,27 @@ def validate_kano_response(kano_priorities, stories):
     return story_ids == response_story_ids
 
 def enrich_original_stories_with_kano(original_stories, kano_priorities):
-    kano_dict = {priority['story_id']: priority['category'] for priority in kano_priorities}
-
-    enriched_stories = []
-    for story in original_stories:
-        story_id = story['key']
-        story['kano_category'] = kano_dict.get(story_id, "No Category")
-        enriched_stories.append(story)
-
-    enriched_stories.sort(key=lambda x: ['Basic Needs', 'Performance Needs', 'Excitement Needs', 'Indifferent', 'Reverse'].index(x['kano_category']))
-    
-    return enriched_stories
+    return enrich_stories("KANO", original_stories, kano_priorities)
 
 #close KANO TECHNIQUE
 
 
-async def stream_response_word_by_word(websocket, response, agent_type, delay=0.6):
+async def stream_response_word_by_word(websocket, response, agent_type):
 
     if websocket.application_state != WebSocketState.DISCONNECTED:
         await websocket.send_json({
             "agentType": agent_type,
             "message": response
         })
-        await asyncio.sleep(delay)  # Delay to simulate streaming effect  
+
+async def send_stream_frame(websocket, agent_type, delta, stream):
+    # stream is "delta" for a chunk of an agent's message and "end" once the message is complete
+    if websocket.application_state != WebSocketState.DISCONNECTED:
+        await websocket.send_json({
+            "agentType": agent_type,
+            "message": delta,
+            "stream": stream
+        })
 
 
 def construct_product_owner_prompt(data, client_feedback=None):
@@ -860,14 +1072,13 @@ def construct_product_owner_prompt(data, client_feedback=None):
     ])
 
     feedback_section = ""
-    if client_feedback:
-        feedback_section = "As you prioritize, consider the following feedback provided by the client:\n\n" + '\n'.join(['- ' + fb for fb in client_feedback]) + "\n\n"
+    feedback_lines = format_client_feedback(client_feedback)
+    if feedback_lines:
+        feedback_section = "As you prioritize, consider the following feedback provided by the client:\n\n" + '\n'.join(['- ' + fb for fb in feedback_lines]) + "\n\n"
 
-    print("Formatted Stories:")
-    print(stories_formatted)
+    logger.debug(f"Formatted Stories:\n{stories_formatted}")
     if feedback_section:
-        print("Client Feedback:")
-        print(feedback_section)
+        logger.debug(f"Client Feedback:\n{feedback_section}")
     
     prompt = (
         "You are an experienced Product Owner who has successfully delivered several products from concept to market. "
@@ -882,6 +1093,7 @@ def construct_product_owner_prompt(data, client_feedback=None):
         "After allocating, double-check that the total is exactly 100 dollars. If it does not total 100, adjust and verify until it equals exactly 100.\n"
         "Provide a brief summary of two or three lines, explaining your prioritization approach, focusing on maximizing customer value and aligning with strategic goals."
     )
+    count_prompt_tokens("Product Owner", prompt)
     return prompt
 
 
@@ -892,14 +1104,13 @@ def construct_senior_developer_prompt(data, client_feedback=None):
     ])
 
     feedback_section = ""
-    if client_feedback:
-        feedback_section = "As you prioritize, take into account the following feedback from the client:\n\n" + '\n'.join(['- ' + fb for fb in client_feedback]) + "\n\n"
+    feedback_lines = format_client_feedback(client_feedback)
+    if feedback_lines:
+        feedback_section = "As you prioritize, take into account the following feedback from the client:\n\n" + '\n'.join(['- ' + fb for fb in feedback_lines]) + "\n\n"
 
-    print("Formatted Stories:")
-    print(stories_formatted)
+    logger.debug(f"Formatted Stories:\n{stories_formatted}")
     if feedback_section:
-        print("Client Feedback:")
-        print(feedback_section)
+        logger.debug(f"Client Feedback:\n{feedback_section}")
     
     prompt = (
         "You are a Senior Developer with several years of programming experience. "
@@ -914,6 +1125,7 @@ def construct_senior_developer_prompt(data, client_feedback=None):
         "After allocating, double-check that the total is exactly 100 dollars. If it does not total 100, adjust and verify until it equals exactly 100.\n"
         "Provide a brief summary of two or three lines,, focusing on technical dependencies, efficient project flow, and best practices."
     )
+    count_prompt_tokens("Senior Developer", prompt)
     return prompt
 
 
@@ -924,14 +1136,13 @@ def construct_senior_qa_prompt(data, client_feedback=None):
     ])
 
     feedback_section = ""
-    if client_feedback:
-        feedback_section = "As you prioritize, consider the following feedback from the client:\n\n" + '\n'.join(['- ' + fb for fb in client_feedback]) + "\n\n"
+    feedback_lines = format_client_feedback(client_feedback)
+    if feedback_lines:
+        feedback_section = "As you prioritize, consider the following feedback from the client:\n\n" + '\n'.join(['- ' + fb for fb in feedback_lines]) + "\n\n"
 
-    print("Formatted Stories:")
-    print(stories_formatted)
+    logger.debug(f"Formatted Stories:\n{stories_formatted}")
     if feedback_section:
-        print("Client Feedback:")
-        print(feedback_section)
+        logger.debug(f"Client Feedback:\n{feedback_section}")
     
     prompt = (
         "You are a Senior QA professional focused on quality and reliability. "
@@ -946,5 +1157,6 @@ def construct_senior_qa_prompt(data, client_feedback=None):
         "After allocating, double-check that the total is exactly 100 dollars. If it does not total 100, adjust and verify until it equals exactly 100.\n"
         "Provide a brief summary of two or three lines, emphasizing risk mitigation, quality, and client satisfaction."
     )
+    count_prompt_tokens("Senior QA", prompt)
     return prompt
 
@@ -0,0 +1,155 @@
+# incremental.py
+
+import os
+import re
+import hashlib
+import logging
+
+from enrichment import rank_stories
+
+logger = logging.getLogger(__name__)
+
+# Above this share of changed stories a full run is cheaper than patching the previous ranking
+INCREMENTAL_MAX_CHANGED_SHARE = float(os.getenv("INCREMENTAL_MAX_CHANGED_SHARE", "0.3"))
+# Unchanged stories re-scored along with the changed ones for the relative techniques, their previous values
+# calibrate the new scores
+INCREMENTAL_REFERENCE_STORIES = int(os.getenv("INCREMENTAL_REFERENCE_STORIES", "3"))
+
+# Techniques whose values are shares of a fixed total, so a re-scored subset has to be rescaled into the rest
+RELATIVE_FIELDS = {
+    "100_DOLLAR": ("dollar_allocation", 100),
+    "AHP_PAIRWISE": ("W", 1),
+}
+
+_STOPWORDS = {
+    "that", "this", "with", "from", "have", "should", "would", "could", "want", "user", "users", "story",
+    "stories", "able", "into", "more", "less", "than", "then", "they", "them", "their", "there", "when",
+    "what", "which", "will", "please", "also", "need", "needs", "like", "make", "sure", "about",
+}
+_STORY_REFERENCE = re.compile(r"\b(?:story|id)\s*(?:id\s*)?#?\s*(\d+)", re.IGNORECASE)
+
+
+def story_fingerprint(story):
+    text = f"{story.get('user_story', '')}\x1f{story.get('epic', '')}\x1f{story.get('description', '')}"
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _keywords(text):
+    return {word for word in re.findall(r"[a-z]{4,}", text.lower()) if word not in _STOPWORDS}
+
+
+def stories_named_in_feedback(stories, feedback_lines):
+    # A feedback line concerns a story when it names its ID, its epic, or shares two keywords with it
+    referenced = {match for line in feedback_lines for match in _STORY_REFERENCE.findall(line)}
+    line_keywords = [_keywords(line) for line in feedback_lines]
+    lowered_lines = [line.lower() for line in feedback_lines]
+
+    named = set()
+    for story in stories:
+        if str(story['key']) in referenced:
+            named.add(story['key'])
+            continue
+        epic = (story.get('epic') or '').lower()
+        if epic and any(epic in line for line in lowered_lines):
+            named.add(story['key'])
+            continue
+        story_keywords = _keywords(f"{story.get('user_story', '')} {story.get('description', '')}")
+        if any(len(story_keywords & keywords) >= 2 for keywords in line_keywords):
+            named.add(story['key'])
+    return named
+
+
+def plan_incremental_run(previous, stories, feedback_lines, technique, model):
+    # Returns the stories to re-score (none when stories were only removed), or None when the previous session
+    # can't be patched or nothing changed, and a full run is needed
+    if not previous or previous["technique"] != technique or previous["model"] != model:
+        return None
+
+    fingerprints = previous["fingerprints"]
+    changed = {story['key'] for story in stories if fingerprints.get(story['key']) != story_fingerprint(story)}
+    new_feedback = [line for line in feedback_lines if line not in set(previous["feedback"])]
+    if set(previous["feedback"]) - set(feedback_lines):
+        # Withdrawn feedback may have shaped any score of the previous run
+        logger.info("Feedback was removed, running the full workflow")
+        return None
+    if new_feedback:
+        named = stories_named_in_feedback(stories, new_feedback)
+        if not named:
+            logger.info("New feedback doesn't name specific stories, running the full workflow")
+            return None
+        changed |= named
+
+    removed = set(fingerprints) - {story['key'] for story in stories}
+    if not changed and not removed and not new_feedback:
+        # The same request again is a request for a fresh ranking, not for the stored one
+        logger.info("Nothing changed since the previous run, running the full workflow")
+        return None
+    if len(changed) > INCREMENTAL_MAX_CHANGED_SHARE * len(stories):
+        logger.info(f"{len(changed)} of {len(stories)} stories changed, running the full workflow")
+        return None
+    if changed and technique in RELATIVE_FIELDS and not reference_stories(technique, previous["results"], stories, changed):
+        logger.info("No unchanged stories to calibrate the new scores against, running the full workflow")
+        return None
+    return [story for story in stories if story['key'] in changed]
+
+
+def reference_stories(technique, previous_results, stories, changed_keys, count=INCREMENTAL_REFERENCE_STORIES):
+    # Unchanged stories spread evenly over the previous ranking, only those that got a share of the total
+    field, _ = RELATIVE_FIELDS[technique]
+    current = {story['key']: story for story in stories}
+    candidates = [
+        current[story['key']] for story in previous_results
+        if story['key'] in current and story['key'] not in changed_keys and (story.get(field) or 0) > 0
+    ]
+    if len(candidates) <= count:
+        return candidates
+    if count <= 1:
+        return candidates[:count]
+    return [candidates[round(i * (len(candidates) - 1) / (count - 1))] for i in range(count)]
+
+
+def _rescale(stories, field, target):
+    total = sum(story.get(field) or 0 for story in stories)
+    factor = target / total if total else 0
+    return [{**story, field: round((story.get(field) or 0) * factor, 4 if target == 1 else 2)} for story in stories]
+
+
+def merge_incremental_results(technique, previous_results, rescored, stories, reference_keys=()):
+    # Previous results of the untouched stories plus the re-scored ones, ranked again as one backlog.
+    # reference_keys are unchanged stories that were re-scored along with the changed ones.
+    reference_keys = set(reference_keys)
+    changed = [story for story in rescored if story['key'] not in reference_keys]
+    changed_keys = {story['key'] for story in changed}
+    current_keys = {story['key'] for story in stories}
+    kept = [story for story in previous_results if story['key'] in current_keys and story['key'] not in changed_keys]
+
+    if technique in RELATIVE_FIELDS:
+        # The new values are only comparable to the old ones through the references, which were scored in both runs:
+        # the changed stories are scaled by how the references' total changed, then everything is normalized again
+        field, total = RELATIVE_FIELDS[technique]
+        previous_reference = sum(story.get(field) or 0 for story in previous_results if story['key'] in reference_keys)
+        new_reference = sum(story.get(field) or 0 for story in rescored if story['key'] in reference_keys)
+        if changed and new_reference > 0:
+            factor = previous_reference / new_reference
+            changed = [{**story, field: (story.get(field) or 0) * factor} for story in changed]
+        elif changed:
+            # The references got nothing this time, the changed stories took the whole total
+            logger.warning("Reference stories were scored 0, the re-scored stories keep their share of the total")
+            changed = _rescale(changed, field, total * len(changed) / len(stories))
+        merged = _rescale(kept + changed, field, total)
+        if technique == "AHP_PAIRWISE":
+            merged = [{**story, "OS": round(story["W"] * 100, 2)} for story in merged]
+        return rank_stories(technique, merged)
+
+    return rank_stories(technique, kept + changed)
+
+
+def session_snapshot(technique, model, stories, feedback_lines, turns, results):
+    return {
+        "technique": technique,
+        "model": model,
+        "fingerprints": {story['key']: story_fingerprint(story) for story in stories},
+        "feedback": list(feedback_lines),
+        "turns": turns,
+        "results": results,
+    }
@@ -0,0 +1,371 @@
+# ingestion.py
+
+import os
+import re
+import csv
+import codecs
+import asyncio
+import logging
+import tempfile
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+try:
+    import openpyxl
+    from openpyxl.utils import column_index_from_string
+except ImportError:  # optional, only .xlsx uploads need it
+    openpyxl = None
+
+logger = logging.getLogger(__name__)
+
+# Uploads are parsed straight from the request body, these caps keep a huge export from running on
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_MAX_ROWS = int(os.getenv("UPLOAD_MAX_ROWS", "5000"))
+# Stories per batch yielded while the upload is parsed
+UPLOAD_BATCH_ROWS = int(os.getenv("UPLOAD_BATCH_ROWS", "200"))
+# Longest CSV record in characters. Quoted fields may span lines, this bounds what one record can buffer.
+UPLOAD_MAX_RECORD_CHARS = int(os.getenv("UPLOAD_MAX_RECORD_CHARS", str(256 * 1024)))
+# Spreadsheets need a seekable file, they are spooled in memory up to this size and to a temporary file beyond it
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+# Rows searched for the header of a sheet, our exports start with a few empty rows
+XLSX_HEADER_SCAN_ROWS = int(os.getenv("XLSX_HEADER_SCAN_ROWS", "20"))
+
+# Line ends of CSV records. str.splitlines would also split on form feeds and other separators inside fields.
+_LINE = re.compile(r".*?(?:\r\n|\n|\r)|.+", re.DOTALL)
+
+# Header names (lowercase) that map to the story fields, first match wins. Covers our own CSVs and Jira exports.
+COLUMN_ALIASES = {
+    "user_story": ("user_story", "user story", "user stories", "story", "summary", "title", "name"),
+    "epic": ("epic", "epic name", "epic link", "epic link summary", "parent summary", "parent", "feature"),
+    "description": ("description", "details", "body"),
+    "status": ("status",),
+}
+
+
+class UploadError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# Query parameters that pick the column of a story field by header name or spreadsheet letter
+COLUMN_OPTIONS = {f"{field}_column": field for field in COLUMN_ALIASES}
+
+
+def column_index(header, name):
+    # Header name (any case), else a column letter like "C"
+    normalized = [cell.strip().lower() for cell in header]
+    name = name.strip()
+    if name.lower() in normalized:
+        return normalized.index(name.lower())
+    if openpyxl is not None and name.isalpha() and len(name) <= 3:
+        return column_index_from_string(name.upper()) - 1
+    raise UploadError(f"No column {name!r} in the header {', '.join(cell for cell in header if cell)}")
+
+
+def map_columns(header, overrides=None):
+    # Story field -> column index. Columns chosen by the user win over the aliases, without a known
+    # user story column the first column is taken.
+    normalized = [name.strip().lower() for name in header]
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in normalized:
+                columns[field] = normalized.index(alias)
+                break
+    for field, name in (overrides or {}).items():
+        columns[field] = column_index(header, name)
+    if "user_story" not in columns and header:
+        columns["user_story"] = 0
+    return columns
+
+
+def is_header(row, overrides=None):
+    # A row that names the user story column, the user's choice or one of the aliases (a letter choice isn't in it)
+    normalized = {cell.strip().lower() for cell in row}
+    name = (overrides or {}).get("user_story", "").strip().lower()
+    return (name and name in normalized) or any(alias in normalized for alias in COLUMN_ALIASES["user_story"])
+
+
+def upload_options(query_params):
+    # Sheet, header row and column choices of an upload, e.g. ?sheet=GPT-4o&user_story_column=User%20Stories
+    options = {"columns": {field: query_params[name] for name, field in COLUMN_OPTIONS.items() if query_params.get(name)}}
+    options["sheet"] = query_params.get("sheet") or None
+    header_row = query_params.get("header_row")
+    if header_row:
+        if not header_row.isdigit() or int(header_row) < 1:
+            raise UploadError("header_row must be a row number starting at 1")
+        options["header_row"] = int(header_row)
+    return options
+
+
+class CSVRecordStream:
+    # Incremental CSV parser: text is fed in arbitrary chunks, complete rows come out. A record ends at a
+    # newline outside quotes, so quoted fields may span lines and chunks. As in RFC 4180, a quote only opens a
+    # field at the start of the field, a '"' inside an unquoted field (5" screen) is an ordinary character.
+    def __init__(self, max_record_chars=UPLOAD_MAX_RECORD_CHARS):
+        self.decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+        self.partial_line = ""
+        self.record = []
+        self.record_chars = 0
+        self.in_quotes = False
+        self.dialect = None
+        self.max_record_chars = max_record_chars
+
+    def feed(self, data, final=False):
+        text = self.partial_line + self.decoder.decode(data, final=final)
+        lines = _LINE.findall(text)
+        self.partial_line = lines.pop() if lines and not final and not lines[-1].endswith(("\n", "\r")) else ""
+        if self.record_chars + len(self.partial_line) > self.max_record_chars:
+            raise UploadError(f"A CSV record is longer than {self.max_record_chars} characters")
+        rows = []
+        for line in lines:
+            self.record.append(line)
+            self.record_chars += len(line)
+            if self.record_chars > self.max_record_chars:
+                raise UploadError(
+                    f"A CSV record is longer than {self.max_record_chars} characters, "
+                    f"check for a quoted field that is never closed"
+                )
+            self._scan_quotes(line)
+            if not self.in_quotes:
+                rows.extend(self._parse("".join(self.record)))
+                self.record = []
+                self.record_chars = 0
+        if final and self.record:
+            rows.extend(self._parse("".join(self.record)))
+            self.record = []
+        return rows
+
+    def _scan_quotes(self, line):
+        # Updates in_quotes for one line. Until the header has been parsed the delimiter isn't known yet.
+        delimiters = self.dialect.delimiter if self.dialect else ",;\t"
+        pos = 0
+        while True:
+            quote = line.find('"', pos)
+            if quote < 0:
+                return
+            if self.in_quotes:
+                if line.startswith('"', quote + 1):
+                    pos = quote + 2  # "" is an escaped quote
+                    continue
+                self.in_quotes = False
+            elif quote == 0 or line[quote - 1] in delimiters:
+                self.in_quotes = True
+            pos = quote + 1
+
+    def _parse(self, record):
+        if self.dialect is None:
+            # The header decides between comma, semicolon and tab separated exports, quoting is always RFC 4180
+            try:
+                delimiter = csv.Sniffer().sniff(record, delimiters=",;\t").delimiter
+            except csv.Error:
+                delimiter = ","
+            self.dialect = type("UploadDialect", (csv.excel,), {"delimiter": delimiter})
+        try:
+            return [row for row in csv.reader([record], self.dialect) if any(cell.strip() for cell in row)]
+        except csv.Error as e:
+            raise UploadError(f"Malformed CSV record: {e}")
+
+
+class StoryNormalizer:
+    # Header row first, then each row becomes {key, user_story, epic, description[, status]}, numbered as it arrives
+    def __init__(self, max_rows=UPLOAD_MAX_ROWS, overrides=None):
+        self.header = None
+        self.columns = None
+        self.count = 0
+        self.max_rows = max_rows
+        self.overrides = overrides
+
+    def normalize(self, rows):
+        stories = []
+        for row in rows:
+            if self.columns is None:
+                self.header = row
+                self.columns = map_columns(row, self.overrides)
+                continue
+            if self.count >= self.max_rows:
+                raise UploadError(f"The file has more than {self.max_rows} stories", status_code=413)
+            story = {"key": self.count}
+            for field in ("user_story", "epic", "description"):
+                index = self.columns.get(field)
+                story[field] = row[index].strip() if index is not None and index < len(row) else ""
+            if "status" in self.columns and self.columns["status"] < len(row):
+                story["status"] = row[self.columns["status"]].strip()
+            stories.append(story)
+            self.count += 1
+        return stories
+
+
+def _cell_text(value):
+    # Numbers typed into a sheet come back as floats, 3.0 is shown as 3
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _sheet_rows(worksheet):
+    # Non-empty rows as text, with their row number. Read-only worksheets parse the XML as rows are taken.
+    for number, row in enumerate(worksheet.iter_rows(values_only=True), start=1):
+        cells = [_cell_text(value) for value in row]
+        if any(cell.strip() for cell in cells):
+            yield number, cells
+
+
+def _find_header(worksheet, options):
+    # The header and the rows after it, or None if the sheet has no header in the rows searched
+    header_row = options.get("header_row")
+    rows = _sheet_rows(worksheet)
+    for number, cells in rows:
+        if header_row is not None:
+            if number < header_row:
+                continue
+            return (cells, rows) if number == header_row else None
+        if number > XLSX_HEADER_SCAN_ROWS:
+            return None
+        if is_header(cells, options["columns"]):
+            return cells, rows
+    return None
+
+
+def _xlsx_batches(file, options, info, max_rows, batch_rows):
+    # Streams the stories of one sheet in batches. Without a sheet choice the first sheet with a
+    # story header is taken, so project description and feedback sheets are skipped.
+    if openpyxl is None:
+        raise UploadError("Excel uploads need the openpyxl package (pip install openpyxl)", status_code=415)
+    try:
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    except Exception as e:  # zipfile, XML and openpyxl's own errors for files that aren't workbooks
+        raise UploadError(f"Not a valid .xlsx file: {e}")
+    try:
+        info["sheets"] = workbook.sheetnames
+        sheet = options.get("sheet")
+        if sheet is not None and sheet not in workbook.sheetnames:
+            raise UploadError(f"No sheet {sheet!r}, the workbook has {', '.join(workbook.sheetnames)}")
+        found = None
+        for worksheet in [workbook[sheet]] if sheet is not None else workbook.worksheets:
+            worksheet.reset_dimensions()  # the stored dimensions are often wrong, read up to the last row there is
+            found = _find_header(worksheet, options)
+            if found:
+                break
+        if found is None:
+            raise UploadError(f"No header row with a user story column in {sheet or 'any sheet'}")
+        header, rows = found
+        info["sheet"] = worksheet.title
+        normalizer = StoryNormalizer(max_rows, options["columns"])
+        normalizer.normalize([header])
+        info["normalizer"] = normalizer
+        batch = []
+        for _, cells in rows:
+            batch.extend(normalizer.normalize([cells]))
+            if len(batch) >= batch_rows:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        workbook.close()
+
+
+async def iter_upload(request, options=None, info=None, field_name="file", max_bytes=UPLOAD_MAX_BYTES,
+                      max_rows=UPLOAD_MAX_ROWS, batch_rows=UPLOAD_BATCH_ROWS):
+    # Parses the CSV or .xlsx part of a multipart request and yields batches of stories. A CSV is parsed
+    # while it is received, nothing is written to disk and memory stays at about one batch plus one chunk.
+    # A workbook is spooled first (zip archives are read from the end), then its rows are streamed in
+    # read-only mode. options come from upload_options, info receives the sheet and column mapping used.
+    options = options or {"columns": {}}
+    info = {} if info is None else info
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("Expected a multipart/form-data upload")
+
+    state = {"headers": {}, "field": None, "name": b"", "value": b"", "kind": None}
+    csv_stream = CSVRecordStream()
+    normalizer = StoryNormalizer(max_rows, options["columns"])
+    spool = None
+    pending = []
+    received = 0
+
+    def on_part_begin():
+        state["headers"] = {}
+
+    def on_header_field(data, start, end):
+        state["name"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["name"].lower()] = state["value"]
+        state["name"], state["value"] = b"", b""
+
+    def on_headers_finished():
+        nonlocal spool
+        _, disposition = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        state["field"] = disposition.get(b"name", b"").decode("utf-8", "replace")
+        if state["field"] == field_name:
+            filename = disposition.get(b"filename", b"").decode("utf-8", "replace").lower()
+            if filename.endswith(".csv"):
+                state["kind"] = "csv"
+            elif filename.endswith(".xlsx"):
+                state["kind"] = "xlsx"
+                spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+            else:
+                raise UploadError("Unsupported file type, upload a .csv or .xlsx file")
+
+    def on_part_data(data, start, end):
+        if state["field"] != field_name:
+            return
+        if state["kind"] == "xlsx":
+            spool.write(data[start:end])
+        else:
+            pending.extend(normalizer.normalize(csv_stream.feed(data[start:end])))
+
+    def on_part_end():
+        if state["field"] == field_name and state["kind"] == "csv":
+            pending.extend(normalizer.normalize(csv_stream.feed(b"", final=True)))
+        state["field"] = None
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_bytes:
+                raise UploadError(f"The upload is larger than {max_bytes // (1024 * 1024)} MB", status_code=413)
+            parser.write(chunk)
+            while len(pending) >= batch_rows:
+                yield pending[:batch_rows]
+                del pending[:batch_rows]
+        parser.finalize()
+
+        if state["kind"] is None:
+            raise UploadError("No file part")
+        if state["kind"] == "xlsx":
+            spool.seek(0)
+            batches = _xlsx_batches(spool, options, info, max_rows, batch_rows)
+            # openpyxl parses synchronously, each batch is read in a thread
+            while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+                yield batch
+            normalizer = info.pop("normalizer")
+        elif pending:
+            yield pending
+    finally:
+        if spool is not None:
+            spool.close()
+
+    header = normalizer.header or []
+    info["header"] = [cell for cell in header if cell.strip()]
+    info["columns"] = {field: header[index] for field, index in (normalizer.columns or {}).items() if index < len(header)}
+    info["count"] = normalizer.count
+    logger.info(f"Imported {normalizer.count} stories from the {state['kind']} upload ({received} bytes)")
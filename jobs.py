@@ -0,0 +1,261 @@
+# jobs.py
+
+import os
+import time
+import uuid
+import asyncio
+import logging
+from collections import deque
+
+from starlette.websockets import WebSocketState
+
+from session_store import save_job, load_job, request_job_cancel, job_cancel_requested
+
+logger = logging.getLogger(__name__)
+
+# Prioritization runs are queued and run by a fixed pool of workers, independent of the WebSocket that submitted them.
+# Both limits apply per uvicorn worker process, WEB_CONCURRENCY=4 runs up to 4 * JOB_WORKERS jobs at once.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Submissions beyond this many waiting jobs are rejected instead of piling up
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "32"))
+# Finished jobs stay available for status and subscribe this many seconds
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "3600"))
+# Events kept per job for subscribers that join late. The token deltas of a streamed message are kept as one event.
+JOB_EVENT_HISTORY = int(os.getenv("JOB_EVENT_HISTORY", "5000"))
+# With several uvicorn workers a job can be cancelled from another process, the worker running it checks this often
+JOB_CANCEL_POLL = float(os.getenv("JOB_CANCEL_POLL", "2")) if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 else None
+
+FINISHED = ("done", "failed", "cancelled")
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobChannel:
+    # Stands in for the WebSocket in the workflow functions: every frame they send becomes an event of the job
+    application_state = WebSocketState.CONNECTED
+
+    def __init__(self, job):
+        self.job = job
+
+    async def send_json(self, payload):
+        self.job.publish(payload)
+
+
+class Job:
+    def __init__(self, run, kind, session_id=None):
+        self.id = uuid.uuid4().hex
+        self.run = run  # coroutine function taking the job's channel, its return value is the job's result
+        self.kind = kind
+        self.session_id = session_id
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.result = None
+        self.task = None
+        self.events = deque(maxlen=JOB_EVENT_HISTORY)
+        self.events_dropped = 0
+        self.open_messages = {}  # agentType -> (history event, deltas) of the messages still streaming
+        self.subscribers = set()
+
+    def persist(self):
+        # Status changes are stored for the other worker processes, in order, without waiting for the write
+        asyncio.ensure_future(save_job(self.summary()))
+
+    def publish(self, event):
+        self._record(event)
+        for subscriber in self.subscribers:
+            subscriber.put_nowait(event)
+
+    def _record(self, event):
+        # Subscribers get every delta, the history joins the deltas of a message into one delta event
+        stream = event.get("stream")
+        if stream == "delta" and event["agentType"] in self.open_messages:
+            self.open_messages[event["agentType"]][1].append(event["message"])
+            return
+        if stream == "end" and event["agentType"] in self.open_messages:
+            history_event, deltas = self.open_messages.pop(event["agentType"])
+            history_event["message"] = "".join(deltas)
+        if len(self.events) == self.events.maxlen:
+            if not self.events_dropped:
+                logger.warning(f"Job {self.id} has more than {JOB_EVENT_HISTORY} events, late subscribers miss the oldest")
+            self.events_dropped += 1
+        if stream == "delta":
+            history_event = dict(event)  # the published event may still be waiting in a subscriber's queue
+            self.open_messages[event["agentType"]] = (history_event, [event["message"]])
+            event = history_event
+        self.events.append(event)
+
+    def history(self):
+        # Messages still streaming are replayed with their deltas so far, a dropped start is announced first
+        events = [status_event(self, events_dropped=self.events_dropped)] if self.events_dropped else []
+        open_events = {id(history_event): deltas for history_event, deltas in self.open_messages.values()}
+        for event in self.events:
+            if id(event) in open_events:
+                event = {**event, "message": "".join(open_events[id(event)])}
+            events.append(event)
+        return events
+
+    def subscribe(self, from_start=True):
+        # Queue of the job's events, from the start or from now on. None marks the end of the stream.
+        subscriber = asyncio.Queue()
+        for event in (self.history() if from_start else ()):
+            subscriber.put_nowait(event)
+        if self.status in FINISHED:
+            subscriber.put_nowait(None)
+        else:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+        self.persist()
+        self.publish(status_event(self))
+        for subscriber in self.subscribers:
+            subscriber.put_nowait(None)
+        self.subscribers.clear()
+
+    def summary(self):
+        summary = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "session_id": self.session_id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.status == "queued":
+            summary["queue_position"] = queue_position(self)
+        if self.error:
+            summary["error"] = self.error
+        if self.status == "done":
+            summary["result"] = self.result
+        return summary
+
+
+_jobs = {}
+_queue = None
+_workers = []
+
+
+def status_event(job, **fields):
+    return {"agentType": "job", "message": "", "job_id": job.id, "status": job.status, **fields}
+
+
+def queue_position(job):
+    return sum(1 for other in _jobs.values() if other.status == "queued" and other.created_at < job.created_at)
+
+
+async def _worker():
+    while True:
+        job = await _queue.get()
+        if job.status != "queued":
+            continue  # cancelled while it was waiting
+        job.status = "running"
+        job.started_at = time.time()
+        job.persist()
+        job.publish(status_event(job))
+        job.task = asyncio.ensure_future(job.run(JobChannel(job)))
+        # asyncio.wait doesn't cancel the job when the worker itself is cancelled on shutdown
+        while not job.task.done():
+            await asyncio.wait({job.task}, timeout=JOB_CANCEL_POLL)
+            if not job.task.done() and await job_cancel_requested(job.id):
+                job.task.cancel()
+        if job.task.cancelled():
+            job.finish("cancelled")
+        elif job.task.exception() is not None:
+            logger.error(f"Job {job.id} failed: {job.task.exception()}")
+            job.finish("failed", str(job.task.exception()))
+        else:
+            job.result = job.task.result()
+            job.finish("done")
+
+
+def _start_workers():
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+    _workers[:] = [worker for worker in _workers if not worker.done()]
+    while len(_workers) < JOB_WORKERS:
+        _workers.append(asyncio.ensure_future(_worker()))
+
+
+def _drop_expired_jobs():
+    cutoff = time.time() - JOB_RETENTION
+    for job_id in [job_id for job_id, job in _jobs.items() if job.status in FINISHED and job.finished_at < cutoff]:
+        del _jobs[job_id]
+
+
+def submit_job(run, kind, session_id=None):
+    _start_workers()
+    _drop_expired_jobs()
+    job = Job(run, kind, session_id)
+    try:
+        _queue.put_nowait(job)
+    except asyncio.QueueFull:
+        raise QueueFullError(f"{_queue.qsize()} jobs are already waiting")
+    _jobs[job.id] = job
+    job.persist()
+    logger.info(f"Job {job.id} ({kind}) queued at position {queue_position(job)}")
+    return job
+
+
+def get_job(job_id):
+    return _jobs.get(job_id)
+
+
+def active_job_for_session(session_id):
+    active = [job for job in _jobs.values() if job.session_id == session_id and job.status not in FINISHED]
+    return max(active, key=lambda job: job.created_at) if active else None
+
+
+def cancel_job(job_id):
+    job = _jobs.get(job_id)
+    if job is None or job.status in FINISHED:
+        return False
+    if job.status == "queued":
+        job.finish("cancelled")  # the worker skips it when it comes up
+    else:
+        job.task.cancel()
+    return True
+
+
+async def find_job(job_id):
+    # Summary of a job of this process or, with several workers, of another one
+    job = _jobs.get(job_id)
+    return job.summary() if job else await load_job(job_id)
+
+
+async def request_cancel(job_id):
+    if job_id in _jobs:
+        return cancel_job(job_id)
+    summary = await load_job(job_id)
+    if summary is None or summary["status"] in FINISHED:
+        return False
+    await request_job_cancel(job_id)
+    return True
+
+
+def job_stats():
+    counts = {}
+    for job in _jobs.values():
+        counts[job.status] = counts.get(job.status, 0) + 1
+    return {"workers": JOB_WORKERS, "queue_size": JOB_QUEUE_SIZE, "jobs": counts}
+
+
+async def close_jobs():
+    for job in _jobs.values():
+        if job.task is not None and not job.task.done():
+            job.task.cancel()
+    for worker in _workers:
+        worker.cancel()
+    _workers.clear()
@@ -0,0 +1,381 @@
+# key_scheduler.py
+
+import os
+import re
+import time
+import sqlite3
+import asyncio
+import logging
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+# .env names of the keys per provider (API-KEY1..N and LLAMA-key1..N, gaps are skipped)
+PROVIDER_KEY_PREFIX = {
+    "openai": "API-KEY",
+    "groq": "LLAMA-key",
+}
+MAX_KEYS_PER_PROVIDER = 10
+
+# Requests and tokens per minute allowed for one key, set them to your account tier
+KEY_LIMITS = {
+    "openai": {
+        "rpm": int(os.getenv("OPENAI_RPM_PER_KEY", "500")),
+        "tpm": int(os.getenv("OPENAI_TPM_PER_KEY", "200000")),
+    },
+    "groq": {
+        "rpm": int(os.getenv("GROQ_RPM_PER_KEY", "30")),
+        "tpm": int(os.getenv("GROQ_TPM_PER_KEY", "6000")),
+    },
+}
+# Optional limits for all keys of a provider together, 0 means no provider-wide limit
+PROVIDER_LIMITS = {
+    "openai": {
+        "rpm": int(os.getenv("OPENAI_RPM", "0")),
+        "tpm": int(os.getenv("OPENAI_TPM", "0")),
+    },
+    "groq": {
+        "rpm": int(os.getenv("GROQ_RPM", "0")),
+        "tpm": int(os.getenv("GROQ_TPM", "0")),
+    },
+}
+
+# Cooldown for a throttled key when the provider doesn't say how long to wait
+DEFAULT_THROTTLE_COOLDOWN = float(os.getenv("KEY_THROTTLE_COOLDOWN", "20"))
+# Cooldown for a key the provider rejected (revoked, wrong project, no credit)
+INVALID_KEY_COOLDOWN = float(os.getenv("KEY_INVALID_COOLDOWN", "300"))
+
+# Rate limit state shared by all worker processes. On by default when uvicorn runs more than one worker,
+# otherwise the limits are tracked in memory.
+KEY_STATE_DB = os.getenv("KEY_STATE_DB") or ("instance/key_state.db" if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 else None)
+if KEY_STATE_DB:
+    KEY_STATE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), KEY_STATE_DB)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def cost(self, amount):
+        # A request larger than the whole bucket would wait forever, it only needs a full bucket
+        return min(float(amount), self.capacity)
+
+    def wait_time(self, amount):
+        self.refill()
+        deficit = self.cost(amount) - self.level
+        return max(0.0, deficit / self.rate) if self.rate else 0.0
+
+    def consume(self, amount):
+        self.refill()
+        self.level -= self.cost(amount)
+
+    def sync(self, remaining):
+        # The provider's own counter is the source of truth when it sends one
+        self.refill()
+        self.level = min(self.capacity, float(remaining))
+
+    def fill_ratio(self):
+        self.refill()
+        return self.level / self.capacity if self.capacity else 1.0
+
+
+class KeyState:
+    def __init__(self, provider, name, key):
+        self.provider = provider
+        self.name = name  # env var name, safe to log
+        self.key = key
+        self.requests = TokenBucket(KEY_LIMITS[provider]["rpm"])
+        self.tokens = TokenBucket(KEY_LIMITS[provider]["tpm"])
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+
+    def wait_time(self, estimated_tokens):
+        cooldown = max(0.0, self.cooldown_until - time.monotonic())
+        return max(cooldown, self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+
+
+def load_keys(provider):
+    prefix = PROVIDER_KEY_PREFIX[provider]
+    keys = []
+    for i in range(1, MAX_KEYS_PER_PROVIDER + 1):
+        name = f"{prefix}{i}"
+        key = os.getenv(name)
+        if key:
+            keys.append(KeyState(provider, name, key))
+    return keys
+
+
+_keys = {}
+_provider_buckets = {}
+# One FIFO queue per provider: asyncio.Lock wakes its waiters in arrival order, so no session can starve another
+_queues = {}
+_key_state_ready = False
+
+
+def _provider_state(provider):
+    if provider not in _keys:
+        _keys[provider] = load_keys(provider)
+        limits = PROVIDER_LIMITS[provider]
+        _provider_buckets[provider] = {
+            "requests": TokenBucket(limits["rpm"]) if limits["rpm"] else None,
+            "tokens": TokenBucket(limits["tpm"]) if limits["tpm"] else None,
+        }
+        _queues[provider] = asyncio.Lock()
+        logger.info(f"Key scheduler: {len(_keys[provider])} {provider} key(s) configured")
+    return _keys[provider], _provider_buckets[provider], _queues[provider]
+
+
+def _provider_wait_time(buckets, estimated_tokens):
+    wait = 0.0
+    if buckets["requests"]:
+        wait = max(wait, buckets["requests"].wait_time(1))
+    if buckets["tokens"]:
+        wait = max(wait, buckets["tokens"].wait_time(estimated_tokens))
+    return wait
+
+
+def _preference_order(keys, avoid=None):
+    # Least loaded key first: fewest requests in flight, then the fullest token bucket. Keys to avoid come last.
+    avoid = avoid or ()
+    return sorted(keys, key=lambda s: (s.name in avoid, s.in_flight, -s.tokens.fill_ratio()))
+
+
+def _take_local(keys, buckets, estimated_tokens, avoid=None):
+    # Charges the preferred ready key, or returns how long until one could be
+    provider_wait = _provider_wait_time(buckets, estimated_tokens)
+    waits = {state.name: state.wait_time(estimated_tokens) for state in keys}
+    if provider_wait == 0.0:
+        for state in _preference_order(keys, avoid):
+            if waits[state.name] == 0.0:
+                state.requests.consume(1)
+                state.tokens.consume(estimated_tokens)
+                if buckets["requests"]:
+                    buckets["requests"].consume(1)
+                if buckets["tokens"]:
+                    buckets["tokens"].consume(estimated_tokens)
+                return state, 0.0
+    return None, max(provider_wait, min(waits.values()))
+
+
+# Shared state: one row per bucket with its level at a wall-clock time, and a cooldown on the requests bucket of a key
+
+def _connect_key_state():
+    global _key_state_ready
+    if not _key_state_ready:
+        os.makedirs(os.path.dirname(KEY_STATE_DB), exist_ok=True)
+    connection = sqlite3.connect(KEY_STATE_DB, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    if not _key_state_ready:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS key_state ("
+            "bucket TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL, cooldown_until REAL NOT NULL DEFAULT 0)"
+        )
+        _key_state_ready = True
+    return connection
+
+
+def _bucket_ids(provider, state=None):
+    scope = state.name if state else "*"
+    return f"{provider}:{scope}:requests", f"{provider}:{scope}:tokens"
+
+
+def _shared_level(rows, bucket_id, bucket, now):
+    if bucket_id not in rows:
+        return bucket.capacity
+    level, updated, _ = rows[bucket_id]
+    return min(bucket.capacity, level + max(0.0, now - updated) * bucket.rate)
+
+
+def _shared_wait(rows, bucket_id, bucket, amount, now):
+    deficit = bucket.cost(amount) - _shared_level(rows, bucket_id, bucket, now)
+    return max(0.0, deficit / bucket.rate) if bucket.rate else 0.0
+
+
+def _take_shared(provider, keys, buckets, estimated_tokens, avoid=None):
+    # Same as _take_local against the levels all workers share, read and charged in one IMMEDIATE transaction
+    now = time.time()
+    with closing(_connect_key_state()) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = {
+                row[0]: row[1:]
+                for row in connection.execute(
+                    "SELECT bucket, level, updated, cooldown_until FROM key_state WHERE bucket LIKE ?", (f"{provider}:%",)
+                )
+            }
+            provider_parts = [
+                (bucket_id, bucket, amount)
+                for bucket_id, bucket, amount in zip(_bucket_ids(provider), (buckets["requests"], buckets["tokens"]), (1, estimated_tokens))
+                if bucket
+            ]
+            provider_wait = max([_shared_wait(rows, *part, now) for part in provider_parts], default=0.0)
+
+            chosen, waits = None, []
+            for state in _preference_order(keys, avoid):
+                requests_id, tokens_id = _bucket_ids(provider, state)
+                parts = [(requests_id, state.requests, 1), (tokens_id, state.tokens, estimated_tokens)]
+                # This worker's own cooldown counts too, in case its shared write failed
+                cooldown = max(0.0, state.cooldown_until - time.monotonic())
+                if requests_id in rows:
+                    cooldown = max(cooldown, rows[requests_id][2] - now)
+                wait = max([cooldown] + [_shared_wait(rows, *part, now) for part in parts])
+                waits.append(wait)
+                if wait == 0.0 and provider_wait == 0.0:
+                    chosen = state
+                    for bucket_id, bucket, amount in parts + provider_parts:
+                        level = _shared_level(rows, bucket_id, bucket, now) - bucket.cost(amount)
+                        connection.execute(
+                            "INSERT INTO key_state (bucket, level, updated) VALUES (?, ?, ?) "
+                            "ON CONFLICT(bucket) DO UPDATE SET level = excluded.level, updated = excluded.updated",
+                            (bucket_id, level, now),
+                        )
+                    break
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+    if chosen is not None:
+        # The local buckets only mirror the shared ones for key_stats
+        chosen.requests.consume(1)
+        chosen.tokens.consume(estimated_tokens)
+        return chosen, 0.0
+    return None, max(provider_wait, min(waits))
+
+
+def _update_shared(provider, state, levels, cooldown_until=None):
+    # levels: {"requests": remaining, "tokens": remaining} as reported by the provider
+    now = time.time()
+    requests_id, tokens_id = _bucket_ids(provider, state)
+    with closing(_connect_key_state()) as connection:
+        for bucket_id, remaining in ((requests_id, levels.get("requests")), (tokens_id, levels.get("tokens"))):
+            if remaining is not None:
+                connection.execute(
+                    "INSERT INTO key_state (bucket, level, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT(bucket) DO UPDATE SET level = excluded.level, updated = excluded.updated",
+                    (bucket_id, remaining, now),
+                )
+        if cooldown_until is not None:
+            connection.execute(
+                "INSERT INTO key_state (bucket, level, updated, cooldown_until) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(bucket) DO UPDATE SET cooldown_until = excluded.cooldown_until",
+                (requests_id, state.requests.capacity, now, cooldown_until),
+            )
+
+
+def _update_shared_now(provider, state, levels, cooldown_until=None):
+    try:
+        _update_shared(provider, state, levels, cooldown_until)
+    except sqlite3.Error as e:
+        logger.error(f"Shared key state update failed: {e}")
+
+
+def _update_shared_in_background(provider, state, levels):
+    # release_key is synchronous, a level update doesn't need to hold up the response
+    try:
+        asyncio.get_running_loop().run_in_executor(None, _update_shared_now, provider, state, levels)
+    except RuntimeError:
+        _update_shared_now(provider, state, levels)
+
+
+async def acquire_key(provider, estimated_tokens, avoid=None):
+    keys, buckets, queue = _provider_state(provider)
+    if not keys:
+        raise Exception(f"No API key configured for {provider}, add {PROVIDER_KEY_PREFIX[provider]}1 to the .env file")
+
+    async with queue:
+        waiting = False
+        while True:
+            if KEY_STATE_DB:
+                try:
+                    state, wait = await asyncio.to_thread(_take_shared, provider, keys, buckets, estimated_tokens, avoid)
+                except sqlite3.Error as e:
+                    logger.error(f"Shared key state unavailable, using this worker's limits: {e}")
+                    state, wait = _take_local(keys, buckets, estimated_tokens, avoid)
+            else:
+                state, wait = _take_local(keys, buckets, estimated_tokens, avoid)
+            if state is not None:
+                state.in_flight += 1
+                return state
+
+            if not waiting:
+                logger.info(f"All {provider} keys are rate limited, queueing for about {wait:.2f}s")
+                waiting = True
+            await asyncio.sleep(min(wait, 1.0))
+
+
+def parse_reset_duration(value):
+    # "1s", "6m0s", "20ms", "1.5s" or plain seconds as sent in retry-after
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def release_key(state, status_code=None, headers=None):
+    state.in_flight = max(0, state.in_flight - 1)
+    headers = headers or {}
+    levels = {}
+
+    remaining_requests = headers.get("x-ratelimit-remaining-requests")
+    if remaining_requests is not None and remaining_requests.isdigit():
+        state.requests.sync(int(remaining_requests))
+        levels["requests"] = state.requests.level
+    remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+    if remaining_tokens is not None and remaining_tokens.isdigit():
+        state.tokens.sync(int(remaining_tokens))
+        levels["tokens"] = state.tokens.level
+    cooldown = None
+
+    if status_code == 429:
+        cooldown = (
+            parse_reset_duration(headers.get("retry-after"))
+            or max(
+                parse_reset_duration(headers.get("x-ratelimit-reset-requests")) or 0.0,
+                parse_reset_duration(headers.get("x-ratelimit-reset-tokens")) or 0.0,
+            )
+            or DEFAULT_THROTTLE_COOLDOWN
+        )
+        state.cooldown_until = time.monotonic() + cooldown
+        logger.warning(f"{state.name} was throttled, cooling down for {cooldown:.1f}s")
+    elif status_code in (401, 403):
+        cooldown = INVALID_KEY_COOLDOWN
+        state.cooldown_until = time.monotonic() + cooldown
+        logger.error(f"{state.name} was rejected with {status_code}, disabled for {INVALID_KEY_COOLDOWN:.0f}s")
+
+    if KEY_STATE_DB and cooldown is not None:
+        # Written before returning, so no worker takes the key again before it sees the cooldown
+        _update_shared_now(state.provider, state, levels, time.time() + cooldown)
+    elif KEY_STATE_DB and levels:
+        _update_shared_in_background(state.provider, state, levels)
+
+
+def key_stats():
+    stats = {}
+    for provider, keys in _keys.items():
+        now = time.monotonic()
+        stats[provider] = [
+            {
+                "key": state.name,
+                "in_flight": state.in_flight,
+                "requests_available": round(state.requests.level, 1),
+                "tokens_available": round(state.tokens.level),
+                "cooling_down_for": round(max(0.0, state.cooldown_until - now), 1),
+            }
+            for state in keys
+        ]
+    return stats
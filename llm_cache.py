@@ -0,0 +1,142 @@
+# llm_cache.py
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import asyncio
+import logging
+import contextvars
+from contextlib import closing
+from cachetools import TTLCache
+
+# In-memory LRU tier
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "512"))
+
+# Optional on-disk SQLite tier, e.g. LLM_CACHE_DB=instance/llm_cache.db. With more than one uvicorn worker
+# it is on by default, so that the workers share their cached completions.
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB") or ("instance/llm_cache.db" if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 else None)
+if LLM_CACHE_DB:
+    LLM_CACHE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), LLM_CACHE_DB)
+LLM_CACHE_DISK_MAX_ENTRIES = int(os.getenv("LLM_CACHE_DISK_MAX_ENTRIES", "10000"))
+
+logger = logging.getLogger(__name__)
+
+_memory_cache = TTLCache(maxsize=LLM_CACHE_MAX_ENTRIES, ttl=LLM_CACHE_TTL)
+_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+_disk_ready = False
+
+# Set to False for a request (e.g. a websocket message with "use_cache": false) to always call the model
+cache_enabled = contextvars.ContextVar("cache_enabled", default=True)
+
+
+def cache_key(model, messages, temperature):
+    payload = json.dumps({"model": model, "messages": messages, "temperature": temperature}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def should_use_cache(use_cache=None):
+    if not LLM_CACHE_ENABLED:
+        return False
+    return cache_enabled.get() if use_cache is None else use_cache
+
+
+def _connect():
+    global _disk_ready
+    if not _disk_ready:
+        os.makedirs(os.path.dirname(os.path.abspath(LLM_CACHE_DB)), exist_ok=True)
+    connection = sqlite3.connect(LLM_CACHE_DB, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    if not _disk_ready:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, completion TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed_at ON llm_cache (accessed_at)")
+        connection.commit()
+        _disk_ready = True
+    return connection
+
+
+def _disk_get(key):
+    now = time.time()
+    with closing(_connect()) as connection, connection:
+        row = connection.execute("SELECT completion, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        completion, created_at = row
+        if now - created_at > LLM_CACHE_TTL:
+            connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            return None
+        connection.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return completion
+
+
+def _disk_set(key, completion):
+    now = time.time()
+    with closing(_connect()) as connection, connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, completion, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, completion, now, now),
+        )
+        # Evict expired rows first, then the least recently used ones above the size cap
+        connection.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - LLM_CACHE_TTL,))
+        connection.execute(
+            "DELETE FROM llm_cache WHERE key IN ("
+            "SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (LLM_CACHE_DISK_MAX_ENTRIES,),
+        )
+
+
+async def get_cached_completion(key):
+    completion = _memory_cache.get(key)
+    if completion is not None:
+        _stats["memory_hits"] += 1
+        return completion
+
+    if LLM_CACHE_DB:
+        try:
+            completion = await asyncio.to_thread(_disk_get, key)
+        except sqlite3.Error as e:
+            logger.error(f"LLM cache read failed: {e}")
+            completion = None
+        if completion is not None:
+            _stats["disk_hits"] += 1
+            _memory_cache[key] = completion
+            return completion
+
+    _stats["misses"] += 1
+    return None
+
+
+async def store_completion(key, completion):
+    if not completion:
+        return
+    _memory_cache[key] = completion
+    _stats["stores"] += 1
+    if LLM_CACHE_DB:
+        try:
+            await asyncio.to_thread(_disk_set, key, completion)
+        except sqlite3.Error as e:
+            logger.error(f"LLM cache write failed: {e}")
+
+
+def cache_stats():
+    lookups = _stats["memory_hits"] + _stats["disk_hits"] + _stats["misses"]
+    hits = _stats["memory_hits"] + _stats["disk_hits"]
+    return {
+        **_stats,
+        "hit_rate": hits / lookups if lookups else 0.0,
+        "memory_entries": len(_memory_cache),
+        "disk_enabled": bool(LLM_CACHE_DB),
+    }
+
+
+def clear_cache():
+    _memory_cache.clear()
+    if LLM_CACHE_DB and os.path.exists(LLM_CACHE_DB):
+        with closing(_connect()) as connection, connection:
+            connection.execute("DELETE FROM llm_cache")
@@ -0,0 +1,142 @@
+# llm_client.py
+
+import os
+import json
+import logging
+import importlib.util
+from httpx import AsyncClient, Timeout, Limits
+
+from key_scheduler import acquire_key, release_key
+
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+LLAMA_URL = "https://api.groq.com/openai/v1/chat/completions"
+
+PROVIDER_URLS = {
+    "openai": OPENAI_URL,
+    "groq": LLAMA_URL,
+}
+
+# Pool limits, per provider. Override them in the .env file when running many sessions.
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_DEFAULT_TIMEOUT = float(os.getenv("LLM_DEFAULT_TIMEOUT", "100"))
+
+# HTTP/2 needs the optional h2 package (pip install "httpx[http2]"), fall back to HTTP/1.1 keep-alive without it
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+logger = logging.getLogger(__name__)
+
+# One long-lived client per provider, created lazily inside the running event loop
+_clients = {}
+
+
+class LLMError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def provider_for_model(model):
+    if model.startswith("llama3") or model == "mixtral-8x7b-32768":
+        return "groq"
+    return "openai"
+
+
+def get_client(provider):
+    client = _clients.get(provider)
+    if client is None or client.is_closed:
+        client = AsyncClient(
+            http2=LLM_HTTP2,
+            limits=Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=Timeout(LLM_DEFAULT_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+        _clients[provider] = client
+        logger.info(f"Opened {provider} connection pool (http2={LLM_HTTP2}, max_connections={LLM_MAX_CONNECTIONS})")
+    return client
+
+
+async def close_clients():
+    for provider, client in list(_clients.items()):
+        await client.aclose()
+        logger.info(f"Closed {provider} connection pool")
+    _clients.clear()
+
+
+def estimate_request_tokens(post_data):
+    # Rough prompt size plus room for the answer, only used to pace the per-key token buckets
+    prompt_chars = sum(len(message.get("content") or "") for message in post_data.get("messages", []))
+    return prompt_chars // 4 + post_data.get("max_tokens", 1000)
+
+
+async def post_chat_completion(model, post_data, headers, timeout=LLM_DEFAULT_TIMEOUT, used_keys=None):
+    # The Authorization header is always set here, from the least loaded healthy key of the provider.
+    # Keys named in used_keys are avoided when another one is ready, and the chosen key is added to it.
+    provider = provider_for_model(model)
+    client = get_client(provider)
+    key_state = await acquire_key(provider, estimate_request_tokens(post_data), avoid=used_keys)
+    if used_keys is not None:
+        used_keys.add(key_state.name)
+    headers["Authorization"] = f"Bearer {key_state.key}"
+    response = None
+    try:
+        response = await client.post(
+            PROVIDER_URLS[provider],
+            json=post_data,
+            headers=headers,
+            timeout=Timeout(timeout, connect=LLM_CONNECT_TIMEOUT),
+        )
+        return response
+    finally:
+        if response is None:
+            release_key(key_state)
+        else:
+            release_key(key_state, response.status_code, response.headers)
+
+
+async def stream_chat_completion(model, post_data, headers, timeout=LLM_DEFAULT_TIMEOUT, used_keys=None):
+    # Yields the content deltas of a `stream: true` completion as the provider sends its SSE events.
+    # used_keys works as in post_chat_completion.
+    provider = provider_for_model(model)
+    client = get_client(provider)
+    key_state = await acquire_key(provider, estimate_request_tokens(post_data), avoid=used_keys)
+    if used_keys is not None:
+        used_keys.add(key_state.name)
+    headers["Authorization"] = f"Bearer {key_state.key}"
+    status_code = None
+    response_headers = None
+    try:
+        async with client.stream(
+            "POST",
+            PROVIDER_URLS[provider],
+            json={**post_data, "stream": True},
+            headers=headers,
+            timeout=Timeout(timeout, connect=LLM_CONNECT_TIMEOUT),
+        ) as response:
+            status_code = response.status_code
+            response_headers = response.headers
+            if response.status_code != 200:
+                await response.aread()
+                logger.error(f"Streaming request failed with {response.status_code}: {response.text}")
+                raise LLMError("Failed to process the request with OpenAI", response.status_code)
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                chunk = json.loads(payload)
+                choices = chunk.get("choices") or []
+                if not choices:
+                    continue
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    yield delta
+    finally:
+        release_key(key_state, status_code, response_headers)
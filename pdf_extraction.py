@@ -0,0 +1,115 @@
+# pdf_extraction.py
+
+import os
+import asyncio
+import hashlib
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pdfplumber
+from cachetools import LRUCache
+
+from ingestion import UploadError
+
+logger = logging.getLogger(__name__)
+
+# Text extraction is CPU bound, it runs in worker processes so the event loop keeps serving requests
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Pages extracted per task, the pages of one document are spread over the workers in runs of this size
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+PDF_MAX_BYTES = int(os.getenv("PDF_MAX_BYTES", str(25 * 1024 * 1024)))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "300"))
+# Extracted texts kept by content hash, the same vision or MVP document is usually uploaded again and again
+PDF_CACHE_ENTRIES = int(os.getenv("PDF_CACHE_ENTRIES", "64"))
+
+_pool = None
+_text_cache = LRUCache(maxsize=PDF_CACHE_ENTRIES)
+
+
+def _page_count(path):
+    with pdfplumber.open(path) as pdf:
+        return len(pdf.pages)
+
+
+def _extract_pages(path, start, stop):
+    # Runs in a worker process. Each task opens the file itself, only the path and the texts are pickled.
+    with pdfplumber.open(path) as pdf:
+        return [page.extract_text() or "" for page in pdf.pages[start:stop]]
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn, forking a process that runs threads (the event loop's executors) can deadlock the child
+        _pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def _spool_to_disk(upload, max_bytes):
+    # Copies the upload to a temporary file for the workers and hashes it on the way
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        try:
+            while chunk := await upload.read(1024 * 1024):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadError(f"{upload.filename} is larger than {max_bytes // (1024 * 1024)} MB", status_code=413)
+                digest.update(chunk)
+                f.write(chunk)
+        except BaseException:
+            os.remove(f.name)
+            raise
+    return f.name, digest.hexdigest()
+
+
+async def _run_in_pool(function, *args):
+    global _pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_pool(), function, *args)
+    except BrokenProcessPool:
+        _pool = None  # a worker died (e.g. out of memory on a hostile file), the next call starts a new pool
+        raise
+
+
+async def extract_pdf_text(upload, max_bytes=PDF_MAX_BYTES, max_pages=PDF_MAX_PAGES):
+    # Text of an uploaded PDF, pages joined by newlines. Raises UploadError for files that are too big,
+    # have too many pages, can't be read or have no text layer.
+    if not (upload.filename or "").lower().endswith(".pdf"):
+        raise UploadError(f"{upload.filename} is not a PDF")
+    path, digest = await _spool_to_disk(upload, max_bytes)
+    try:
+        if digest in _text_cache:
+            logger.info(f"PDF text cache hit for {upload.filename}")
+            return _text_cache[digest]
+        try:
+            pages = await _run_in_pool(_page_count, path)
+            if pages > max_pages:
+                raise UploadError(f"{upload.filename} has {pages} pages, at most {max_pages} are accepted", status_code=413)
+            runs = await asyncio.gather(*(
+                _run_in_pool(_extract_pages, path, start, min(start + PDF_PAGES_PER_TASK, pages))
+                for start in range(0, pages, PDF_PAGES_PER_TASK)
+            ))
+        except UploadError:
+            raise
+        except Exception as e:  # pdfminer raises a range of its own errors for damaged files
+            raise UploadError(f"Could not read {upload.filename}: {e}")
+    finally:
+        os.remove(path)
+
+    text = "\n".join(page_text for run in runs for page_text in run if page_text)
+    if not text.strip():
+        raise UploadError(f"No text could be extracted from {upload.filename}, scanned PDFs are not supported", status_code=422)
+    _text_cache[digest] = text
+    logger.info(f"Extracted {len(text)} characters from {pages} pages of {upload.filename}")
+    return text
+
+
+async def close_pdf_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
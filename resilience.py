@@ -0,0 +1,264 @@
+# resilience.py
+
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+
+import httpx
+
+from llm_client import LLMError, LLM_DEFAULT_TIMEOUT, provider_for_model, post_chat_completion, stream_chat_completion
+
+logger = logging.getLogger(__name__)
+
+# Retries for throttled (429), overloaded (5xx) and dropped requests, with exponential backoff and full jitter
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "20"))
+# Wall-clock limit for one attempt, the httpx timeout alone only bounds the gap between two reads
+LLM_ATTEMPT_DEADLINE = float(os.getenv("LLM_ATTEMPT_DEADLINE", "120"))
+# Wall-clock limit until a stream's first delta, a stream that stalls before it is retried like a failed request
+LLM_FIRST_DELTA_DEADLINE = float(os.getenv("LLM_FIRST_DELTA_DEADLINE", "60"))
+
+# Hedging: when an attempt is slower than this percentile of recent completions (of first deltas for
+# streams), a duplicate is sent on another key and the first good response wins. Off by default, it costs tokens.
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "0") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LATENCY_WINDOW = 200
+
+# Circuit breaker: after this many consecutive failures a provider is skipped for the cooldown,
+# then a single trial request decides whether it is closed again
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = (httpx.TransportError, asyncio.TimeoutError)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+_latencies = {}
+_breakers = {}
+
+
+def _breaker(provider):
+    if provider not in _breakers:
+        _breakers[provider] = {"failures": 0, "opened_at": None, "trial_started": None}
+    return _breakers[provider]
+
+
+def check_breaker(provider):
+    breaker = _breaker(provider)
+    if breaker["opened_at"] is None:
+        return
+    now = time.monotonic()
+    remaining = breaker["opened_at"] + LLM_BREAKER_COOLDOWN - now
+    # A trial that never reported back (cancelled with its session) stops blocking after one attempt deadline
+    trial_running = breaker["trial_started"] is not None and now - breaker["trial_started"] < LLM_ATTEMPT_DEADLINE
+    if remaining > 0 or trial_running:
+        raise CircuitOpenError(f"{provider} is failing, requests are paused for {max(remaining, 0):.0f}s")
+    # Half open: let this request through as the trial
+    breaker["trial_started"] = now
+
+
+def record_success(provider):
+    breaker = _breaker(provider)
+    if breaker["opened_at"] is not None:
+        logger.info(f"{provider} circuit closed")
+    breaker.update(failures=0, opened_at=None, trial_started=None)
+
+
+def record_failure(provider):
+    breaker = _breaker(provider)
+    breaker["failures"] += 1
+    if breaker["failures"] >= LLM_BREAKER_THRESHOLD:
+        if breaker["opened_at"] is None or breaker["trial_started"] is not None:
+            logger.error(f"{provider} circuit opened after {breaker['failures']} consecutive failures")
+        breaker.update(opened_at=time.monotonic(), trial_started=None)
+
+
+def record_latency(provider, seconds):
+    _latencies.setdefault(provider, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+
+def hedge_delay(provider):
+    samples = _latencies.get(provider)
+    if not LLM_HEDGE_ENABLED or not samples or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * LLM_HEDGE_PERCENTILE / 100))
+    return ordered[index]
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+async def _timed_post(provider, model, post_data, headers, timeout, used_keys):
+    started = time.monotonic()
+    response = await asyncio.wait_for(
+        post_chat_completion(model, post_data, dict(headers), timeout=timeout, used_keys=used_keys),
+        LLM_ATTEMPT_DEADLINE,
+    )
+    if response.status_code == 200:
+        record_latency(provider, time.monotonic() - started)
+    return response
+
+
+async def _hedged_post(provider, model, post_data, headers, timeout):
+    # Each hedge shares used_keys, so the key scheduler places the duplicate on a different key when one is ready
+    used_keys = set()
+    primary = asyncio.ensure_future(_timed_post(provider, model, post_data, headers, timeout, used_keys))
+    delay = hedge_delay(provider)
+    if delay is None:
+        return await primary
+
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            logger.info(f"{provider} request slower than p{LLM_HEDGE_PERCENTILE:g} ({delay:.1f}s), sending a hedge")
+            pending.add(asyncio.ensure_future(_timed_post(provider, model, post_data, headers, timeout, used_keys)))
+
+        last = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                last = task
+                if task.exception() is None and task.result().status_code == 200:
+                    return task.result()
+        return last.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def post_with_retries(model, post_data, headers, timeout=LLM_DEFAULT_TIMEOUT):
+    # Returns the last response, so callers still see a non-retryable or final non-200 status
+    provider = provider_for_model(model)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        check_breaker(provider)
+        try:
+            response = await _hedged_post(provider, model, post_data, headers, timeout)
+        except RETRYABLE_ERRORS as e:
+            record_failure(provider)
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            reason = type(e).__name__
+        else:
+            if response.status_code not in RETRYABLE_STATUS:
+                record_success(provider)
+                return response
+            record_failure(provider)
+            if attempt == LLM_MAX_RETRIES:
+                return response
+            reason = f"status {response.status_code}"
+
+        delay = backoff_delay(attempt)
+        logger.warning(f"{provider} request failed ({reason}), retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+
+def _stream_latencies(provider):
+    # Streams are timed to their first delta, kept apart from the full completions of post requests
+    return f"{provider}:stream"
+
+
+async def _open_stream(provider, model, post_data, headers, timeout, used_keys):
+    # Starts a stream and waits for its first delta. Returns the delta (None for an empty stream) and the stream.
+    started = time.monotonic()
+    stream = stream_chat_completion(model, post_data, dict(headers), timeout=timeout, used_keys=used_keys)
+    try:
+        async with asyncio.timeout(LLM_FIRST_DELTA_DEADLINE):
+            first = await anext(stream)
+    except StopAsyncIteration:
+        return None, stream
+    except BaseException:
+        await stream.aclose()
+        raise
+    record_latency(_stream_latencies(provider), time.monotonic() - started)
+    return first, stream
+
+
+async def _hedged_stream(provider, model, post_data, headers, timeout):
+    # Same as _hedged_post, the first stream to deliver a delta wins and the other one is closed
+    used_keys = set()
+    delay = hedge_delay(_stream_latencies(provider))
+    if delay is None:
+        return await _open_stream(provider, model, post_data, headers, timeout, used_keys)
+
+    pending = {asyncio.ensure_future(_open_stream(provider, model, post_data, headers, timeout, used_keys))}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            logger.info(f"{provider} stream slower than p{LLM_HEDGE_PERCENTILE:g} ({delay:.1f}s) to start, sending a hedge")
+            pending.add(asyncio.ensure_future(_open_stream(provider, model, post_data, headers, timeout, used_keys)))
+
+        winner = last = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                last = task
+                if task.exception() is not None:
+                    continue
+                if winner is None:
+                    winner = task
+                else:
+                    await task.result()[1].aclose()
+            if winner is not None:
+                return winner.result()
+        return last.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def stream_with_retries(model, post_data, headers, timeout=LLM_DEFAULT_TIMEOUT):
+    # A stream can only be retried before its first delta, after that the client already shows partial text
+    provider = provider_for_model(model)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        check_breaker(provider)
+        started = False
+        stream = None
+        try:
+            first, stream = await _hedged_stream(provider, model, post_data, headers, timeout)
+            if first is not None:
+                started = True
+                yield first
+                async for delta in stream:
+                    yield delta
+            record_success(provider)
+            return
+        except (LLMError, *RETRYABLE_ERRORS) as e:
+            status_code = getattr(e, "status_code", None)
+            if isinstance(e, LLMError) and status_code not in RETRYABLE_STATUS:
+                record_success(provider)
+                raise
+            record_failure(provider)
+            if started or attempt == LLM_MAX_RETRIES:
+                raise
+            reason = f"status {status_code}" if status_code else type(e).__name__
+        finally:
+            if stream is not None:
+                await stream.aclose()
+
+        delay = backoff_delay(attempt)
+        logger.warning(f"{provider} stream failed ({reason}), retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+
+def resilience_stats():
+    return {
+        provider: {
+            "circuit": "open" if breaker["opened_at"] is not None else "closed",
+            "consecutive_failures": breaker["failures"],
+            "hedge_after": hedge_delay(provider),
+            "stream_hedge_after": hedge_delay(_stream_latencies(provider)),
+        }
+        for provider, breaker in _breakers.items()
+    }
@@ -0,0 +1,193 @@
+# scoring.py
+
+import os
+import json
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+WSJF_CRITERIA = ('BV', 'TC', 'RR/OE', 'JS')
+AHP_CRITERIA = ('BV', 'ER', 'D')
+
+# Saaty's random consistency index per matrix size
+RANDOM_INDEX = (0.0, 0.0, 0.0, 0.58, 0.90, 1.12, 1.24, 1.32, 1.41, 1.45, 1.49)
+CONSISTENCY_LIMIT = 0.1
+
+# Pairwise importance of BV, ER and D for AHP as a JSON matrix, e.g. [[1, 3, 5], [0.333, 1, 2], [0.2, 0.5, 1]].
+# The default weighs them equally, which gives the plain average the prompt describes.
+AHP_CRITERIA_PAIRWISE = os.getenv("AHP_CRITERIA_PAIRWISE")
+
+_default_ahp_weights = None
+
+
+def factor_matrix(rows, criteria, source=None):
+    # stories x criteria as float64, missing or non-numeric values are 0. source picks a nested dict per row.
+    matrix = np.zeros((len(rows), len(criteria)))
+    for i, row in enumerate(rows):
+        values = (row.get(source) or {}) if source else row
+        for j, criterion in enumerate(criteria):
+            try:
+                matrix[i, j] = float(values.get(criterion) or 0)
+            except (TypeError, ValueError):
+                pass
+    return matrix
+
+
+def wsjf_scores(matrix):
+    # (BV + TC + RR/OE) / JS, 0 where the job size is 0
+    value = matrix[:, :3].sum(axis=1)
+    job_size = matrix[:, 3]
+    return np.divide(value, job_size, out=np.zeros_like(value), where=job_size != 0)
+
+
+def weighted_scores(matrix, weights):
+    return matrix @ np.asarray(weights, dtype=float)
+
+
+def ahp_weights(pairwise):
+    # Criteria weights are the principal eigenvector of the pairwise comparison matrix,
+    # CR = ((lambda_max - n) / (n - 1)) / RI tells how consistent the judgments are
+    pairwise = np.asarray(pairwise, dtype=float)
+    n = pairwise.shape[0]
+    eigenvalues, eigenvectors = np.linalg.eig(pairwise)
+    principal = np.argmax(eigenvalues.real)
+    weights = np.abs(eigenvectors[:, principal].real)
+    weights = weights / weights.sum()
+    lambda_max = eigenvalues[principal].real
+    if n < 3:
+        return weights, 0.0
+    consistency_index = (lambda_max - n) / (n - 1)
+    random_index = RANDOM_INDEX[n] if n < len(RANDOM_INDEX) else RANDOM_INDEX[-1]
+    return weights, float(max(consistency_index, 0.0) / random_index)
+
+
+def default_ahp_weights():
+    global _default_ahp_weights
+    if _default_ahp_weights is None:
+        if AHP_CRITERIA_PAIRWISE:
+            weights, consistency_ratio = ahp_weights(json.loads(AHP_CRITERIA_PAIRWISE))
+            if consistency_ratio > CONSISTENCY_LIMIT:
+                logger.warning(f"AHP criteria judgments are inconsistent (CR={consistency_ratio:.3f} > {CONSISTENCY_LIMIT})")
+        else:
+            weights = np.full(len(AHP_CRITERIA), 1 / len(AHP_CRITERIA))
+        _default_ahp_weights = weights
+    return _default_ahp_weights
+
+
+def ahp_scores(matrix, weights=None):
+    return weighted_scores(matrix, default_ahp_weights() if weights is None else weights)
+
+
+def rank_order(scores, descending=True):
+    # Stable, so stories with equal scores keep their backlog order
+    scores = np.asarray(scores, dtype=float)
+    return np.argsort(-scores if descending else scores, kind="stable")
+
+
+def comparison_pairs(n):
+    # Sparse design for pairwise AHP over n items: item i is compared with i + 1, i + 2, i + 4, ... (mod n).
+    # That's about n * log2(n) pairs instead of n * (n - 1) / 2, every item takes part in about 2 * log2(n)
+    # of them and any two items are linked by a chain of at most log2(n) judgments.
+    pairs = set()
+    offset = 1
+    while offset < n:
+        for i in range(n):
+            j = (i + offset) % n
+            pairs.add((min(i, j), max(i, j)))
+        offset *= 2
+    return sorted(pairs)
+
+
+def principal_eigenvector(matrix, tolerance=1e-10, max_iterations=1000):
+    # Power iteration, the comparison matrices are positive on the diagonal so it converges to the Perron vector
+    n = matrix.shape[0]
+    weights = np.full(n, 1 / n)
+    for _ in range(max_iterations):
+        product = matrix @ weights
+        updated = product / product.sum()
+        if np.abs(updated - weights).max() < tolerance:
+            weights = updated
+            break
+        weights = updated
+    lambda_max = float((matrix @ weights).sum() / weights.sum())
+    return weights, lambda_max
+
+
+def judgment_components(n, judgments):
+    # Groups of items linked by chains of judgments, union-find as in dedup.find_duplicate_clusters.
+    # Items in different groups were never compared, directly or indirectly.
+    parent = list(range(n))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j, _ in judgments:
+        parent[max(root(i), root(j))] = min(root(i), root(j))
+    components = {}
+    for i in range(n):
+        components.setdefault(root(i), []).append(i)
+    return list(components.values())
+
+
+def incomplete_pairwise_weights(n, judgments):
+    # Harker's method for an incomplete pairwise matrix: judgments are (i, j, a_ij) with a_ij > 1 when i is
+    # preferred, unknown entries stay 0 and each diagonal entry is 1 + the number of unknowns in its row.
+    # Returns the priority vector (sums to 1) and the consistency ratio.
+    if n <= 1:
+        return np.ones(n), 0.0  # an empty backlog or a single story, nothing to compare
+    if len(judgment_components(n, judgments)) > 1:
+        # Each group would be scaled on its own, the weights across groups wouldn't mean anything
+        raise ValueError("The judgments don't connect all items")
+    matrix = np.zeros((n, n))
+    for i, j, value in judgments:
+        matrix[i, j] = value
+        matrix[j, i] = 1 / value
+    known = np.count_nonzero(matrix, axis=1)
+    np.fill_diagonal(matrix, 1 + (n - 1 - known))
+    weights, lambda_max = principal_eigenvector(matrix)
+    if n < 3:
+        return weights, 0.0
+    consistency_index = (lambda_max - n) / (n - 1)
+    random_index = RANDOM_INDEX[n] if n < len(RANDOM_INDEX) else RANDOM_INDEX[-1]
+    return weights, float(max(consistency_index, 0.0) / random_index)
+
+
+def average_ranks(scores):
+    # Rank 1 is the highest score, stories with equal scores share the mean of their positions
+    scores = np.asarray(scores, dtype=float)
+    n = len(scores)
+    order = rank_order(scores)
+    sorted_scores = scores[order]
+    group = np.concatenate(([0], np.cumsum(sorted_scores[1:] != sorted_scores[:-1])))
+    mean_position = np.bincount(group, weights=np.arange(1, n + 1)) / np.bincount(group)
+    ranks = np.empty(n)
+    ranks[order] = mean_position[group]
+    return ranks
+
+
+def spearman_matrix(ranks):
+    # ranks: stories x techniques of average ranks, Spearman's rho is the Pearson correlation of the ranks.
+    # A technique that ranks every story the same has no correlation, those entries are nan.
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.atleast_2d(np.corrcoef(ranks, rowvar=False))
+
+
+def kendall_w(ranks):
+    # Kendall's coefficient of concordance for m techniques ranking n stories, with the correction for ties:
+    # W = 12 S / (m^2 (n^3 - n) - m sum(t^3 - t)), 1 when all techniques agree and 0 when they don't at all
+    n, m = ranks.shape
+    if n < 2 or m < 2:
+        return 1.0
+    totals = ranks.sum(axis=1)
+    s = float(((totals - totals.mean()) ** 2).sum())
+    ties = 0.0
+    for column in ranks.T:
+        _, counts = np.unique(column, return_counts=True)
+        ties += float((counts ** 3 - counts).sum())
+    denominator = m ** 2 * (n ** 3 - n) - m * ties
+    return 12 * s / denominator if denominator > 0 else 1.0
@@ -0,0 +1,340 @@
+# session_store.py
+
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+from contextlib import closing
+
+from incremental import story_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Sessions, stories, agent turns, factors and rankings, so a client that reconnects gets its results back
+SESSION_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv("SESSION_DB", "instance/sessions.db"))
+SESSION_STORE_ENABLED = os.getenv("SESSION_STORE_ENABLED", "1") == "1"
+# Job status is how uvicorn workers see each other's jobs, with several of them it is stored even without sessions
+JOB_STORE_ENABLED = SESSION_STORE_ENABLED or int(os.getenv("WEB_CONCURRENCY", "1")) > 1
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 86400)))
+# Writes of concurrent sessions that queue up together are committed in one transaction, up to this many
+SESSION_WRITE_BATCH = int(os.getenv("SESSION_WRITE_BATCH", "200"))
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS sessions ("
+    "id TEXT PRIMARY KEY, technique TEXT, model TEXT, feedback TEXT NOT NULL DEFAULT '[]', "
+    "status TEXT NOT NULL DEFAULT 'created', created_at REAL NOT NULL, updated_at REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS stories ("
+    "session_id TEXT NOT NULL, story_key TEXT NOT NULL, position INTEGER NOT NULL, fingerprint TEXT NOT NULL, "
+    "data TEXT NOT NULL, PRIMARY KEY (session_id, story_key))",
+    "CREATE TABLE IF NOT EXISTS turns ("
+    "session_id TEXT NOT NULL, agent TEXT NOT NULL, content TEXT NOT NULL, created_at REAL NOT NULL, "
+    "PRIMARY KEY (session_id, agent))",
+    "CREATE TABLE IF NOT EXISTS factors ("
+    "session_id TEXT NOT NULL, story_key TEXT NOT NULL, technique TEXT NOT NULL, data TEXT NOT NULL, "
+    "PRIMARY KEY (session_id, technique, story_key))",
+    "CREATE TABLE IF NOT EXISTS rankings ("
+    "session_id TEXT NOT NULL, technique TEXT NOT NULL, position INTEGER NOT NULL, story_key TEXT NOT NULL, "
+    "PRIMARY KEY (session_id, technique, position))",
+    "CREATE TABLE IF NOT EXISTS jobs ("
+    "id TEXT PRIMARY KEY, session_id TEXT, summary TEXT NOT NULL, status TEXT NOT NULL, "
+    "cancel_requested INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions (updated_at)",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_updated_at ON jobs (updated_at)",
+    "CREATE INDEX IF NOT EXISTS idx_stories_story_key ON stories (story_key)",
+    "CREATE INDEX IF NOT EXISTS idx_factors_story_key ON factors (session_id, story_key)",
+)
+
+_schema_ready = False
+_write_queue = None
+_writer_task = None
+_job_lock = None
+
+
+def _connect():
+    global _schema_ready
+    if not _schema_ready:
+        os.makedirs(os.path.dirname(SESSION_DB), exist_ok=True)
+    connection = sqlite3.connect(SESSION_DB, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    if not _schema_ready:
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+        _schema_ready = True
+    return connection
+
+
+def _apply_writes(batch):
+    # One transaction for everything that queued up since the last commit. Each queued write gets its own
+    # savepoint, so a write that fails is rolled back alone and the other sessions' writes still commit.
+    # Returns the error of every write, None where it succeeded.
+    errors = []
+    with closing(_connect()) as connection:
+        connection.execute("BEGIN")
+        try:
+            for statements in batch:
+                connection.execute("SAVEPOINT queued_write")
+                try:
+                    for sql, rows in statements:
+                        connection.executemany(sql, rows)
+                    errors.append(None)
+                except sqlite3.Error as e:
+                    connection.execute("ROLLBACK TO queued_write")
+                    errors.append(e)
+                connection.execute("RELEASE queued_write")
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+    return errors
+
+
+async def _writer():
+    while True:
+        batch = [await _write_queue.get()]
+        while len(batch) < SESSION_WRITE_BATCH and not _write_queue.empty():
+            batch.append(_write_queue.get_nowait())
+        try:
+            errors = await asyncio.to_thread(_apply_writes, [statements for _, statements, _ in batch])
+        except sqlite3.Error as e:
+            logger.error(f"Session store commit failed: {e}")
+            errors = [e] * len(batch)
+        else:
+            for (owner_id, _, _), error in zip(batch, errors):
+                if error is not None:
+                    logger.error(f"Session store write for {owner_id} failed: {error}")
+        for (_, _, done), error in zip(batch, errors):
+            if done.done():
+                continue
+            if error:
+                done.set_exception(error)
+            else:
+                done.set_result(None)
+
+
+async def _write(owner_id, statements):
+    # statements: [(sql, [params, ...]), ...], applied in order once the writer commits them.
+    # Runs without a session or job (owner_id None) aren't stored. Returns the error of this write, if any,
+    # a session that can't be saved still runs.
+    global _write_queue, _writer_task
+    if not SESSION_STORE_ENABLED or owner_id is None:
+        return None
+    if _writer_task is None or _writer_task.done():
+        _write_queue = asyncio.Queue()
+        _writer_task = asyncio.ensure_future(_writer())
+    done = asyncio.get_running_loop().create_future()
+    await _write_queue.put((owner_id, statements, done))
+    try:
+        await done
+    except sqlite3.Error as e:
+        return e
+    return None
+
+
+def _touch(session_id, now, **fields):
+    columns = ", ".join(f"{column} = ?" for column in fields)
+    assignments = f"{columns}, updated_at = ?" if columns else "updated_at = ?"
+    return (
+        f"UPDATE sessions SET {assignments} WHERE id = ?",
+        [(*fields.values(), now, session_id)],
+    )
+
+
+async def create_session(session_id):
+    now = time.time()
+    return await _write(session_id, [(
+        "INSERT OR IGNORE INTO sessions (id, created_at, updated_at) VALUES (?, ?, ?)",
+        [(session_id, now, now)],
+    )])
+
+
+async def save_run_start(session_id, technique, model, stories, feedback_lines, keep_turns=False):
+    # A new run replaces the stories and turns of the previous one, an incremental run keeps the turns it reuses
+    now = time.time()
+    statements = [
+        _touch(session_id, now, technique=technique, model=model, feedback=json.dumps(feedback_lines), status="running"),
+        ("DELETE FROM stories WHERE session_id = ?", [(session_id,)]),
+    ]
+    if not keep_turns:
+        statements.append(("DELETE FROM turns WHERE session_id = ?", [(session_id,)]))
+    return await _write(session_id, statements + [
+        (
+            "INSERT INTO stories (session_id, story_key, position, fingerprint, data) VALUES (?, ?, ?, ?, ?)",
+            [
+                (session_id, str(story['key']), position, story_fingerprint(story), json.dumps(story))
+                for position, story in enumerate(stories)
+            ],
+        ),
+    ])
+
+
+async def save_turn(session_id, agent, content):
+    now = time.time()
+    return await _write(session_id, [
+        (
+            "INSERT OR REPLACE INTO turns (session_id, agent, content, created_at) VALUES (?, ?, ?, ?)",
+            [(session_id, agent, content if isinstance(content, str) else json.dumps(content), now)],
+        ),
+        _touch(session_id, now),
+    ])
+
+
+async def save_results(session_id, technique, results, status="done"):
+    # results are the enriched stories in ranked order, the technique's factors are part of each one
+    now = time.time()
+    return await _write(session_id, [
+        ("DELETE FROM factors WHERE session_id = ? AND technique = ?", [(session_id, technique)]),
+        ("DELETE FROM rankings WHERE session_id = ? AND technique = ?", [(session_id, technique)]),
+        (
+            "INSERT INTO factors (session_id, story_key, technique, data) VALUES (?, ?, ?, ?)",
+            [(session_id, str(story['key']), technique, json.dumps(story)) for story in results],
+        ),
+        (
+            "INSERT INTO rankings (session_id, technique, position, story_key) VALUES (?, ?, ?, ?)",
+            [(session_id, technique, position, str(story['key'])) for position, story in enumerate(results)],
+        ),
+        _touch(session_id, now, status=status),
+    ])
+
+
+async def save_status(session_id, status):
+    return await _write(session_id, [_touch(session_id, time.time(), status=status)])
+
+
+def _load_session(session_id):
+    with closing(_connect()) as connection:
+        row = connection.execute(
+            "SELECT technique, model, feedback, status, updated_at FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        if row is None or time.time() - row[4] > SESSION_TTL:
+            return None
+        technique, model, feedback, status, _ = row
+        stories = [
+            json.loads(data) for (data,) in connection.execute(
+                "SELECT data FROM stories WHERE session_id = ? ORDER BY position", (session_id,)
+            )
+        ]
+        turns = dict(connection.execute("SELECT agent, content FROM turns WHERE session_id = ?", (session_id,)).fetchall())
+        results = [
+            json.loads(data) for (data,) in connection.execute(
+                "SELECT f.data FROM rankings r JOIN factors f "
+                "ON f.session_id = r.session_id AND f.technique = r.technique AND f.story_key = r.story_key "
+                "WHERE r.session_id = ? AND r.technique = ? ORDER BY r.position",
+                (session_id, technique),
+            )
+        ]
+    return {
+        "technique": technique,
+        "model": model,
+        "feedback": json.loads(feedback),
+        "status": status,
+        "stories": stories,
+        "turns": turns,
+        "results": results,
+    }
+
+
+async def load_session(session_id):
+    if not SESSION_STORE_ENABLED or not os.path.exists(SESSION_DB):
+        return None
+    try:
+        return await asyncio.to_thread(_load_session, session_id)
+    except sqlite3.Error as e:
+        logger.error(f"Session store read failed: {e}")
+        return None
+
+
+# Jobs, so that any worker process can answer status and cancel requests for them
+
+def _apply_now(statements):
+    with closing(_connect()) as connection, connection:
+        for sql, rows in statements:
+            connection.executemany(sql, rows)
+
+
+async def _write_job(statements):
+    # Job status doesn't wait in the session write queue: each change is committed on its own, in the order the
+    # changes were made, so other workers see it right away and a failing session write can't take it along
+    global _job_lock
+    if not JOB_STORE_ENABLED:
+        return None
+    if _job_lock is None:
+        _job_lock = asyncio.Lock()
+    async with _job_lock:
+        try:
+            await asyncio.to_thread(_apply_now, statements)
+        except sqlite3.Error as e:
+            logger.error(f"Job store write failed: {e}")
+            return e
+    return None
+
+
+async def save_job(summary):
+    # Everything but the cancel flag, which another worker may have set in the meantime
+    return await _write_job([(
+        "INSERT INTO jobs (id, session_id, summary, status, updated_at) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET summary = excluded.summary, status = excluded.status, updated_at = excluded.updated_at",
+        [(summary["job_id"], summary["session_id"], json.dumps(summary), summary["status"], time.time())],
+    )])
+
+
+async def _read(query, params=(), enabled=SESSION_STORE_ENABLED):
+    if not enabled or not os.path.exists(SESSION_DB):
+        return None
+
+    def read():
+        with closing(_connect()) as connection:
+            return connection.execute(query, params).fetchone()
+    try:
+        return await asyncio.to_thread(read)
+    except sqlite3.Error as e:
+        logger.error(f"Session store read failed: {e}")
+        return None
+
+
+async def load_job(job_id):
+    row = await _read("SELECT summary FROM jobs WHERE id = ?", (job_id,), JOB_STORE_ENABLED)
+    return json.loads(row[0]) if row else None
+
+
+async def request_job_cancel(job_id):
+    # Picked up by the worker process that runs the job
+    return await _write_job([("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", [(job_id,)])])
+
+
+async def job_cancel_requested(job_id):
+    row = await _read("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,), JOB_STORE_ENABLED)
+    return bool(row and row[0])
+
+
+def _delete_expired():
+    with closing(_connect()) as connection, connection:
+        expired = [row[0] for row in connection.execute(
+            "SELECT id FROM sessions WHERE updated_at < ?", (time.time() - SESSION_TTL,)
+        )]
+        for table in ("stories", "turns", "factors", "rankings"):
+            connection.executemany(f"DELETE FROM {table} WHERE session_id = ?", [(session_id,) for session_id in expired])
+        connection.executemany("DELETE FROM sessions WHERE id = ?", [(session_id,) for session_id in expired])
+        connection.execute("DELETE FROM jobs WHERE updated_at < ?", (time.time() - SESSION_TTL,))
+    return len(expired)
+
+
+async def delete_expired_sessions():
+    if not JOB_STORE_ENABLED or not os.path.exists(SESSION_DB):
+        return 0
+    try:
+        return await asyncio.to_thread(_delete_expired)
+    except sqlite3.Error as e:
+        logger.error(f"Session store cleanup failed: {e}")
+        return 0
+
+
+async def close_session_store():
+    global _writer_task
+    if _writer_task is not None:
+        # Every _write waits for its commit, so nothing is left in the queue once requests are done
+        _writer_task.cancel()
+        _writer_task = None
@@ -12,6 +12,7 @@ import {
   moscowColumns,
   kanoColumns,
   ahpColumns,
+  multiTechniqueColumns,
   frameworkColumns,
 } from "./columns"; // Import the necessary columns
 import TextArea from "antd/es/input/TextArea";
@@ -33,6 +34,7 @@ import {
   getChatMessageClass,
   handleSuccessResponse,
   labelOptions,
+  readNdjson,
 } from "./utilityFunctions";
 
 const WS_URL = "ws://localhost:8000/api/ws-chat";
@@ -55,13 +57,18 @@ function App() {
   const [selectType, setSelectType] = useState("file");
   const [type, setType] = useState("textbox");
 
-  const [prioritizationTechnique, setPrioritizationTechnique] =
-    useState("100_Dollar");
+  // One technique, or several to compare in one run
+  const [prioritizationTechnique, setPrioritizationTechnique] = useState([
+    "100_DOLLAR",
+  ]);
   const [selectModel, setSelectModel] = useState("gpt-4o-mini");
   const [frameWork, setFromWork] = useState("INVEST framework");
   const [result1, setResult1] = useState([]);
   const [frameWorkResult, setFrameWorkResult] = useState([]);
   const [selectedFile, setSelectedFile] = useState(null);
+  // Sheet and columns the server imported, and the user's choices for the next upload
+  const [uploadInfo, setUploadInfo] = useState(null);
+  const [uploadOptions, setUploadOptions] = useState({});
   const [visionFile, setVisionFile] = useState(null);
   const [mvpFile, setMvpFile] = useState(null);
   // const [fileInput, setFileInput] = useState({
@@ -70,6 +77,7 @@ function App() {
   // });
   const [finalTableData, setFinalTableData] = useState([]);
   const [finalPrioritizationType, setFinalPrioritizationType] = useState("");
+  const [finalTechniques, setFinalTechniques] = useState([]);
   const chatContainerRef = useRef(null);
   const [messageQueue, setMessageQueue] = useState([]);
   const [isDisplayingMessage, setIsDisplayingMessage] = useState(false);
@@ -80,6 +88,9 @@ function App() {
     "Final Prioritization": [],
   });
   const textAreaRefs = useRef({});
+  // Stored session on the server, resumed when the socket reconnects or the page is reloaded
+  const sessionIdRef = useRef(sessionStorage.getItem("sessionId"));
+  const replayedRef = useRef(false);
   const handleModel = (value) => {
     setSelectModel(value);
   };
@@ -91,6 +102,26 @@ function App() {
   };
   const [messageSequence, setMessageSequence] = useState([]);
   const [totalMessageData, setTotalMessageData] = useState("");
+  const appendStreamDelta = (agentType, delta, completed) => {
+    setMessageSequence((prevSequence) => {
+      const lastMessageIndex = prevSequence.findIndex(
+        (msg) => msg.agentType === agentType && !msg.completed
+      );
+      if (lastMessageIndex > -1) {
+        const updatedSequence = [...prevSequence];
+        updatedSequence[lastMessageIndex] = {
+          ...updatedSequence[lastMessageIndex],
+          message: updatedSequence[lastMessageIndex].message + delta,
+          completed,
+        };
+        return updatedSequence;
+      }
+      if (completed) {
+        return prevSequence;
+      }
+      return [...prevSequence, { agentType, message: delta, completed: false }];
+    });
+  };
   useEffect(() => {
     const connectWebSocket = () => {
       const socket = new WebSocket(WS_URL);
@@ -98,9 +129,46 @@ function App() {
         console.log("event data:", event.data);
         const data = JSON.parse(event.data);
 
+        if (data.agentType === "session") {
+          sessionIdRef.current = data.session_id;
+          sessionStorage.setItem("sessionId", data.session_id);
+          return;
+        }
+
+        // Runs are queued as jobs on the server, their status frames carry no chat text
+        if (data.agentType === "job") {
+          if (data.status === "rejected" || data.status === "failed") {
+            notification.error({
+              message: data.error || "Prioritization failed",
+            });
+            setLoading(false);
+          }
+          return;
+        }
+
+        // Near-duplicate stories the server found, or merged before the run
+        if (data.agentType === "duplicates") {
+          notification.info({
+            message: data.merged ? "Near-duplicate stories merged" : "Possible duplicate stories",
+            description: data.message,
+          });
+          return;
+        }
+
         if (data.agentType === "Final_output_into_table") {
           setFinalTableData(data.message);
           setFinalPrioritizationType(data.prioritization_type);
+          setFinalTechniques(data.techniques || []);
+        }
+
+        // Token deltas of a streamed agent message are appended as they arrive
+        if (data.stream) {
+          appendStreamDelta(data.agentType, data.message, data.stream === "end");
+          if (data.message.length > 0) {
+            setTotalMessageData((prvMessage) => prvMessage + data.message);
+          }
+          setLoading(false);
+          return;
         }
 
         if (data.message.trim().length > 0) {
@@ -115,6 +183,13 @@ function App() {
       socket.onopen = () => {
         console.log("WebSocket connected");
         setLoading(false);
+        if (sessionIdRef.current) {
+          // Only a reloaded page needs the earlier messages sent again
+          socket.send(
+            JSON.stringify({ resume: sessionIdRef.current, replay: !replayedRef.current })
+          );
+        }
+        replayedRef.current = true;
       };
       socket.onmessage = handleMessage;
       socket.onerror = (error) => {
@@ -257,6 +332,36 @@ function App() {
     setVisionFile(e.target.files[0])
   }
 
+  // Stories arrive epic by epic and are shown as they come, the last event has the final keyed list
+  const receiveGeneratedStories = async (response) => {
+    const epics = [];
+    let final = null;
+    await readNdjson(response, (event) => {
+      if (event.error) {
+        throw new Error(event.error);
+      }
+      if (event.stories) {
+        epics[event.epic_index] = event.stories;
+        setResult1(addKeyToResponse(epics.filter(Boolean).flat()));
+        setLoading(false);
+      }
+      if (event.stories_with_epics) {
+        final = event;
+      }
+    });
+    if (!final) {
+      // The stream broke off, keep the epics already shown instead of replacing them with nothing
+      throw new Error("Story generation stopped before it finished, the stories shown are incomplete");
+    }
+    if (final.failed_epics?.length) {
+      notification.warning({
+        message: "Some epics have no stories",
+        description: `Generation failed for: ${final.failed_epics.join(", ")}`,
+      });
+    }
+    return final.stories_with_epics;
+  };
+
   const handleGenerateStoriesByFiles = async (e) => {
     e.preventDefault();
     console.log(visionFile);
@@ -276,6 +381,7 @@ function App() {
       
       // Append the selected model
       formData.append('model', selectModel); // 'model' should match the Form field in the backend
+      formData.append('stream', 'true');
   
       const response = await fetch("/api/generate-user-stories-by-files", {
         method: "POST",
@@ -283,12 +389,11 @@ function App() {
       });
   
       if (!response.ok) {
-        throw new Error("Failed to generate stories");
+        const message = await response.json();
+        throw new Error(message.error || "Failed to generate stories");
       }
-  
-      const message = await response.json();
       
-      let dataResponse = message.stories_with_epics.map((i, index) => ({
+      let dataResponse = (await receiveGeneratedStories(response)).map((i, index) => ({
         ...i,
         key: index,
       }));
@@ -306,6 +411,7 @@ function App() {
       setLoading(false);
       notification.error({
         message: "Internal Server Error",
+        description: error.message,
       });
     }
   };
@@ -331,14 +437,14 @@ function App() {
           vision: textBox.vision,
           mvp: textBox.mvp,
           model: selectModel,
+          stream: true,
         }),
       });
       if (!response.ok) {
         throw new Error("Response");
       }
-      const message = await response.json();
       // console.log(message);
-      let dataResponse = message.stories_with_epics.map((i, index) => ({
+      let dataResponse = (await receiveGeneratedStories(response)).map((i, index) => ({
         ...i,
         key: index,
       }));
@@ -353,27 +459,45 @@ function App() {
       setLoading(false);
       notification.error({
         message: "Internal Server Error",
+        description: error.message,
       });
     }
   };
-  const handleFileUpload = async (file) => {
+  const handleFileUpload = async (options = {}) => {
     // console.log(selectedFile);
     try {
       setLoading(true);
       const formData = new FormData();
       formData.append("file", selectedFile);
-      const response = await fetch("/api/upload-csv", {
+      const query = new URLSearchParams(options).toString();
+      const response = await fetch(`/api/upload-csv${query ? `?${query}` : ""}`, {
         method: "POST",
         body: formData,
       });
       if (!response.ok) {
-        throw new Error("Failed to upload file");
+        const data = await response.json();
+        throw new Error(data.error || "Failed to upload file");
+      }
+      // The stories arrive in batches (NDJSON), the last line says which sheet and columns were used
+      const stories = [];
+      let info = null;
+      await readNdjson(response, (event) => {
+        if (event.error) {
+          throw new Error(event.error);
+        }
+        if (event.stories) {
+          stories.push(...event.stories);
+        }
+        if (event.done) {
+          info = event;
+        }
+      });
+      if (!info) {
+        throw new Error("The upload stopped before all stories were read");
       }
-      const data = await response.json();
-      // console.log(data);
-      const responseDataWithKeys = addKeyToResponse(data.stories_with_epics);
-      // console.log("Uploaded file data:", responseDataWithKeys); // Log the transformed data
-      setResult1(responseDataWithKeys);
+      setUploadInfo(info);
+      setUploadOptions(options);
+      setResult1(addKeyToResponse(stories));
       setLoading(false);
       notification.success({
         message: "File uploaded successfully",
@@ -383,6 +507,7 @@ function App() {
       setLoading(false);
       notification.error({
         message: "Error uploading file",
+        description: error.message,
       });
     }
   };
@@ -431,7 +556,10 @@ function App() {
         JSON.stringify({
           stories: result1,
           model: selectModel,
-          prioritization_type: prioritizationTechnique,
+          prioritization_type:
+            prioritizationTechnique.length === 1
+              ? prioritizationTechnique[0]
+              : prioritizationTechnique,
           feedback: feedback
         })
       );
@@ -444,7 +572,7 @@ function App() {
     setLoading(true);
     sendInput();
     setTotalMessageData("");
-    handleSuccessResponse(prioritizationTechnique, selectModel);
+    handleSuccessResponse(prioritizationTechnique.join(", "), selectModel);
     notification.success({
       message: "Successfully ",
     });
@@ -453,7 +581,7 @@ function App() {
   const renderChatMessages = () => {
     const agentMessages = messageSequence.reduce((acc, entry) => {
       const { agentType, message } = entry;
-      if (agentType !== "Final Prioritization" && agentType !== "error") {
+      if (!agentType.startsWith("Final Prioritization") && agentType !== "error") {
         if (!acc[agentType]) {
           acc[agentType] = [];
         }
@@ -464,7 +592,7 @@ function App() {
 
     let finalMessage = messageSequence.reduce((acc, entry) => {
       const { agentType, message } = entry;
-      if (agentType === "Final Prioritization") {
+      if (agentType.startsWith("Final Prioritization")) {
         if (!acc[agentType]) {
           acc[agentType] = [];
         }
@@ -605,7 +733,9 @@ function App() {
                     : finalPrioritizationType === "KANO"
                     ? kanoColumns
                     : finalPrioritizationType === "AHP"
-                    ? ahpColumns
+                    ? ahpColumns(finalTableData)
+                    : finalPrioritizationType === "MULTI"
+                    ? multiTechniqueColumns(finalTechniques)
                     : ""
                 }
                 pagination={false}
@@ -893,6 +1023,7 @@ function App() {
                               <Input
                                 type="file"
                                 name="vision"
+                                accept=".pdf"
                                 onChange={handleVisionFileChange}
                               />
                             </Form.Item>
@@ -903,6 +1034,7 @@ function App() {
                               <Input
                                 type="file"
                                 name="mvp"
+                                accept=".pdf"
                                 onChange={handleMvpFileChange}
                               />
                             </Form.Item>
@@ -956,6 +1088,7 @@ function App() {
                       style={{
                         display: "flex",
                         alignItems: "center",
+                        flexWrap: "wrap",
                         width: "81%",
                         border: "1px solid #ccc",
                         paddingRight: 15,
@@ -978,7 +1111,11 @@ function App() {
                         >
                           <Input
                             type="file"
-                            onChange={(e) => setSelectedFile(e.target.files[0])}
+                            accept=".csv,.xlsx"
+                            onChange={(e) => {
+                              setSelectedFile(e.target.files[0]);
+                              setUploadInfo(null);
+                            }}
                           />
                         </Form.Item>
                         <Form.Item style={{ marginBottom: "-4px" }}>
@@ -993,6 +1130,35 @@ function App() {
                           </Button>
                         </Form.Item>
                       </Form>
+                      {uploadInfo && (
+                        <Form layout="vertical" style={{ width: "100%", display: "flex", gap: "5px" }}>
+                          {uploadInfo.sheets && (
+                            <Form.Item label="Sheet" style={{ flex: 1 }}>
+                              <Select
+                                value={uploadInfo.sheet}
+                                options={uploadInfo.sheets.map((sheet) => ({ value: sheet, label: sheet }))}
+                                // Columns of another sheet may not exist in this one
+                                onChange={(sheet) => handleFileUpload({ sheet })}
+                              />
+                            </Form.Item>
+                          )}
+                          {[
+                            ["user_story", "User Story Column"],
+                            ["epic", "Epic Column"],
+                            ["description", "Description Column"],
+                          ].map(([field, label]) => (
+                            <Form.Item key={field} label={label} style={{ flex: 1 }}>
+                              <Select
+                                value={uploadInfo.columns[field]}
+                                options={uploadInfo.header.map((name) => ({ value: name, label: name }))}
+                                onChange={(name) =>
+                                  handleFileUpload({ ...uploadOptions, [`${field}_column`]: name })
+                                }
+                              />
+                            </Form.Item>
+                          ))}
+                        </Form>
+                      )}
                     </div>
                   )}
                 </div>
@@ -1207,6 +1373,7 @@ function App() {
 
                       <Form.Item label="Prioritization Technique">
                         <Select
+                          mode="multiple"
                           placeholder="Select Technique"
                           optionFilterProp="children"
                           onChange={handleLanguage}
@@ -1249,7 +1416,7 @@ function App() {
                           type="primary"
                           icon={<SearchOutlined />}
                           onClick={handleSubmit}
-                          disabled={prioritizationTechnique === null}
+                          disabled={prioritizationTechnique.length === 0}
                         >
                           Generate
                         </Button>
@@ -304,22 +304,8 @@ export const kanoColumns = [
   },
 ];
 
-export const ahpColumns = [
-  {
-    title: "Epic",
-    dataIndex: "epic",
-    key: "epic",
-  },
-  {
-    title: "User Story",
-    dataIndex: "user_story",
-    key: "user_story",
-  },
-  {
-    title: "Description",
-    dataIndex: "description",
-    key: "description",
-  },
+// AHP_METHOD=scores fills BV/ER/D per story, the default pairwise method only W and OS
+const ahpCriteriaColumns = [
   {
     title: "Business Value (BV)",
     dataIndex: "BV",
@@ -335,6 +321,25 @@ export const ahpColumns = [
     dataIndex: "D",
     key: "D",
   },
+];
+
+export const ahpColumns = (stories = []) => [
+  {
+    title: "Epic",
+    dataIndex: "epic",
+    key: "epic",
+  },
+  {
+    title: "User Story",
+    dataIndex: "user_story",
+    key: "user_story",
+  },
+  {
+    title: "Description",
+    dataIndex: "description",
+    key: "description",
+  },
+  ...(stories.some((story) => story.BV !== undefined) ? ahpCriteriaColumns : []),
   {
     title: "Weight (W)",
     dataIndex: "W",
@@ -348,6 +353,37 @@ export const ahpColumns = [
 ];
 
 
+// Combined table of a multi-technique run: rank and outcome per technique, ordered by mean rank
+export const multiTechniqueColumns = (techniques) => [
+  {
+    title: "Epic",
+    dataIndex: "epic",
+    key: "epic",
+  },
+  {
+    title: "User Story",
+    dataIndex: "user_story",
+    key: "user_story",
+  },
+  ...techniques.flatMap((technique) => [
+    {
+      title: `${technique} Rank`,
+      dataIndex: `${technique}_rank`,
+      key: `${technique}_rank`,
+    },
+    {
+      title: technique,
+      dataIndex: `${technique}_value`,
+      key: `${technique}_value`,
+    },
+  ]),
+  {
+    title: "Mean Rank",
+    dataIndex: "mean_rank",
+    key: "mean_rank",
+  },
+];
+
 // Define columns for your table
 export const testCasesColumns = [
   {
@@ -14,7 +14,8 @@ export const getChatMessageClass = (agentType) => {
       case "Final Prioritization":
         return "chat-message-final";
       default:
-        return "";
+        // Per-technique messages of a multi-technique run, e.g. "Final Prioritization (WSJF)"
+        return agentType.startsWith("Final Prioritization") ? "chat-message-final" : "";
     }
   };
 
@@ -49,7 +50,7 @@ export const getChatMessageClass = (agentType) => {
       case "Final Prioritization":
         return finalIcon;
       default:
-        return defaultIcon;
+        return agentType.startsWith("Final Prioritization") ? finalIcon : defaultIcon;
     }
   };
   
@@ -75,4 +76,21 @@ export const getChatMessageClass = (agentType) => {
       value: "AHP",
       label: "AHP (Analytic Hierarchy Process)",
     },
-  ];
\ No newline at end of file
+  ];
+  // Calls onEvent with every line of an NDJSON response as it arrives
+  export const readNdjson = async (response, onEvent) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    for (;;) {
+      const { done, value } = await reader.read();
+      buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+      const lines = buffer.split("\n");
+      buffer = lines.pop();
+      lines.filter((line) => line.trim()).forEach((line) => onEvent(JSON.parse(line)));
+      if (done) {
+        if (buffer.trim()) onEvent(JSON.parse(buffer));
+        return;
+      }
+    }
+  };
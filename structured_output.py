@@ -0,0 +1,288 @@
+# structured_output.py
+
+import os
+import re
+import json
+import logging
+from typing import List, Literal, Optional, Union
+
+from pydantic import BaseModel, Field, ValidationError
+
+from llm_client import provider_for_model
+from enrichment import MOSCOW_CATEGORIES, KANO_CATEGORIES
+
+logger = logging.getLogger(__name__)
+
+# Ask the technique steps for JSON instead of the line formats the regex parsers expect
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "1") == "1"
+
+
+# Schemas, one item per story
+
+class AHPStory(BaseModel):
+    story_id: int
+    user_story: str = ""
+    BV: float = Field(ge=0, le=10)
+    ER: float = Field(ge=0, le=10)
+    D: float = Field(ge=0, le=10)
+    W: float
+    OS: float
+    reason: str = ""
+
+
+class WSJFStory(BaseModel):
+    story_id: int
+    BV: int = Field(ge=0, le=10)
+    TC: int = Field(ge=0, le=10)
+    RR_OE: int = Field(ge=0, le=10)
+    JS: int = Field(ge=0, le=10)
+    reason: str = ""
+
+
+class MoSCoWStory(BaseModel):
+    story_id: int
+    category: Literal[tuple(MOSCOW_CATEGORIES)]
+    reason: str = ""
+
+
+class KanoStory(BaseModel):
+    story_id: int
+    category: Literal[tuple(KANO_CATEGORIES)]
+    reason: str = ""
+
+
+class DollarStory(BaseModel):
+    story_id: int
+    dollars: float = Field(ge=0, le=100)
+    reason: str = ""
+
+
+class AHPResponse(BaseModel):
+    stories: List[AHPStory]
+    summary: Optional[str] = None
+
+
+class WSJFResponse(BaseModel):
+    stories: List[WSJFStory]
+    summary: Optional[str] = None
+
+
+class MoSCoWResponse(BaseModel):
+    stories: List[MoSCoWStory]
+    summary: Optional[str] = None
+
+
+class KanoResponse(BaseModel):
+    stories: List[KanoStory]
+    summary: Optional[str] = None
+
+
+class DollarResponse(BaseModel):
+    stories: List[DollarStory]
+    summary: Optional[str] = None
+
+
+# Pairwise AHP judgments, collected outside the per-story techniques
+
+class PairJudgment(BaseModel):
+    pair: int
+    preferred: Union[int, str]
+    intensity: int = Field(ge=1, le=9)
+
+
+class PairJudgmentResponse(BaseModel):
+    judgments: List[PairJudgment]
+
+
+# Conversion to the dicts the regex parsers return, so the enrich functions work on either
+
+def _whole(value):
+    return int(value) if float(value).is_integer() else value
+
+
+def ahp_to_legacy(item):
+    return {"ID": item.story_id, "user_story": item.user_story, "BV": _whole(item.BV), "ER": _whole(item.ER),
+            "D": _whole(item.D), "W": item.W, "OS": item.OS}
+
+
+def wsjf_to_legacy(item):
+    return {"story_id": item.story_id, "wsjf_factors": {"BV": item.BV, "TC": item.TC, "RR/OE": item.RR_OE, "JS": item.JS}}
+
+
+def category_to_legacy(item):
+    return {"story_id": item.story_id, "category": item.category}
+
+
+def dollars_to_legacy(item):
+    return {"story_id": item.story_id, "dollars": _whole(item.dollars)}
+
+
+# Text shown in the chat for every parsed story, in the same layout as the line formats
+
+def render_ahp(item):
+    return (f"### Story ID {item.story_id}: {item.user_story}\n- BV: {_whole(item.BV)}\n- ER: {_whole(item.ER)}\n"
+            f"- D: {_whole(item.D)}\n- W: {item.W}\n- OS: {item.OS}\n{item.reason}\n\n")
+
+
+def render_wsjf(item):
+    return (f"- Story ID {item.story_id}:\n  - Business Value (BV): {item.BV}\n  - Time Criticality (TC): {item.TC}\n"
+            f"  - Risk Reduction/Opportunity Enablement (RR/OE): {item.RR_OE}\n  - Job Size (JS): {item.JS}\n{item.reason}\n\n")
+
+
+def render_category(item):
+    return f"- Story ID {item.story_id}: {item.category}\n{item.reason}\n\n"
+
+
+def render_dollars(item):
+    return f"- Story ID {item.story_id}: {_whole(item.dollars)} dollars\n{item.reason}\n\n"
+
+
+# Keyed by the step names the estimate functions pass to score_stories_in_chunks
+TECHNIQUES = {
+    "AHP": {
+        "response": AHPResponse, "item": AHPStory, "to_legacy": ahp_to_legacy, "render": render_ahp,
+        "example": '{"story_id": 3, "user_story": "<story title>", "BV": 8, "ER": 5, "D": 3, "W": 5.33, "OS": 5.33, "reason": "<why>"}',
+    },
+    "WSJF": {
+        "response": WSJFResponse, "item": WSJFStory, "to_legacy": wsjf_to_legacy, "render": render_wsjf,
+        "example": '{"story_id": 3, "BV": 8, "TC": 6, "RR_OE": 4, "JS": 5, "reason": "<why>"}',
+    },
+    "MoSCoW": {
+        "response": MoSCoWResponse, "item": MoSCoWStory, "to_legacy": category_to_legacy, "render": render_category,
+        "example": '{"story_id": 3, "category": "Must Have", "reason": "<why>"}',
+        "note": "category is one of: " + ", ".join(MOSCOW_CATEGORIES) + ".",
+    },
+    "Kano": {
+        "response": KanoResponse, "item": KanoStory, "to_legacy": category_to_legacy, "render": render_category,
+        "example": '{"story_id": 3, "category": "Basic Needs", "reason": "<why>"}',
+        "note": "category is one of: " + ", ".join(KANO_CATEGORIES) + ".",
+    },
+    "100 dollar": {
+        "response": DollarResponse, "item": DollarStory, "to_legacy": dollars_to_legacy, "render": render_dollars,
+        "example": '{"story_id": 3, "dollars": 12, "reason": "<why>"}',
+        "note": "The dollars of all stories add up to exactly 100.",
+    },
+}
+
+
+def structured_output_enabled(technique):
+    return LLM_STRUCTURED_OUTPUT and technique in TECHNIQUES
+
+
+def json_response_format(model, name, response_model):
+    # Groq's JSON mode can't stream, so there the instructions and the tolerant parser do the work
+    provider = provider_for_model(model)
+    if provider != "openai":
+        return None
+    if model.startswith("gpt-4o"):
+        schema = response_model.model_json_schema()
+        return {"type": "json_schema", "json_schema": {"name": re.sub(r"\W", "_", name), "schema": schema}}
+    return {"type": "json_object"}
+
+
+def response_format_for(technique, model):
+    return json_response_format(model, technique, TECHNIQUES[technique]["response"])
+
+
+def structured_instructions(technique):
+    spec = TECHNIQUES[technique]
+    note = f" {spec['note']}" if "note" in spec else ""
+    return (
+        "\n\nInstead of the text format above, answer with a single JSON object and nothing else, shaped like:\n"
+        f'{{"stories": [{spec["example"]}], "summary": "<overall explanation>"}}\n'
+        f"Include one entry in \"stories\" for every story ID listed above, with the explanation in \"reason\".{note}"
+    )
+
+
+class JSONItemStream:
+    # Incremental, tolerant scan of a JSON completion. Every object that sits directly in an array is
+    # returned as soon as its closing brace arrives, so stories can be shown while the rest is generated.
+    # Prose and ``` fences around the JSON are skipped, a truncated tail just yields nothing.
+    def __init__(self):
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.item_depth = None
+        self.buffer = []
+
+    def feed(self, text):
+        items = []
+        for char in text:
+            if self.item_depth is not None:
+                self.buffer.append(char)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = bool(self.stack)
+            elif char in "{[":
+                if char == "{" and self.item_depth is None and self.stack and self.stack[-1] == "[":
+                    self.item_depth = len(self.stack)
+                    self.buffer = ["{"]
+                self.stack.append(char)
+            elif char in "}]" and self.stack:
+                self.stack.pop()
+                if self.item_depth is not None and len(self.stack) == self.item_depth:
+                    try:
+                        items.append(json.loads("".join(self.buffer)))
+                    except ValueError:
+                        pass
+                    self.item_depth = None
+                    self.buffer = []
+        return items
+
+
+def _strip_code_fence(text):
+    text = text.strip()
+    match = re.match(r"^```(?:json)?\s*(.*?)\s*```$", text, re.DOTALL)
+    return match.group(1) if match else text
+
+
+def validate_items(technique, raw_items, item_model=None):
+    item_model = item_model or TECHNIQUES[technique]["item"]
+    items = []
+    for raw in raw_items:
+        try:
+            items.append(item_model.model_validate(raw))
+        except ValidationError as e:
+            logger.warning(f"Skipping invalid {technique} item {raw}: {e.error_count()} error(s)")
+    return items
+
+
+def parse_structured_items(technique, text):
+    # The whole response first, then item by item so one bad story doesn't discard the others
+    try:
+        response = TECHNIQUES[technique]["response"].model_validate_json(_strip_code_fence(text))
+        return response.stories, response.summary
+    except ValidationError:
+        pass
+    items = validate_items(technique, JSONItemStream().feed(text))
+    return items, None
+
+
+def parse_structured_response(technique, text, fallback=None):
+    items, _ = parse_structured_items(technique, text)
+    if not items and fallback is not None:
+        logger.warning(f"No JSON {technique} items found, falling back to the text parser")
+        return fallback(text)
+    return [TECHNIQUES[technique]["to_legacy"](item) for item in items]
+
+
+def render_structured_response(technique, text):
+    # Human-readable version of a complete JSON completion, the raw text when it wasn't JSON at all
+    items, summary = parse_structured_items(technique, text)
+    if not items:
+        return text
+    render = TECHNIQUES[technique]["render"]
+    return "".join(render(item) for item in items) + (summary or "")
+
+
+def extract_summary(text):
+    try:
+        return json.loads(_strip_code_fence(text)).get("summary") or ""
+    except (ValueError, AttributeError):
+        return ""
@@ -0,0 +1,143 @@
+# Pairwise AHP: the sparse comparison design, Harker's weights for incomplete matrices and parsing the judgments
+
+import json
+from math import comb
+
+import numpy as np
+import pytest
+
+from scoring import comparison_pairs, incomplete_pairwise_weights, judgment_components
+from helpers import parse_ahp_judgments
+
+
+def is_connected(n, pairs):
+    return len(judgment_components(n, [(i, j, 1) for i, j in pairs])) == 1
+
+
+@pytest.mark.parametrize("n", [2, 3, 5, 8, 17, 100])
+def test_comparison_pairs_are_sparse_and_connect_all_items(n):
+    pairs = comparison_pairs(n)
+    assert len(pairs) == len(set(pairs))
+    assert all(0 <= i < j < n for i, j in pairs)
+    assert len(pairs) <= n * int(np.ceil(np.log2(n)))
+    assert is_connected(n, pairs)
+
+
+def test_comparison_pairs_small_backlogs():
+    assert comparison_pairs(0) == []
+    assert comparison_pairs(1) == []
+    assert comparison_pairs(2) == [(0, 1)]
+    assert comparison_pairs(4) == [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)]
+    assert len(comparison_pairs(64)) < comb(64, 2) / 4
+
+
+def test_weights_of_a_consistent_complete_matrix():
+    # True weights 4:2:1, every judgment is their ratio
+    weights, consistency_ratio = incomplete_pairwise_weights(3, [(0, 1, 2), (1, 2, 2), (0, 2, 4)])
+    assert weights == pytest.approx([4 / 7, 2 / 7, 1 / 7], abs=1e-6)
+    assert consistency_ratio == pytest.approx(0, abs=1e-6)
+
+
+def test_weights_of_a_consistent_incomplete_matrix():
+    # 0 vs 2 is missing, Harker's method still recovers 4:2:1 from the chain 0 > 1 > 2
+    weights, consistency_ratio = incomplete_pairwise_weights(3, [(0, 1, 2), (1, 2, 2)])
+    assert weights == pytest.approx([4 / 7, 2 / 7, 1 / 7], abs=1e-6)
+    assert consistency_ratio == pytest.approx(0, abs=1e-6)
+
+
+def test_inconsistent_judgments_raise_the_consistency_ratio():
+    # 0 > 1 > 2 > 0 is a cycle
+    weights, consistency_ratio = incomplete_pairwise_weights(3, [(0, 1, 5), (1, 2, 5), (2, 0, 5)])
+    assert weights == pytest.approx([1 / 3] * 3, abs=1e-6)
+    assert consistency_ratio > 1
+
+
+def test_empty_and_single_item():
+    weights, consistency_ratio = incomplete_pairwise_weights(0, [])
+    assert weights.shape == (0,) and consistency_ratio == 0
+    weights, consistency_ratio = incomplete_pairwise_weights(1, [])
+    assert weights.tolist() == [1.0] and consistency_ratio == 0
+
+
+def test_disconnected_judgments_are_rejected():
+    assert judgment_components(4, [(0, 1, 5), (2, 3, 5)]) == [[0, 1], [2, 3]]
+    with pytest.raises(ValueError):
+        incomplete_pairwise_weights(4, [(0, 1, 5), (2, 3, 5)])
+
+
+def test_one_judgment_connects_the_groups():
+    assert judgment_components(4, [(0, 1, 5), (2, 3, 5), (1, 2, 3)]) == [[0, 1, 2, 3]]
+    weights, _ = incomplete_pairwise_weights(4, [(0, 1, 5), (2, 3, 5), (1, 2, 3)])
+    assert list(np.argsort(-weights)) == [0, 1, 2, 3]
+
+
+STORIES = [{"key": 10}, {"key": 11}, {"key": "x"}]
+NUMBERED_PAIRS = {1: (0, 1), 2: (1, 2), 3: (0, 2)}
+
+
+def completion(*judgments):
+    return json.dumps({"judgments": [{"pair": pair, "preferred": preferred, "intensity": intensity} for pair, preferred, intensity in judgments]})
+
+
+def test_parse_judgments_orders_the_preferred_story_first():
+    judgments = parse_ahp_judgments(completion((1, 11, 3), (2, 11, 5), (3, 10, 7)), NUMBERED_PAIRS, STORIES)
+    assert judgments == [(1, 0, 3), (1, 2, 5), (0, 2, 7)]
+
+
+def test_parse_judgments_accepts_keys_as_strings():
+    assert parse_ahp_judgments(completion((2, "x", 2), (1, "10", 4)), NUMBERED_PAIRS, STORIES) == [(2, 1, 2), (0, 1, 4)]
+
+
+def test_parse_judgments_skips_unknown_pairs_stories_and_intensities():
+    judgments = parse_ahp_judgments(
+        completion((4, 10, 3), (1, 12, 3), (2, 11, 12), (3, 10, 2)), NUMBERED_PAIRS, STORIES
+    )
+    assert judgments == [(0, 2, 2)]
+
+
+def test_parse_judgments_of_a_broken_completion():
+    assert parse_ahp_judgments("The stories are all important.", NUMBERED_PAIRS, STORIES) == []
+
+
+class RecordingChannel:
+    # Stands in for the WebSocket, like jobs.JobChannel
+    application_state = "connected"
+
+    def __init__(self):
+        self.frames = []
+
+    async def send_json(self, payload):
+        self.frames.append(payload)
+
+
+def test_disconnected_judgments_fall_back_to_criteria_scores(monkeypatch):
+    import asyncio
+    import helpers
+
+    stories = [{"key": key, "user_story": f"Story {key}", "epic": "E", "description": ""} for key in range(4)]
+    requests = []
+
+    async def send_to_llm(prompt, headers, model, response_format=None):
+        # Only pairs between stories 0-1 and 2-3 are ever answered
+        requests.append(prompt)
+        answers = {(0, 1): 0, (2, 3): 2}
+        lines = [line for line in prompt.splitlines() if line.startswith("- Pair ")]
+        judgments = []
+        for line in lines:
+            number = int(line.split()[2].rstrip(":"))
+            first, second = int(line.split("Story ID ")[1].split()[0]), int(line.split("Story ID ")[2])
+            if (first, second) in answers:
+                judgments.append({"pair": number, "preferred": answers[(first, second)], "intensity": 5})
+        return json.dumps({"judgments": judgments})
+
+    async def estimate_ahp_scores(data, websocket, model, topic_response, context_response):
+        return ["scores"]
+
+    monkeypatch.setattr(helpers, "send_to_llm", send_to_llm)
+    monkeypatch.setattr(helpers, "estimate_ahp_scores", estimate_ahp_scores)
+    channel = RecordingChannel()
+    result = asyncio.run(helpers.estimate_ahp_pairwise({"stories": stories}, channel, "gpt-4o", "", ""))
+
+    assert result == ["scores"]
+    assert len(requests) == 2  # the unanswered pairs were asked for once more
+    assert any("2 separate groups" in str(frame.get("message")) for frame in channel.frames)
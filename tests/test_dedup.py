@@ -0,0 +1,88 @@
+# Near-duplicate detection and merging of backlog stories
+
+import pytest
+
+from dedup import dedupe_backlog, find_duplicate_clusters, merge_duplicates, minhash_signatures
+
+
+WORDS = [f"word{i}" for i in range(60)]
+
+
+def story(key, text, description=""):
+    return {"key": key, "user_story": text, "epic": "Epic", "description": description}
+
+
+def window(start, length=40):
+    # Overlapping runs of the same words, the closer the starts the more word pairs they share
+    return " ".join(WORDS[start:start + length])
+
+
+def test_reworded_story_is_a_duplicate():
+    stories = [
+        story(1, "As a user I want to reset my password by email so that I can log in again", "Send a reset link"),
+        story(2, "As a user, I want to reset my password by email so that I can log in again!", "Send a reset link"),
+        story(3, "As an admin I want to export the monthly invoices as a PDF report"),
+    ]
+    assert find_duplicate_clusters(stories) == [[0, 1]]
+
+
+def test_different_stories_stay_apart():
+    stories = [
+        story(1, "As a user I want to reset my password by email"),
+        story(2, "As an admin I want to export the monthly invoices as PDF"),
+        story(3, "As a visitor I want to browse the catalogue without an account"),
+    ]
+    assert find_duplicate_clusters(stories) == []
+
+
+def test_stories_without_words_are_never_duplicates():
+    assert find_duplicate_clusters([story(1, ""), story(2, "..."), story(3, "")]) == []
+
+
+def test_clusters_are_transitive():
+    stories = [story(1, window(0)), story(2, window(4)), story(3, window(8))]
+    signatures = minhash_signatures(stories)
+    # The first and last story alone are below the threshold, they only join through the middle one
+    assert (signatures[0] == signatures[2]).mean() < 0.75
+    assert (signatures[0] == signatures[1]).mean() >= 0.75
+    assert (signatures[1] == signatures[2]).mean() >= 0.75
+    assert find_duplicate_clusters(stories, threshold=0.75) == [[0, 1, 2]]
+
+
+def test_signatures_are_deterministic():
+    stories = [story(1, window(0)), story(2, window(10))]
+    assert (minhash_signatures(stories) == minhash_signatures(list(stories))).all()
+
+
+def test_merge_keeps_the_first_story_and_lists_the_merged_keys():
+    stories = [story(10, "a"), story(11, "b"), story(12, "c"), story(13, "d"), story(14, "e")]
+    merged = merge_duplicates(stories, [[0, 2, 4], [1, 3]])
+    assert [s["key"] for s in merged] == [10, 11]
+    assert merged[0]["merged_keys"] == [12, 14]
+    assert merged[1]["merged_keys"] == [13]
+    assert "merged_keys" not in stories[0]
+
+
+def test_dedupe_backlog_modes():
+    stories = [story(1, window(0)), story(2, window(0)), story(3, window(20, 10))]
+    assert dedupe_backlog(stories, mode="off") == (stories, [])
+    assert dedupe_backlog(stories, mode="suggest") == (stories, [[0, 1]])
+    kept, clusters = dedupe_backlog(stories, mode="merge")
+    assert [s["key"] for s in kept] == [1, 3] and clusters == [[0, 1]]
+    with pytest.raises(ValueError):
+        dedupe_backlog(stories, mode="drop")
+
+
+def test_submit_prioritization_rejects_an_invalid_mode(monkeypatch):
+    import app
+    queued = []
+    monkeypatch.setattr(app, "submit_job", lambda *args: queued.append(args))
+    state = {"session": None, "session_id": "test"}
+    data = {"stories": [story(1, "a")], "model": "gpt-4o", "prioritization_type": "WSJF"}
+    with pytest.raises(ValueError, match="Unsupported dedup mode 'drop'"):
+        app.submit_prioritization(state, {**data, "dedup": "drop"})
+    with pytest.raises(ValueError, match="key"):
+        app.submit_prioritization(state, {**data, "stories": [{"user_story": "a"}]})
+    assert queued == []
+    app.submit_prioritization(state, {**data, "dedup": "merge"})
+    assert len(queued) == 1
@@ -0,0 +1,123 @@
+# Planning and merging of incremental re-prioritization runs
+
+import pytest
+
+from incremental import plan_incremental_run, merge_incremental_results, reference_stories, session_snapshot
+
+
+def make_stories(count=10):
+    return [
+        {"key": i, "user_story": f"As a user I want feature {i}", "epic": f"Epic {i % 3}", "description": f"Details {i}"}
+        for i in range(count)
+    ]
+
+
+def dollar_results(stories, allocations):
+    return [{**story, "dollar_allocation": value} for story, value in zip(stories, allocations)]
+
+
+def previous_run(stories, technique="WSJF", feedback=(), results=None):
+    return session_snapshot(technique, "gpt-4o", stories, list(feedback), {"po": "", "qa": "", "developer": ""}, results or [])
+
+
+def test_no_previous_session_runs_the_full_workflow():
+    assert plan_incremental_run(None, make_stories(), [], "WSJF", "gpt-4o") is None
+
+
+def test_other_technique_or_model_runs_the_full_workflow():
+    stories = make_stories()
+    previous = previous_run(stories)
+    assert plan_incremental_run(previous, stories, [], "MOSCOW", "gpt-4o") is None
+    assert plan_incremental_run(previous, stories, [], "WSJF", "gpt-4o-mini") is None
+
+
+def test_identical_request_runs_the_full_workflow():
+    stories = make_stories()
+    assert plan_incremental_run(previous_run(stories), stories, [], "WSJF", "gpt-4o") is None
+
+
+def test_removed_feedback_runs_the_full_workflow():
+    stories = make_stories()
+    previous = previous_run(stories, feedback=["Story 3 is urgent"])
+    assert plan_incremental_run(previous, stories, [], "WSJF", "gpt-4o") is None
+
+
+def test_changed_story_is_rescored_alone():
+    stories = make_stories()
+    previous = previous_run(stories)
+    edited = [dict(story) for story in stories]
+    edited[4]["description"] = "New acceptance criteria"
+    assert [story["key"] for story in plan_incremental_run(previous, edited, [], "WSJF", "gpt-4o")] == [4]
+
+
+def test_feedback_naming_a_story_rescores_it():
+    stories = make_stories()
+    rescore = plan_incremental_run(previous_run(stories), stories, ["Story ID 7 must come first"], "WSJF", "gpt-4o")
+    assert [story["key"] for story in rescore] == [7]
+
+
+def test_feedback_naming_no_story_runs_the_full_workflow():
+    stories = make_stories()
+    assert plan_incremental_run(previous_run(stories), stories, ["Be conservative"], "WSJF", "gpt-4o") is None
+
+
+def test_removed_story_only_needs_no_rescoring():
+    stories = make_stories()
+    assert plan_incremental_run(previous_run(stories), stories[:-1], [], "WSJF", "gpt-4o") == []
+
+
+def test_too_many_changes_run_the_full_workflow():
+    stories = make_stories()
+    edited = [{**story, "description": "changed"} if story["key"] < 4 else story for story in stories]
+    assert plan_incremental_run(previous_run(stories), edited, [], "WSJF", "gpt-4o") is None
+
+
+def test_relative_technique_without_references_runs_the_full_workflow():
+    stories = make_stories(4)
+    results = dollar_results(stories, [100, 0, 0, 0])
+    previous = previous_run(stories, "100_DOLLAR", results=results)
+    edited = [dict(story) for story in stories]
+    edited[0]["description"] = "changed"
+    assert plan_incremental_run(previous, edited, [], "100_DOLLAR", "gpt-4o") is None
+
+
+def test_reference_stories_spread_over_the_ranking():
+    stories = make_stories()
+    results = dollar_results(stories, [30, 20, 15, 10, 8, 7, 4, 3, 2, 1])
+    references = reference_stories("100_DOLLAR", results, stories, {4}, count=3)
+    assert [story["key"] for story in references] == [0, 5, 9]
+
+
+@pytest.mark.parametrize("new_value, expected", [(70, 61.49), (0, 0.0)])
+def test_merge_calibrates_dollars_against_the_references(new_value, expected):
+    stories = make_stories(5)
+    previous = dollar_results(stories, [50, 30, 10, 5, 5])
+    # Story 3 re-scored with stories 0, 2 and 4 as references, which keep their previous proportions 50:10:5.
+    # 70 new dollars against 30 for references worth 65 before: 70 * 65 / 30 = 151.67 of 246.67 in total.
+    rest = 100 - new_value
+    rescored = [{**stories[3], "dollar_allocation": new_value}] + [
+        {**stories[key], "dollar_allocation": rest * weight / 65} for key, weight in ((0, 50), (2, 10), (4, 5))
+    ]
+    merged = merge_incremental_results("100_DOLLAR", previous, rescored, stories, {0, 2, 4})
+    by_key = {story["key"]: story["dollar_allocation"] for story in merged}
+    assert by_key[3] == pytest.approx(expected, abs=0.01)
+    assert sum(by_key.values()) == pytest.approx(100, abs=0.05)
+    # The unchanged stories keep their proportions
+    assert by_key[0] / by_key[1] == pytest.approx(50 / 30, rel=0.01)
+
+
+def test_merge_drops_removed_stories_and_renormalizes():
+    stories = make_stories(4)
+    previous = dollar_results(stories, [40, 30, 20, 10])
+    merged = merge_incremental_results("100_DOLLAR", previous, [], stories[:3])
+    assert [story["key"] for story in merged] == [0, 1, 2]
+    assert [story["dollar_allocation"] for story in merged] == pytest.approx([44.44, 33.33, 22.22], abs=0.01)
+
+
+def test_merge_absolute_technique_replaces_the_rescored_story():
+    stories = make_stories(3)
+    factors = [{"BV": 5, "TC": 5, "RR/OE": 5, "JS": 5}, {"BV": 8, "TC": 8, "RR/OE": 8, "JS": 2}, {"BV": 1, "TC": 1, "RR/OE": 1, "JS": 5}]
+    previous = [{**story, "wsjf_factors": f} for story, f in zip(stories, factors)]
+    rescored = [{**stories[2], "wsjf_factors": {"BV": 10, "TC": 10, "RR/OE": 10, "JS": 1}}]
+    merged = merge_incremental_results("WSJF", previous, rescored, stories)
+    assert [story["key"] for story in merged] == [2, 1, 0]
@@ -0,0 +1,220 @@
+# Incremental CSV parsing, story normalization and the streamed upload route
+
+import asyncio
+import json
+
+import pytest
+
+from ingestion import CSVRecordStream, StoryNormalizer, UploadError, iter_upload
+
+
+def feed_chunks(stream, chunks):
+    rows = []
+    for chunk in chunks:
+        rows.extend(stream.feed(chunk))
+    rows.extend(stream.feed(b"", final=True))
+    return rows
+
+
+def split_every(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+CSV_TEXT = (
+    'user_story,epic,description\r\n'
+    '"As a user, I want to log in",Accounts,"Line one\r\nLine two"\r\n'
+    'As an admin I want a 5" screen,Admin,"She said ""hi"""\r\n'
+).encode()
+
+CSV_ROWS = [
+    ["user_story", "epic", "description"],
+    ["As a user, I want to log in", "Accounts", "Line one\r\nLine two"],
+    ['As an admin I want a 5" screen', "Admin", 'She said "hi"'],
+]
+
+
+def test_whole_file_in_one_chunk():
+    assert feed_chunks(CSVRecordStream(), [CSV_TEXT]) == CSV_ROWS
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16])
+def test_rows_are_the_same_for_any_chunking(size):
+    assert feed_chunks(CSVRecordStream(), split_every(CSV_TEXT, size)) == CSV_ROWS
+
+
+def test_crlf_split_across_chunks_keeps_quoted_newline_and_ends_the_record():
+    chunks = [b'a,b\r', b'\n"x\r', b'\ny",z\r', b'\n']
+    assert feed_chunks(CSVRecordStream(), chunks) == [["a", "b"], ["x\r\ny", "z"]]
+
+
+def test_escaped_quote_before_a_newline_does_not_close_the_field():
+    rows = feed_chunks(CSVRecordStream(), [b'h\n"say ""', b'""\nnext"\n'])
+    assert rows == [["h"], ['say ""\nnext']]
+
+
+def test_semicolon_exports_and_a_utf8_bom():
+    data = "\ufeffSummary;Epic Link\nÉtape un;Onboarding\n".encode("utf-8")
+    assert feed_chunks(CSVRecordStream(), split_every(data, 5)) == [["Summary", "Epic Link"], ["Étape un", "Onboarding"]]
+
+
+def test_unclosed_quote_hits_the_record_cap():
+    stream = CSVRecordStream(max_record_chars=50)
+    stream.feed(b'h\n"never closed\n')
+    with pytest.raises(UploadError) as error:
+        for _ in range(10):
+            stream.feed(b"more text on another line\n")
+    assert error.value.status_code == 400
+
+
+def test_long_line_without_a_newline_hits_the_record_cap():
+    stream = CSVRecordStream(max_record_chars=50)
+    with pytest.raises(UploadError):
+        stream.feed(b"x" * 60)
+
+
+def test_normalizer_maps_jira_columns_and_numbers_stories():
+    normalizer = StoryNormalizer()
+    stories = normalizer.normalize([
+        ["Issue key", "Summary", "Epic Link", "Status"],
+        ["P-1", " Log in ", "Accounts", "Done"],
+        ["P-2", "Log out"],
+    ])
+    assert stories == [
+        {"key": 0, "user_story": "Log in", "epic": "Accounts", "description": "", "status": "Done"},
+        {"key": 1, "user_story": "Log out", "epic": "", "description": ""},
+    ]
+    assert normalizer.columns == {"user_story": 1, "epic": 2, "status": 3}
+    assert normalizer.count == 2
+
+
+def test_normalizer_column_overrides_win_over_aliases():
+    normalizer = StoryNormalizer(overrides={"user_story": "Notes"})
+    stories = normalizer.normalize([["Summary", "Notes"], ["ignored", "taken"]])
+    assert stories[0]["user_story"] == "taken"
+
+
+def test_normalizer_row_cap():
+    normalizer = StoryNormalizer(max_rows=2)
+    normalizer.normalize([["user_story"], ["a"], ["b"]])
+    with pytest.raises(UploadError) as error:
+        normalizer.normalize([["c"]])
+    assert error.value.status_code == 413
+
+
+BOUNDARY = "testboundary"
+
+
+def multipart_body(data, filename="stories.csv"):
+    return (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: text/csv\r\n\r\n"
+    ).encode() + data + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+class ChunkedRequest:
+    # What iter_upload uses of a Starlette request
+    def __init__(self, body, chunk_size=64):
+        self.headers = {"content-type": f"multipart/form-data; boundary={BOUNDARY}"}
+        self.chunks = split_every(body, chunk_size)
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def collect(request, **limits):
+    async def run():
+        info = {}
+        batches = [batch async for batch in iter_upload(request, info=info, **limits)]
+        return batches, info
+    return asyncio.run(run())
+
+
+def story_csv(count):
+    return ("user_story,epic\n" + "".join(f"Story {i},Epic {i % 2}\n" for i in range(count))).encode()
+
+
+def test_upload_is_yielded_in_batches():
+    batches, info = collect(ChunkedRequest(multipart_body(story_csv(5))), batch_rows=2)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert [story["key"] for batch in batches for story in batch] == [0, 1, 2, 3, 4]
+    assert info["count"] == 5
+    assert info["columns"] == {"user_story": "user_story", "epic": "epic"}
+
+
+def test_upload_byte_cap():
+    with pytest.raises(UploadError) as error:
+        collect(ChunkedRequest(multipart_body(story_csv(50))), max_bytes=256)
+    assert error.value.status_code == 413
+
+
+def test_upload_row_cap():
+    with pytest.raises(UploadError) as error:
+        collect(ChunkedRequest(multipart_body(story_csv(5))), max_rows=3)
+    assert error.value.status_code == 413
+
+
+def test_unsupported_file_type():
+    with pytest.raises(UploadError):
+        collect(ChunkedRequest(multipart_body(b"text", filename="stories.txt")))
+
+
+def post_upload(body, query="", chunk_size=64):
+    # Calls the app over ASGI with the body in several messages, as a server passes on a large upload.
+    # The response may start while the body is still being received.
+    import app
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/api/upload-csv", "raw_path": b"/api/upload-csv",
+        "root_path": "", "query_string": query.encode(), "server": ("test", 80), "client": ("test", 1234),
+        "headers": [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())],
+    }
+    chunks = split_every(body, chunk_size)
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1} for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()  # a client that stays connected
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app.app(scope, receive, send))
+    status = next(message["status"] for message in sent if message["type"] == "http.response.start")
+    body = b"".join(message.get("body", b"") for message in sent if message["type"] == "http.response.body")
+    return status, body.decode()
+
+
+def ndjson_events(body):
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def test_upload_route_streams_ndjson_batches(monkeypatch):
+    import app
+    monkeypatch.setattr(app, "iter_upload", lambda request, options, info: iter_upload(request, options, info, batch_rows=2))
+    status, body = post_upload(multipart_body(story_csv(3)), chunk_size=16)
+    assert status == 200
+    events = ndjson_events(body)
+    assert [len(event["stories"]) for event in events[:-1]] == [2, 1]
+    assert events[-1]["done"] is True
+    assert events[-1]["count"] == 3
+
+
+def test_upload_route_error_after_the_first_batch_is_the_last_line(monkeypatch):
+    import app
+    monkeypatch.setattr(app, "iter_upload", lambda request, options, info: iter_upload(request, options, info, batch_rows=1, max_rows=2))
+    status, body = post_upload(multipart_body(story_csv(3)), chunk_size=16)
+    events = ndjson_events(body)
+    assert status == 200
+    assert events[0] == {"stories": [{"key": 0, "user_story": "Story 0", "epic": "Epic 0", "description": ""}]}
+    assert events[-1]["status_code"] == 413
+    assert "more than 2 stories" in events[-1]["error"]
+
+
+def test_upload_route_error_before_the_first_batch_keeps_its_status():
+    status, body = post_upload(multipart_body(b"text", filename="stories.txt"))
+    assert status == 400
+    assert "Unsupported file type" in json.loads(body)["error"]
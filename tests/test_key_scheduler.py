@@ -0,0 +1,171 @@
+# Key selection, rate limit buckets and cooldowns of the key scheduler
+
+import asyncio
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import key_scheduler
+from key_scheduler import KeyState, TokenBucket, acquire_key, parse_reset_duration, release_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    # Only the scheduler's clock, the event loop keeps the real one
+    monkeypatch.setattr(key_scheduler, "time", SimpleNamespace(monotonic=fake, time=time.time))
+    return fake
+
+
+@pytest.fixture
+def local_keys(monkeypatch):
+    # Two openai keys with limits tracked in this process only
+    monkeypatch.setattr(key_scheduler, "KEY_STATE_DB", None)
+    monkeypatch.setattr(key_scheduler, "_keys", {})
+    monkeypatch.setattr(key_scheduler, "_provider_buckets", {})
+    monkeypatch.setattr(key_scheduler, "_queues", {})
+    monkeypatch.setattr(key_scheduler, "PROVIDER_LIMITS", {"openai": {"rpm": 0, "tpm": 0}})
+    monkeypatch.setattr(key_scheduler, "load_keys", lambda provider: [
+        KeyState(provider, "API-KEY1", "k1"), KeyState(provider, "API-KEY2", "k2"),
+    ])
+
+
+def test_token_bucket_refills_at_its_rate(clock):
+    bucket = TokenBucket(60)  # one per second
+    bucket.consume(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+    clock.now += 30
+    assert bucket.fill_ratio() == pytest.approx(0.5)
+    assert bucket.wait_time(40) == pytest.approx(10.0)
+    clock.now += 600
+    assert bucket.fill_ratio() == pytest.approx(1.0)
+
+
+def test_token_bucket_request_larger_than_the_bucket_needs_a_full_bucket(clock):
+    bucket = TokenBucket(100)
+    assert bucket.wait_time(1000) == 0.0
+    bucket.consume(1000)
+    assert bucket.level == pytest.approx(0.0)
+
+
+def test_token_bucket_sync_takes_the_providers_count(clock):
+    bucket = TokenBucket(100)
+    bucket.sync(25)
+    assert bucket.level == 25
+    bucket.sync(500)
+    assert bucket.level == 100
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("6m0s", 360.0), ("20ms", 0.02), ("1.5s", 1.5), ("1h2m", 3720.0), ("12", 12.0), ("0.5", 0.5),
+])
+def test_parse_reset_duration(value, seconds):
+    assert parse_reset_duration(value) == pytest.approx(seconds)
+
+
+@pytest.mark.parametrize("value", [None, "", "soon"])
+def test_parse_reset_duration_without_a_duration(value):
+    assert parse_reset_duration(value) is None
+
+
+def test_throttled_key_cools_down_for_the_reset_time(clock, local_keys):
+    keys, buckets, _ = key_scheduler._provider_state("openai")
+    first, second = keys
+    release_key(first, 429, {"x-ratelimit-reset-requests": "6m0s", "x-ratelimit-reset-tokens": "20ms"})
+    assert first.cooldown_until == pytest.approx(clock.now + 360)
+
+    state, _ = key_scheduler._take_local(keys, buckets, 100)
+    assert state is second
+    release_key(second, 429, {})
+    state, wait = key_scheduler._take_local(keys, buckets, 100)
+    assert state is None and wait == pytest.approx(key_scheduler.DEFAULT_THROTTLE_COOLDOWN)
+
+    clock.now += 361
+    state, _ = key_scheduler._take_local(keys, buckets, 100)
+    assert state is first
+
+
+def test_retry_after_wins_over_the_reset_headers(clock, local_keys):
+    keys, _, _ = key_scheduler._provider_state("openai")
+    release_key(keys[0], 429, {"retry-after": "3", "x-ratelimit-reset-requests": "6m0s"})
+    assert keys[0].cooldown_until == pytest.approx(clock.now + 3)
+
+
+def test_acquire_key_prefers_the_least_loaded_key_and_honors_avoid(local_keys):
+    async def run():
+        first = await acquire_key("openai", 100)
+        second = await acquire_key("openai", 100)
+        # A retry avoids the key that just failed even when it is the less loaded one
+        release_key(first)
+        retry = await acquire_key("openai", 100, avoid={first.name})
+        return first, second, retry
+    first, second, retry = asyncio.run(run())
+    assert (first.name, second.name) == ("API-KEY1", "API-KEY2")
+    assert retry.name == "API-KEY2" and retry.in_flight == 2
+
+
+def test_avoided_key_is_still_used_when_it_is_the_only_one_ready(clock, local_keys):
+    keys, _, _ = key_scheduler._provider_state("openai")
+    keys[1].cooldown_until = clock.now + 60
+    state = asyncio.run(acquire_key("openai", 100, avoid={"API-KEY1"}))
+    assert state.name == "API-KEY1"
+
+
+def no_provider_limits():
+    return {"requests": None, "tokens": None}
+
+
+@pytest.fixture
+def shared_db(tmp_path, monkeypatch):
+    path = str(tmp_path / "key_state.db")
+    monkeypatch.setattr(key_scheduler, "KEY_STATE_DB", path)
+    monkeypatch.setattr(key_scheduler, "_key_state_ready", False)
+    return path
+
+
+def shared_cooldown(path, state):
+    requests_id, _ = key_scheduler._bucket_ids(state.provider, state)
+    with sqlite3.connect(path) as connection:
+        row = connection.execute("SELECT cooldown_until FROM key_state WHERE bucket = ?", (requests_id,)).fetchone()
+    return row[0] if row else 0.0
+
+
+def test_shared_take_skips_a_key_cooling_down_in_this_worker(shared_db):
+    first, second = KeyState("openai", "API-KEY1", "k1"), KeyState("openai", "API-KEY2", "k2")
+    first.cooldown_until = time.monotonic() + 60
+    state, wait = key_scheduler._take_shared("openai", [first, second], no_provider_limits(), 100)
+    assert state is second and wait == 0.0
+
+    second.cooldown_until = time.monotonic() + 30
+    state, wait = key_scheduler._take_shared("openai", [first, second], no_provider_limits(), 100)
+    assert state is None
+    assert 25 < wait <= 30
+
+
+def test_throttled_key_cooldown_is_shared_before_release_returns(shared_db):
+    state = KeyState("openai", "API-KEY1", "k1")
+    state.in_flight = 1
+    before = time.time()
+    release_key(state, 429, {"retry-after": "12"})
+    assert before + 11 < shared_cooldown(shared_db, state) <= time.time() + 12
+
+    # Another worker, with no local cooldown for the key, sees it from the shared state alone
+    other_worker = KeyState("openai", "API-KEY1", "k1")
+    taken, wait = key_scheduler._take_shared("openai", [other_worker], no_provider_limits(), 100)
+    assert taken is None and wait > 10
+
+
+def test_rejected_key_cooldown_is_shared(shared_db):
+    state = KeyState("openai", "API-KEY1", "k1")
+    release_key(state, 401)
+    assert shared_cooldown(shared_db, state) > time.time() + key_scheduler.INVALID_KEY_COOLDOWN - 5
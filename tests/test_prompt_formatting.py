@@ -0,0 +1,100 @@
+# Prompt assembly of the technique and role builders: prior agent turns and client feedback arrive as strings
+# and used to go through '\n'.join(), which put a newline between every character.
+
+import pytest
+
+from helpers import (
+    format_discussion, format_client_feedback, construct_ahp_prompt, construct_batch_wsjf_prompt,
+    construct_batch_moscow_prompt, construct_batch_kano_prompt, construct_batch_100_dollar_prompt,
+    construct_product_owner_prompt, construct_senior_developer_prompt, construct_senior_qa_prompt,
+)
+
+STORIES = [
+    {"key": 0, "user_story": "As a courier I want to scan parcels", "epic": "Preparation", "description": "Scanner works offline"},
+    {"key": 1, "user_story": "As a courier I want to print receipts", "epic": "Delivery", "description": "Bluetooth printer"},
+]
+QA_TURN = "QA: story 1 needs offline tests.\nStory 2 depends on the printer driver."
+DEV_TURN = "Developer: scanning is the riskiest part."
+PO_TURN = "PO: receipts are required by law."
+FEEDBACK = "Receipts first\n\nScanning can wait"
+
+TECHNIQUE_BUILDERS = {
+    "AHP": lambda qa, dev: construct_ahp_prompt({"stories": STORIES}, qa, dev),
+    "WSJF": lambda qa, dev: construct_batch_wsjf_prompt(STORIES, qa, dev),
+    "MOSCOW": lambda qa, dev: construct_batch_moscow_prompt(STORIES, qa, dev),
+    "KANO": lambda qa, dev: construct_batch_kano_prompt(STORIES, qa, dev),
+    "100_DOLLAR": lambda qa, dev: construct_batch_100_dollar_prompt({"stories": STORIES}, qa, dev, PO_TURN, FEEDBACK),
+}
+ROLE_BUILDERS = {
+    "PO": construct_product_owner_prompt,
+    "developer": construct_senior_developer_prompt,
+    "QA": construct_senior_qa_prompt,
+}
+
+
+def character_split(text):
+    # What the builders used to produce for a string turn
+    return '\n'.join(text)
+
+
+@pytest.mark.parametrize("technique", TECHNIQUE_BUILDERS)
+def test_technique_prompt_keeps_turns_intact(technique):
+    prompt = TECHNIQUE_BUILDERS[technique](QA_TURN, DEV_TURN)
+    assert QA_TURN in prompt
+    assert DEV_TURN in prompt
+    assert character_split(QA_TURN) not in prompt
+    assert character_split(DEV_TURN) not in prompt
+
+
+@pytest.mark.parametrize("technique", TECHNIQUE_BUILDERS)
+def test_technique_prompt_matches_before_except_the_turns(technique):
+    # The prompt as it was built before, with the turns split per character, differs only in the turns
+    prompt = TECHNIQUE_BUILDERS[technique](QA_TURN, DEV_TURN)
+    before = TECHNIQUE_BUILDERS[technique](character_split(QA_TURN), character_split(DEV_TURN))
+    assert before.replace(character_split(QA_TURN), QA_TURN).replace(character_split(DEV_TURN), DEV_TURN) == prompt
+    assert len(before) - len(prompt) == len(QA_TURN) - 1 + len(DEV_TURN) - 1
+
+
+def test_100_dollar_prompt_lists_feedback_lines():
+    prompt = TECHNIQUE_BUILDERS["100_DOLLAR"](QA_TURN, DEV_TURN)
+    assert PO_TURN in prompt
+    assert "- Receipts first\n- Scanning can wait" in prompt
+    assert "None" not in prompt
+
+
+def test_100_dollar_prompt_without_feedback():
+    prompt = construct_batch_100_dollar_prompt({"stories": STORIES}, QA_TURN, DEV_TURN, PO_TURN, None)
+    assert "None" not in prompt
+
+
+@pytest.mark.parametrize("role", ROLE_BUILDERS)
+def test_role_prompt_lists_feedback_lines(role):
+    prompt = ROLE_BUILDERS[role]({"stories": STORIES}, FEEDBACK)
+    assert "- Receipts first\n- Scanning can wait" in prompt
+    assert character_split("Receipts first") not in prompt
+    assert "- ID 1: 'As a courier I want to scan parcels' - Preparation Scanner works offline" in prompt
+
+
+@pytest.mark.parametrize("technique", TECHNIQUE_BUILDERS)
+def test_technique_builders_do_not_print(technique, capsys):
+    # fit_prompt_to_budget builds a prompt up to four times, the backlog goes to the debug log instead of stdout
+    TECHNIQUE_BUILDERS[technique](QA_TURN, DEV_TURN)
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.parametrize("role", ROLE_BUILDERS)
+def test_role_builders_do_not_print(role, capsys):
+    ROLE_BUILDERS[role]({"stories": STORIES}, FEEDBACK)
+    assert capsys.readouterr().out == ""
+
+
+def test_format_discussion():
+    assert format_discussion(QA_TURN) == QA_TURN
+    assert format_discussion([QA_TURN, DEV_TURN]) == f"{QA_TURN}\n{DEV_TURN}"
+    assert format_discussion(None) == ""
+
+
+def test_format_client_feedback():
+    assert format_client_feedback(FEEDBACK) == ["Receipts first", "Scanning can wait"]
+    assert format_client_feedback(["Receipts first", ""]) == ["Receipts first"]
+    assert format_client_feedback(None) == []
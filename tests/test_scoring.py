@@ -0,0 +1,106 @@
+# Vectorized scores and rankings against small hand-computed examples
+
+import numpy as np
+import pytest
+
+from scoring import (
+    WSJF_CRITERIA, AHP_CRITERIA, factor_matrix, wsjf_scores, weighted_scores, ahp_weights, ahp_scores, rank_order,
+    average_ranks, kendall_w,
+)
+
+
+def wsjf_by_hand(factors):
+    # The per-story formula the vectorized version replaced
+    return (factors['BV'] + factors['TC'] + factors['RR/OE']) / factors['JS'] if factors['JS'] else 0
+
+
+WSJF_FACTORS = [
+    {'BV': 8, 'TC': 5, 'RR/OE': 3, 'JS': 4},   # 16 / 4 = 4
+    {'BV': 1, 'TC': 2, 'RR/OE': 3, 'JS': 0},   # no job size, scored 0
+    {'BV': 10, 'TC': 10, 'RR/OE': 1, 'JS': 7},  # 21 / 7 = 3
+    {'BV': 3, 'TC': 2, 'RR/OE': 1, 'JS': 3},   # 6 / 3 = 2
+]
+
+
+def test_factor_matrix_reads_nested_factors_and_zeroes_bad_values():
+    rows = [{'wsjf_factors': factors} for factors in WSJF_FACTORS]
+    rows.append({'wsjf_factors': {'BV': 'high', 'TC': None, 'JS': '2'}})
+    rows.append({})
+    matrix = factor_matrix(rows, WSJF_CRITERIA, source='wsjf_factors')
+    assert matrix.shape == (6, 4)
+    assert matrix[0].tolist() == [8, 5, 3, 4]
+    assert matrix[4].tolist() == [0, 0, 0, 2]
+    assert matrix[5].tolist() == [0, 0, 0, 0]
+
+
+def test_wsjf_scores_match_the_formula():
+    matrix = factor_matrix(WSJF_FACTORS, WSJF_CRITERIA)
+    scores = wsjf_scores(matrix)
+    assert scores.tolist() == [4.0, 0.0, 3.0, 2.0]
+    assert scores.tolist() == [wsjf_by_hand(factors) for factors in WSJF_FACTORS]
+
+
+def test_zero_job_size_is_scored_zero_without_a_warning():
+    with np.errstate(all="raise"):
+        assert wsjf_scores(np.array([[5.0, 5.0, 5.0, 0.0]])).tolist() == [0.0]
+
+
+def test_weighted_scores():
+    matrix = np.array([[10, 5, 1], [2, 8, 4], [0, 0, 0]], dtype=float)
+    scores = weighted_scores(matrix, [0.5, 0.3, 0.2])
+    assert scores == pytest.approx([5 + 1.5 + 0.2, 1 + 2.4 + 0.8, 0])
+
+
+def test_ahp_scores_default_to_the_plain_average(monkeypatch):
+    import scoring
+    monkeypatch.setattr(scoring, "AHP_CRITERIA_PAIRWISE", None)
+    monkeypatch.setattr(scoring, "_default_ahp_weights", None)
+    matrix = factor_matrix([{'BV': 9, 'ER': 3, 'D': 6}, {'BV': 1, 'ER': 2}], AHP_CRITERIA)
+    assert ahp_scores(matrix) == pytest.approx([6, 1])
+
+
+def test_ahp_weights_of_a_consistent_matrix():
+    # BV is twice as important as ER and four times as important as D, so the weights are 4 : 2 : 1
+    weights, consistency_ratio = ahp_weights([[1, 2, 4], [1 / 2, 1, 2], [1 / 4, 1 / 2, 1]])
+    assert weights == pytest.approx([4 / 7, 2 / 7, 1 / 7])
+    assert consistency_ratio == pytest.approx(0.0, abs=1e-9)
+
+
+def test_ahp_weights_and_consistency_ratio_of_saatys_example():
+    # lambda_max = 3.0385, CI = 0.0193 and CR = CI / 0.58 = 0.033, below the 0.1 limit
+    weights, consistency_ratio = ahp_weights([[1, 3, 5], [1 / 3, 1, 3], [1 / 5, 1 / 3, 1]])
+    assert weights == pytest.approx([0.637, 0.258, 0.105], abs=1e-3)
+    assert consistency_ratio == pytest.approx(0.033, abs=1e-3)
+
+
+def test_inconsistent_judgments_have_a_high_consistency_ratio():
+    # BV > ER > D but D > BV, a cycle
+    _, consistency_ratio = ahp_weights([[1, 5, 1 / 5], [1 / 5, 1, 5], [5, 1 / 5, 1]])
+    assert consistency_ratio > 0.1
+
+
+def test_rank_order_is_stable_for_ties():
+    assert rank_order([3, 5, 5, 1, 5]).tolist() == [1, 2, 4, 0, 3]
+    assert rank_order([3, 5, 5, 1, 5], descending=False).tolist() == [3, 0, 1, 2, 4]
+    assert rank_order([0, 0, 0]).tolist() == [0, 1, 2]
+
+
+def test_rank_order_matches_a_stable_sort():
+    scores = [2.5, 7.0, 2.5, 0.0, 7.0, 1.0]
+    by_hand = sorted(range(len(scores)), key=lambda i: -scores[i])
+    assert rank_order(scores).tolist() == by_hand
+
+
+def test_wsjf_ranking_of_the_example():
+    assert rank_order(wsjf_scores(factor_matrix(WSJF_FACTORS, WSJF_CRITERIA))).tolist() == [0, 2, 3, 1]
+
+
+def test_average_ranks_share_tied_positions():
+    assert average_ranks([10, 20, 20, 5]).tolist() == [3.0, 1.5, 1.5, 4.0]
+
+
+def test_kendall_w_of_full_and_no_agreement():
+    agree = np.array([[1, 1], [2, 2], [3, 3]], dtype=float)
+    opposite = np.array([[1, 3], [2, 2], [3, 1]], dtype=float)
+    assert kendall_w(agree) == pytest.approx(1.0)
+    assert kendall_w(opposite) == pytest.approx(0.0)
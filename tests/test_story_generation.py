@@ -0,0 +1,62 @@
+# Both story generation paths return keyed stories without duplicates
+
+import asyncio
+
+import agent
+
+
+def story_sections(*stories):
+    return "\n".join(
+        f"### User Story {number}:\n- User Story: {text}\n- Epic: {epic}\n- Description: Done when {text.lower()}"
+        for number, (text, epic) in enumerate(stories, start=1)
+    )
+
+
+OUTLINE = "### Epic 1:\n- Epic: Accounts\n- Scope: Sign up and log in\n### Epic 2:\n- Epic: Billing\n- Scope: Invoices\n"
+
+
+def fake_completion(monkeypatch, answer):
+    prompts = []
+
+    async def complete(prompt, model, headers, timeout):
+        prompts.append(prompt)
+        return answer(prompt)
+    monkeypatch.setattr(agent, "complete_user_stories_prompt", complete)
+    return prompts
+
+
+def generate(sectioned, monkeypatch):
+    monkeypatch.setattr(agent, "STORY_GENERATION_SECTIONED", sectioned)
+    return asyncio.run(agent.generate_user_stories_with_epics_async("A shop", "Checkout", "gpt-4o", {}))
+
+
+def test_single_request_path_keys_and_dedupes_the_stories(monkeypatch):
+    fake_completion(monkeypatch, lambda prompt: story_sections(
+        ("Sign up", "Accounts"), ("Log in", "Accounts"), ("Sign up", "Accounts"), ("Pay an invoice", "Billing"),
+    ))
+    stories, failed_epics = generate(False, monkeypatch)
+    assert [(story["key"], story["user_story"]) for story in stories] == [(0, "Sign up"), (1, "Log in"), (2, "Pay an invoice")]
+    assert failed_epics == []
+
+
+def test_sectioned_path_keys_the_stories_in_outline_order(monkeypatch):
+    def answer(prompt):
+        if "planning the epics" in prompt:
+            return OUTLINE
+        if "the epic 'Accounts'" in prompt:
+            return story_sections(("Sign up", "Accounts"), ("Log in", "Accounts"))
+        return story_sections(("Pay an invoice", "Billing"), ("Log in", "Billing"))
+    prompts = fake_completion(monkeypatch, answer)
+    stories, failed_epics = generate(True, monkeypatch)
+    assert len(prompts) == 3
+    assert [(story["key"], story["user_story"], story["epic"]) for story in stories] == [
+        (0, "Sign up", "Accounts"), (1, "Log in", "Accounts"), (2, "Pay an invoice", "Billing"),
+    ]
+    assert failed_epics == []
+
+
+def test_both_paths_return_the_same_shape(monkeypatch):
+    fake_completion(monkeypatch, lambda prompt: OUTLINE if "planning the epics" in prompt else story_sections(("Log in", "Accounts")))
+    single, _ = generate(False, monkeypatch)
+    sectioned, _ = generate(True, monkeypatch)
+    assert set(single[0]) == set(sectioned[0]) == {"key", "user_story", "epic", "description"}
@@ -0,0 +1,145 @@
+# token_budget.py
+
+import os
+import re
+import math
+import logging
+
+from llm_client import provider_for_model
+
+try:
+    import tiktoken
+except ImportError:  # optional, the calibrated character heuristic is used without it
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Context window per model, in tokens
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "llama3-70b-8192": 8192,
+    "llama3-8b-8192": 8192,
+    "mixtral-8x7b-32768": 32768,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+
+# Average characters per token measured on English backlog text
+CHARS_PER_TOKEN = {
+    "openai": 4.0,
+    "groq": 3.6,
+}
+
+# Room left in the context window for the completion itself
+LLM_OUTPUT_TOKEN_RESERVE = int(os.getenv("LLM_OUTPUT_TOKEN_RESERVE", "4096"))
+# Hard cap on prompt size even for large-context models, long prompts are slow and expensive
+LLM_MAX_PROMPT_TOKENS = int(os.getenv("LLM_MAX_PROMPT_TOKENS", "32000"))
+
+COMPACT_DESCRIPTION_CHARS = 200
+
+_encodings = {}
+
+
+def _encoding_for(model):
+    if tiktoken is None or provider_for_model(model) != "openai":
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("o200k_base")
+    return _encodings[model]
+
+
+def estimate_tokens(text, model=None):
+    if model:
+        encoding = _encoding_for(model)
+        if encoding is not None:
+            return len(encoding.encode(text))
+        chars_per_token = CHARS_PER_TOKEN[provider_for_model(model)]
+    else:
+        chars_per_token = CHARS_PER_TOKEN["openai"]
+    return math.ceil(len(text) / chars_per_token)
+
+
+def prompt_budget(model):
+    context_tokens = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+    return min(context_tokens - LLM_OUTPUT_TOKEN_RESERVE, LLM_MAX_PROMPT_TOKENS)
+
+
+def truncate_descriptions(stories, max_chars=COMPACT_DESCRIPTION_CHARS):
+    compacted = []
+    for story in stories:
+        description = story.get('description') or ''
+        if len(description) > max_chars:
+            story = {**story, 'description': description[:max_chars].rstrip() + '...'}
+        compacted.append(story)
+    return compacted
+
+
+def drop_descriptions(stories):
+    return [{**story, 'description': ''} for story in stories]
+
+
+# Allocation and scoring lines ("- ID 3: 10 dollars", "- Story ID 4: Must Have") carry the decision of a turn
+_DECISION_LINE = re.compile(r"^\s*[-*#\d.]*\s*(Story )?ID \d+", re.IGNORECASE)
+
+
+def summarize_turn(text, max_tokens, model=None):
+    # Extractive summary: keep the decision lines first, then the reasoning, in original order, until the budget is used
+    if not text or estimate_tokens(text, model) <= max_tokens:
+        return text
+    lines = [line for line in text.splitlines() if line.strip()]
+    decision = [i for i, line in enumerate(lines) if _DECISION_LINE.match(line)]
+    decision_set = set(decision)
+    reasoning = [i for i in range(len(lines)) if i not in decision_set]
+
+    kept = []
+    used_tokens = 0
+    for i in decision + reasoning:
+        tokens = estimate_tokens(lines[i], model) + 1
+        if used_tokens + tokens > max_tokens:
+            continue
+        kept.append(i)
+        used_tokens += tokens
+    return '\n'.join(lines[i] for i in sorted(kept))
+
+
+def summarize_turns(turns, model):
+    # The earlier turns together get at most half of the model's prompt budget
+    turns = list(turns)
+    if not turns:
+        return turns
+    turn_budget = prompt_budget(model) // (2 * len(turns))
+    return [summarize_turn(turn, turn_budget, model) for turn in turns]
+
+
+def fit_prompt_to_budget(step, model, build_prompt, stories, turns=()):
+    # build_prompt(stories, turns) returns the prompt. Each compaction level is only tried
+    # when the previous one is still over the budget.
+    budget = prompt_budget(model)
+    turns = list(turns)
+
+    def levels():
+        yield "full", stories, turns
+        short_stories = truncate_descriptions(stories)
+        yield "truncated descriptions", short_stories, turns
+        short_turns = summarize_turns(turns, model)
+        yield "summarized discussion", short_stories, short_turns
+        yield "dropped descriptions", drop_descriptions(stories), short_turns
+
+    for level, level_stories, level_turns in levels():
+        prompt = build_prompt(level_stories, level_turns)
+        tokens = estimate_tokens(prompt, model)
+        if tokens <= budget:
+            break
+
+    report = {"step": step, "tokens": tokens, "budget": budget, "compaction": level}
+    if tokens > budget:
+        logger.warning(f"{step} prompt is still over budget after compaction: {tokens}/{budget} tokens")
+    else:
+        logger.info(f"{step} prompt budget: {tokens}/{budget} tokens ({level})")
+    return prompt, report
@@ -0,0 +1,65 @@
+# workflow.py
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def agent_step(name, run, depends_on=()):
+    # run is an async callable that receives the results of depends_on as keyword arguments
+    return {"name": name, "run": run, "depends_on": tuple(depends_on)}
+
+
+def order_steps(steps):
+    by_name = {step["name"]: step for step in steps}
+    if len(by_name) != len(steps):
+        raise ValueError("Duplicate step names in workflow")
+
+    for step in steps:
+        for dep in step["depends_on"]:
+            if dep not in by_name:
+                raise ValueError(f"Step '{step['name']}' depends on unknown step '{dep}'")
+
+    # Kahn's algorithm, keeping the declaration order among steps that are ready together
+    remaining = {step["name"]: len(step["depends_on"]) for step in steps}
+    dependents = {step["name"]: [] for step in steps}
+    for step in steps:
+        for dep in step["depends_on"]:
+            dependents[dep].append(step["name"])
+
+    ordered = []
+    ready = [step["name"] for step in steps if remaining[step["name"]] == 0]
+    while ready:
+        name = ready.pop(0)
+        ordered.append(by_name[name])
+        for dependent in dependents[name]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+
+    if len(ordered) != len(steps):
+        raise ValueError("Workflow steps contain a dependency cycle")
+    return ordered
+
+
+async def run_agent_steps(steps):
+    # Every step starts as soon as its own dependencies are done, independent steps run concurrently
+    tasks = {}
+
+    async def run_step(step):
+        inputs = {dep: await tasks[dep] for dep in step["depends_on"]}
+        logger.info(f"Running workflow step: {step['name']}")
+        return await step["run"](**inputs)
+
+    for step in order_steps(steps):
+        tasks[step["name"]] = asyncio.ensure_future(run_step(step))
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+    return {name: task.result() for name, task in tasks.items()}